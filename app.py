@@ -1,27 +1,2571 @@
-from flask import Flask, request, jsonify, render_template_string
-import requests
+import time
+_INIZIO_IMPORT = time.perf_counter()
+
+from flask import Flask, request, jsonify, render_template_string, Response, stream_with_context, g
 import os
-import chromadb
-import pypdf
 from datetime import datetime
 import re
 import threading
 import json
-import time
+import hashlib
+import glob
+import collections
+import concurrent.futures
+import itertools
+import math
+import sqlite3
+import secrets
+import contextlib
+import contextvars
+import queue
+import atexit
+import gzip
+import shutil
+import string
+from collections import OrderedDict
+
+# Le dipendenze pesanti (chromadb, onnxruntime, numpy, pypdf, httpx) si importano al primo uso:
+# /health, i worker appena avviati e la CLI di caricamento non le pagano se non servono
 
 app = Flask(__name__)
 
 
+class EmbeddingCache:
+    """Cache LRU + TTL testo normalizzato -> embedding della query"""
+
+    def __init__(self, max_entries=512, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalizza(testo):
+        return " ".join(testo.lower().split())
+
+    def get(self, testo):
+        chiave = self.normalizza(testo)
+        with self._lock:
+            entry = self._entries.get(chiave)
+            if entry is not None and time.time() - entry[1] <= self.ttl:
+                self._entries.move_to_end(chiave)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[chiave]
+            self.misses += 1
+            return None
+
+    def put(self, testo, embedding):
+        chiave = self.normalizza(testo)
+        with self._lock:
+            self._entries[chiave] = (embedding, time.time())
+            self._entries.move_to_end(chiave)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        totale = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / totale, 3) if totale else 0.0
+        }
+
+
+class AnswerCache:
+    """Cache persistente (SQLite) delle risposte già generate e validate"""
+
+    def __init__(self, path="answer_cache.sqlite3", similarity=0.95, ttl=86400):
+        self.path = path
+        self.similarity = similarity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        with self._connetti() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS risposte ("
+                "domanda TEXT, bucket INTEGER, chunk_ids TEXT, versione INTEGER, "
+                "embedding TEXT, risposta TEXT, creato REAL, "
+                "PRIMARY KEY (domanda, chunk_ids, versione))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_bucket ON risposte (bucket, chunk_ids, versione)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (chiave TEXT PRIMARY KEY, valore INTEGER)")
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('versione', 0)")
+
+    def _connetti(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def bucket(embedding, bits=16):
+        """Bucket di similarità: segno delle prime componenti dell'embedding"""
+        valore = 0
+        for x in embedding[:bits]:
+            valore = (valore << 1) | (1 if x > 0 else 0)
+        return valore
+
+    @staticmethod
+    def _coseno(a, b):
+        dot = sum(x * y for x, y in zip(a, b))
+        norma = (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
+        return dot / norma if norma else 0.0
+
+    def versione(self):
+        with self._connetti() as conn:
+            return conn.execute("SELECT valore FROM meta WHERE chiave = 'versione'").fetchone()[0]
+
+    def get(self, domanda, embedding, chunk_ids):
+        chiave_chunks = ",".join(sorted(chunk_ids))
+        normalizzata = EmbeddingCache.normalizza(domanda)
+        limite = time.time() - self.ttl
+        with self._connetti() as conn:
+            versione = conn.execute("SELECT valore FROM meta WHERE chiave = 'versione'").fetchone()[0]
+            riga = conn.execute(
+                "SELECT risposta FROM risposte WHERE domanda = ? AND chunk_ids = ? AND versione = ? AND creato > ?",
+                (normalizzata, chiave_chunks, versione, limite)
+            ).fetchone()
+            if riga is None:
+                # Domanda quasi identica: stesso bucket, stessi chunk, embedding molto simile
+                candidati = conn.execute(
+                    "SELECT embedding, risposta FROM risposte "
+                    "WHERE bucket = ? AND chunk_ids = ? AND versione = ? AND creato > ?",
+                    (self.bucket(embedding), chiave_chunks, versione, limite)
+                ).fetchall()
+                for embedding_salvato, risposta in candidati:
+                    if self._coseno(embedding, json.loads(embedding_salvato)) >= self.similarity:
+                        riga = (risposta,)
+                        break
+        if riga is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return riga[0]
+
+    def put(self, domanda, embedding, chunk_ids, risposta):
+        with self._connetti() as conn:
+            versione = conn.execute("SELECT valore FROM meta WHERE chiave = 'versione'").fetchone()[0]
+            conn.execute(
+                "INSERT OR REPLACE INTO risposte VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (EmbeddingCache.normalizza(domanda), self.bucket(embedding), ",".join(sorted(chunk_ids)),
+                 versione, json.dumps(embedding), risposta, time.time())
+            )
+
+    def invalida(self):
+        """Nuova versione della collection: le risposte precedenti non sono più valide"""
+        with self._connetti() as conn:
+            conn.execute("UPDATE meta SET valore = valore + 1 WHERE chiave = 'versione'")
+            conn.execute("DELETE FROM risposte")
+
+    def stats(self):
+        totale = self.hits + self.misses
+        with self._connetti() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM risposte").fetchone()[0]
+        return {
+            "entries": entries,
+            "versione": self.versione(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / totale, 3) if totale else 0.0
+        }
+
+
+class SessioniMemoria:
+    """Stato delle conversazioni nel processo: LRU + TTL, valido per un solo worker"""
+
+    def __init__(self, max_sessioni=10000, ttl=3600):
+        self.max_sessioni = max_sessioni
+        self.ttl = ttl
+        self._sessioni = OrderedDict()
+        self._lock = threading.Lock()
+
+    def carica(self, id_sessione):
+        with self._lock:
+            entry = self._sessioni.get(id_sessione)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.ttl:
+                del self._sessioni[id_sessione]
+                return None
+            self._sessioni.move_to_end(id_sessione)
+            return json.loads(entry[0])
+
+    def salva(self, id_sessione, stato):
+        # Serializzato come nei backend condivisi: lo stato restituito è sempre una copia
+        with self._lock:
+            self._sessioni[id_sessione] = (json.dumps(stato, ensure_ascii=False), time.time())
+            self._sessioni.move_to_end(id_sessione)
+            while len(self._sessioni) > self.max_sessioni:
+                self._sessioni.popitem(last=False)
+
+    def elimina(self, id_sessione):
+        with self._lock:
+            self._sessioni.pop(id_sessione, None)
+
+    def stats(self):
+        return {"backend": "memoria", "sessioni": len(self._sessioni),
+                "max_sessioni": self.max_sessioni, "ttl": self.ttl}
+
+
+class SessioniSQLite:
+    """Stato delle conversazioni in un file SQLite condiviso tra worker e processi"""
+
+    def __init__(self, path="sessioni.sqlite3", ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        with self._connetti() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessioni (id TEXT PRIMARY KEY, stato TEXT, aggiornato REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_aggiornato ON sessioni (aggiornato)")
+
+    def _connetti(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def carica(self, id_sessione):
+        with self._connetti() as conn:
+            riga = conn.execute(
+                "SELECT stato FROM sessioni WHERE id = ? AND aggiornato > ?",
+                (id_sessione, time.time() - self.ttl)
+            ).fetchone()
+        return json.loads(riga[0]) if riga else None
+
+    def salva(self, id_sessione, stato):
+        adesso = time.time()
+        with self._connetti() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessioni VALUES (?, ?, ?)",
+                         (id_sessione, json.dumps(stato, ensure_ascii=False), adesso))
+            # Pulizia delle sessioni scadute
+            conn.execute("DELETE FROM sessioni WHERE aggiornato <= ?", (adesso - self.ttl,))
+
+    def elimina(self, id_sessione):
+        with self._connetti() as conn:
+            conn.execute("DELETE FROM sessioni WHERE id = ?", (id_sessione,))
+
+    def stats(self):
+        with self._connetti() as conn:
+            sessioni = conn.execute("SELECT COUNT(*) FROM sessioni WHERE aggiornato > ?",
+                                    (time.time() - self.ttl,)).fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "sessioni": sessioni, "ttl": self.ttl}
+
+
+class SessioniRedis:
+    """Stato delle conversazioni su un server compatibile Redis (Redis, Valkey, KeyDB...)"""
+
+    def __init__(self, url="redis://localhost:6379/0", ttl=3600, prefisso="sessione:"):
+        import redis  # opzionale: necessario solo con SESSION_BACKEND=redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefisso = prefisso
+
+    def carica(self, id_sessione):
+        valore = self.client.get(self.prefisso + id_sessione)
+        return json.loads(valore) if valore else None
+
+    def salva(self, id_sessione, stato):
+        self.client.set(self.prefisso + id_sessione, json.dumps(stato, ensure_ascii=False), ex=self.ttl)
+
+    def elimina(self, id_sessione):
+        self.client.delete(self.prefisso + id_sessione)
+
+    def stats(self):
+        return {"backend": "redis", "ttl": self.ttl}
+
+
+class ArchivioSessioni:
+    """Stato per sessione (cronologia e ticket in compilazione) sopra un backend intercambiabile"""
+
+    STORICO_MAX = 10
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @classmethod
+    def da_ambiente(cls):
+        tipo = os.environ.get("SESSION_BACKEND", "memoria")
+        ttl = int(os.environ.get("SESSION_TTL", 3600))
+        if tipo == "sqlite":
+            backend = SessioniSQLite(path=os.environ.get("SESSION_DB_PATH", "sessioni.sqlite3"), ttl=ttl)
+        elif tipo == "redis":
+            backend = SessioniRedis(url=os.environ.get("SESSION_REDIS_URL", "redis://localhost:6379/0"), ttl=ttl)
+        else:
+            backend = SessioniMemoria(max_sessioni=int(os.environ.get("SESSION_MAX", 10000)), ttl=ttl)
+        return cls(backend)
+
+    @staticmethod
+    def nuovo_id():
+        return secrets.token_urlsafe(24)
+
+    @staticmethod
+    def stato_iniziale():
+        return {"chat_history": [], "awaiting_ticket_field": None, "ticket_data": {}}
+
+    def carica(self, id_sessione):
+        stato = self.backend.carica(id_sessione) if id_sessione else None
+        return stato if stato is not None else self.stato_iniziale()
+
+    def salva(self, id_sessione, stato):
+        stato["chat_history"] = stato["chat_history"][-self.STORICO_MAX:]
+        self.backend.salva(id_sessione, stato)
+
+    def stats(self):
+        return self.backend.stats()
+
+
+class CodaTicket:
+    """Coda persistente (SQLite) delle email dei ticket, svuotata da un pool fisso di thread.
+
+    Un ticket accodato non si perde: resta su disco finché SendGrid non risponde 202. Gli errori
+    temporanei (rete, 429, 5xx) sono ritentati con backoff esponenziale; dopo max_tentativi, o
+    con un errore definitivo (altri 4xx), il ticket passa in dead letter e può essere riaccodato.
+    Un ticket "in_invio" di un processo terminato torna disponibile alla scadenza del lease.
+    Ogni presa assegna ai ticket un proprietario: il lease si rinnova subito prima di ogni invio
+    (quindi un blocco lento non scade a metà) e esito e rinnovo valgono solo per il proprietario,
+    così un ticket ripreso da un altro worker non viene inviato né aggiornato due volte.
+
+    I dati personali di un ticket inviato vengono cancellati subito (resta solo la riga, per le
+    statistiche); le righe inviate e quelle in dead letter più vecchie di conservazione secondi
+    vengono eliminate."""
+
+    STATI = ("in_attesa", "in_invio", "inviato", "dead")
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    INTERVALLO_PULIZIA = 3600
+
+    def __init__(self, path="ticket_queue.sqlite3", workers=2, max_tentativi=8, backoff=2.0,
+                 backoff_max=600, lease=60, batch=10, url=None, timeout=10, conservazione=30 * 86400):
+        self.path = path
+        self.workers = workers
+        self.max_tentativi = max_tentativi
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self.batch = batch
+        self.url = url or os.environ.get("SENDGRID_URL", "https://api.sendgrid.com/v3/mail/send")
+        self.timeout = timeout
+        self.conservazione = conservazione
+        self._ultima_pulizia = 0.0
+        self._client = None
+        self._pid = None
+        self._threads = []
+        self._evento = threading.Event()
+        self._lock = threading.Lock()
+        with self._connetti() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ticket ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, dati TEXT, stato TEXT, tentativi INTEGER, "
+                "prossimo_tentativo REAL, ultimo_errore TEXT, creato REAL, aggiornato REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_stato ON ticket (stato, prossimo_tentativo)")
+            colonne = {riga[1] for riga in conn.execute("PRAGMA table_info(ticket)")}
+            if "proprietario" not in colonne:
+                conn.execute("ALTER TABLE ticket ADD COLUMN proprietario TEXT")
+
+    def _connetti(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _avvia(self):
+        # Thread e client HTTP sono per processo: si (ri)creano anche dopo una fork di gunicorn
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._client = None
+            self._threads = [threading.Thread(target=self._lavora, name=f"coda-ticket-{i}", daemon=True)
+                             for i in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+
+    @property
+    def client(self):
+        if self._client is None:
+            import httpx
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(
+                        limits=httpx.Limits(max_connections=self.workers, max_keepalive_connections=self.workers),
+                        timeout=self.timeout
+                    )
+        return self._client
+
+    def accoda(self, dati_ticket):
+        adesso = time.time()
+        with self._connetti() as conn:
+            cursore = conn.execute(
+                "INSERT INTO ticket (dati, stato, tentativi, prossimo_tentativo, creato, aggiornato) "
+                "VALUES (?, 'in_attesa', 0, ?, ?, ?)",
+                (json.dumps(dati_ticket, ensure_ascii=False), adesso, adesso, adesso)
+            )
+            id_ticket = cursore.lastrowid
+        self._avvia()
+        self._evento.set()
+        return id_ticket
+
+    def _prendi(self):
+        """Riserva (con lease) un blocco di ticket pronti, in modo atomico anche tra processi.
+
+        Restituisce il token del proprietario e le righe (id, dati, tentativi)"""
+        adesso = time.time()
+        proprietario = secrets.token_hex(8)
+        conn = self._connetti()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            righe = conn.execute(
+                "SELECT id, dati, tentativi FROM ticket "
+                "WHERE stato IN ('in_attesa', 'in_invio') AND prossimo_tentativo <= ? "
+                "ORDER BY prossimo_tentativo LIMIT ?",
+                (adesso, self.batch)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE ticket SET stato = 'in_invio', proprietario = ?, prossimo_tentativo = ?, "
+                "aggiornato = ? WHERE id = ?",
+                [(proprietario, adesso + self.lease, adesso, riga[0]) for riga in righe]
+            )
+            conn.commit()
+            return proprietario, righe
+        finally:
+            conn.close()
+
+    def _rinnova(self, id_ticket, proprietario):
+        """Estende il lease prima di un invio; False se il ticket non è più di questo proprietario"""
+        adesso = time.time()
+        with self._connetti() as conn:
+            return conn.execute(
+                "UPDATE ticket SET prossimo_tentativo = ?, aggiornato = ? "
+                "WHERE id = ? AND proprietario = ? AND stato = 'in_invio'",
+                (adesso + self.lease, adesso, id_ticket, proprietario)
+            ).rowcount == 1
+
+    def _attesa(self, tentativi, response=None):
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after and retry_after.replace(".", "", 1).isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return min(self.backoff * (2 ** tentativi), self.backoff_max)
+
+    def _esito(self, id_ticket, proprietario, tentativi, errore=None, definitivo=False, attesa=None):
+        adesso = time.time()
+        if errore is None:
+            stato, prossimo = "inviato", adesso
+        elif definitivo or tentativi >= self.max_tentativi:
+            stato, prossimo = "dead", adesso
+            print(f"☠️ Ticket {id_ticket} in dead letter dopo {tentativi} tentativi: {errore}")
+        else:
+            stato, prossimo = "in_attesa", adesso + (attesa if attesa is not None else self._attesa(tentativi))
+        with self._connetti() as conn:
+            aggiornato = conn.execute(
+                "UPDATE ticket SET stato = ?, tentativi = ?, prossimo_tentativo = ?, ultimo_errore = ?, "
+                "aggiornato = ?, proprietario = NULL WHERE id = ? AND proprietario = ?",
+                (stato, tentativi, prossimo, errore, adesso, id_ticket, proprietario)
+            ).rowcount
+            if not aggiornato:
+                print(f"⚠️ Ticket {id_ticket} ripreso da un altro worker: esito ignorato")
+            elif stato == "inviato":
+                # Email consegnata: nome, reparto e telefono non servono più
+                conn.execute("UPDATE ticket SET dati = NULL WHERE id = ?", (id_ticket,))
+
+    def pulisci(self):
+        """Elimina i ticket inviati o in dead letter più vecchi del periodo di conservazione"""
+        self._ultima_pulizia = time.time()
+        with self._connetti() as conn:
+            eliminati = conn.execute(
+                "DELETE FROM ticket WHERE stato IN ('inviato', 'dead') AND aggiornato < ?",
+                (time.time() - self.conservazione,)
+            ).rowcount
+        if eliminati:
+            print(f"🧹 {eliminati} ticket eliminati dalla coda (oltre il periodo di conservazione)")
+        return eliminati
+
+    @staticmethod
+    def messaggio(dati_ticket):
+        mittente = os.environ.get("SENDGRID_FROM_EMAIL", "marco.dimico@gmail.com")
+        destinatario = os.environ.get("SUPPORT_EMAIL", "toscanaticket@gmail.com")
+        corpo = "Un utente ha aperto un ticket tramite il bot:\n\n"
+        for campo, valore in dati_ticket.items():
+            corpo += f"{campo.capitalize()}: {valore}\n"
+        return {
+            "personalizations": [{
+                "to": [{"email": destinatario}],
+                "reply_to": {"email": "toscanaticket@gmail.com"}
+            }],
+            "from": {"email": mittente, "name": "Bot Sanità Toscana"},
+            "subject": "🆕 Ticket aperto dal bot - Sanità Toscana",
+            "content": [{"type": "text/plain", "value": corpo}]
+        }
+
+    def _invia(self, id_ticket, proprietario, dati, tentativi):
+        import httpx
+        if not self._rinnova(id_ticket, proprietario):
+            return
+        tentativi += 1
+        sendgrid_api_key = os.environ.get("SENDGRID_API_KEY")
+        if not sendgrid_api_key:
+            # Configurazione mancante: il ticket resta in coda e viene ritentato
+            print("📧 SENDGRID_API_KEY non configurata")
+            self._esito(id_ticket, proprietario, tentativi, "SENDGRID_API_KEY non configurata")
+            return
+        try:
+            response = self.client.post(
+                self.url,
+                headers={
+                    "Authorization": f"Bearer {sendgrid_api_key}",
+                    "Content-Type": "application/json"
+                },
+                json=self.messaggio(json.loads(dati))
+            )
+        except httpx.TransportError as e:
+            self._esito(id_ticket, proprietario, tentativi, f"Errore di rete: {e}")
+            return
+        if response.status_code == 202:
+            print(f"✅ Email del ticket {id_ticket} inviata con successo via SendGrid")
+            self._esito(id_ticket, proprietario, tentativi)
+        elif response.status_code in self.RETRY_STATUS:
+            self._esito(id_ticket, proprietario, tentativi, f"SendGrid {response.status_code}",
+                        attesa=self._attesa(tentativi - 1, response))
+        else:
+            print(f"❌ Errore SendGrid: {response.status_code} - {response.text}")
+            self._esito(id_ticket, proprietario, tentativi, f"SendGrid {response.status_code}: {response.text[:200]}",
+                        definitivo=True)
+
+    def _lavora(self):
+        while True:
+            try:
+                proprietario, righe = self._prendi()
+            except sqlite3.Error as e:
+                print(f"❌ Coda ticket non leggibile: {e}")
+                proprietario, righe = None, []
+            for id_ticket, dati, tentativi in righe:
+                try:
+                    self._invia(id_ticket, proprietario, dati, tentativi)
+                except Exception as e:
+                    print(f"❌ Errore invio ticket {id_ticket}: {e}")
+            if not righe:
+                if time.time() - self._ultima_pulizia > self.INTERVALLO_PULIZIA:
+                    try:
+                        self.pulisci()
+                    except sqlite3.Error as e:
+                        print(f"❌ Pulizia della coda ticket fallita: {e}")
+                self._evento.wait(timeout=self._prossima_scadenza())
+                self._evento.clear()
+
+    def _prossima_scadenza(self):
+        with self._connetti() as conn:
+            prossimo = conn.execute(
+                "SELECT MIN(prossimo_tentativo) FROM ticket WHERE stato IN ('in_attesa', 'in_invio')"
+            ).fetchone()[0]
+        if prossimo is None:
+            return 30
+        return min(max(prossimo - time.time(), 0.05), 30)
+
+    def riprendi(self):
+        """All'avvio del processo: riparte a svuotare i ticket rimasti in coda"""
+        self.pulisci()
+        with self._connetti() as conn:
+            pendenti = conn.execute(
+                "SELECT COUNT(*) FROM ticket WHERE stato IN ('in_attesa', 'in_invio')"
+            ).fetchone()[0]
+        if pendenti:
+            print(f"📬 {pendenti} ticket in coda da inviare")
+            self._avvia()
+            self._evento.set()
+        return pendenti
+
+    def riaccoda_dead(self):
+        """Rimette in coda i ticket in dead letter (es. dopo aver corretto la configurazione)"""
+        adesso = time.time()
+        with self._connetti() as conn:
+            riaccodati = conn.execute(
+                "UPDATE ticket SET stato = 'in_attesa', tentativi = 0, prossimo_tentativo = ?, aggiornato = ? "
+                "WHERE stato = 'dead'", (adesso, adesso)
+            ).rowcount
+        if riaccodati:
+            self._avvia()
+            self._evento.set()
+        return riaccodati
+
+    def stats(self):
+        with self._connetti() as conn:
+            conteggi = dict(conn.execute("SELECT stato, COUNT(*) FROM ticket GROUP BY stato").fetchall())
+            piu_vecchio = conn.execute(
+                "SELECT MIN(creato) FROM ticket WHERE stato IN ('in_attesa', 'in_invio')"
+            ).fetchone()[0]
+        return {
+            "profondita": conteggi.get("in_attesa", 0) + conteggi.get("in_invio", 0),
+            "per_stato": {stato: conteggi.get(stato, 0) for stato in self.STATI},
+            "attesa_max_s": round(time.time() - piu_vecchio, 1) if piu_vecchio else 0.0,
+            "workers": self.workers,
+            "workers_attivi": sum(thread.is_alive() for thread in self._threads)
+        }
+
+
+class RegistroInterazioni:
+    """Log delle interazioni non bloccante: le richieste accodano, un thread scrive a blocchi.
+
+    Il file JSONL viene ruotato per dimensione o al cambio di data; i file ruotati sono compressi
+    (gzip) e ne vengono conservati al più max_archivi. Con più worker gunicorn le scritture e la
+    rotazione sono serializzate da un flock."""
+
+    COLONNE = ("timestamp", "domanda", "risposta", "confidence", "documenti_count", "sources", "distanza_min")
+
+    # Sentinella accodata da chiudi(): il thread scrive il blocco in corso e termina
+    _FINE = object()
+
+    def __init__(self, path="interaction_log.jsonl", flush_righe=100, flush_secondi=2.0,
+                 max_bytes=50 * 1024 * 1024, max_archivi=30, coda_max=10000):
+        self.path = path
+        self.flush_righe = flush_righe
+        self.flush_secondi = flush_secondi
+        self.max_bytes = max_bytes
+        self.max_archivi = max_archivi
+        self._coda = queue.Queue(maxsize=coda_max)
+        self._pid = None
+        self._thread = None
+        self._atexit = False
+        self._lock = threading.Lock()
+        self.scritte = 0
+        self.scartate = 0
+        self.rotazioni = 0
+
+    def _avvia(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._lavora, name="registro-interazioni", daemon=True)
+            self._thread.start()
+            if not self._atexit:
+                atexit.register(self.chiudi)
+                self._atexit = True
+
+    def scrivi(self, voce):
+        """Accoda una voce; se la coda è piena la voce viene scartata, mai bloccata la richiesta"""
+        self._avvia()
+        try:
+            self._coda.put_nowait(voce)
+        except queue.Full:
+            self.scartate += 1
+
+    def _lavora(self):
+        while True:
+            voce = self._coda.get()
+            if voce is self._FINE:
+                return
+            blocco = [voce]
+            fine = False
+            scadenza = time.time() + self.flush_secondi
+            while len(blocco) < self.flush_righe:
+                try:
+                    voce = self._coda.get(timeout=max(scadenza - time.time(), 0))
+                except queue.Empty:
+                    break
+                if voce is self._FINE:
+                    fine = True
+                    break
+                blocco.append(voce)
+            self._scrivi_blocco(blocco)
+            if fine:
+                return
+
+    def _scrivi_blocco(self, blocco):
+        import fcntl
+        righe = "".join(json.dumps(voce, ensure_ascii=False) + "\n" for voce in blocco)
+        try:
+            with open(f"{self.path}.lock", 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._ruota_se_necessario()
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(righe)
+            self.scritte += len(blocco)
+        except Exception as e:
+            print(f"Errore nel logging: {e}")
+
+    def _ruota_se_necessario(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        giorno_file = datetime.fromtimestamp(stat.st_mtime).date()
+        if stat.st_size < self.max_bytes and giorno_file == datetime.now().date():
+            return
+        base, estensione = os.path.splitext(self.path)
+        archivio = f"{base}.{datetime.fromtimestamp(stat.st_mtime):%Y%m%d-%H%M%S-%f}{estensione}"
+        os.replace(self.path, archivio)
+        with open(archivio, 'rb') as origine, gzip.open(f"{archivio}.gz", 'wb') as destinazione:
+            shutil.copyfileobj(origine, destinazione)
+        os.remove(archivio)
+        self.rotazioni += 1
+        for vecchio in self.archivi()[:-self.max_archivi or None]:
+            os.remove(vecchio)
+
+    def archivi(self):
+        base, estensione = os.path.splitext(self.path)
+        return sorted(glob.glob(f"{glob.escape(base)}.*{estensione}.gz"))
+
+    def chiudi(self, timeout=10):
+        """Ferma il thread di scrittura dopo che ha scritto il blocco in corso e la coda (all'uscita
+        del processo); una scrittura successiva lo riavvia"""
+        with self._lock:
+            thread = self._thread if self._pid == os.getpid() else None
+            self._thread = None
+            self._pid = None
+        if thread is not None and thread.is_alive():
+            try:
+                self._coda.put(self._FINE, timeout=timeout)
+                thread.join(timeout)
+            except queue.Full:
+                print("⚠️ Registro interazioni: coda piena alla chiusura")
+        # Voci rimaste senza thread (es. processo figlio di una fork)
+        blocco = []
+        while True:
+            try:
+                voce = self._coda.get_nowait()
+            except queue.Empty:
+                break
+            if voce is not self._FINE:
+                blocco.append(voce)
+        if blocco:
+            self._scrivi_blocco(blocco)
+
+    def leggi(self):
+        """Tutte le voci, dagli archivi compressi al file corrente"""
+        for file_path in self.archivi() + [self.path]:
+            if not os.path.exists(file_path):
+                continue
+            apri = gzip.open if file_path.endswith(".gz") else open
+            with apri(file_path, 'rt', encoding='utf-8') as f:
+                for riga in f:
+                    if riga.strip():
+                        yield json.loads(riga)
+
+    def esporta(self, destinazione):
+        """Esportazione colonnare per l'analisi offline: Parquet se pyarrow è installato,
+        altrimenti un .npz compresso con un array per colonna"""
+        colonne = {nome: [] for nome in self.COLONNE}
+        for voce in self.leggi():
+            documenti = voce.get("documenti_utilizzati", [])
+            colonne["timestamp"].append(voce.get("timestamp", ""))
+            colonne["domanda"].append(voce.get("domanda", ""))
+            colonne["risposta"].append(voce.get("risposta", ""))
+            colonne["confidence"].append(float(voce.get("confidence") or 0.0))
+            colonne["documenti_count"].append(int(voce.get("documenti_count") or 0))
+            colonne["sources"].append("|".join(sorted({d.get("source", "") for d in documenti})))
+            colonne["distanza_min"].append(min((d.get("distance", 1.0) for d in documenti), default=1.0))
+        if destinazione.endswith(".parquet"):
+            import pyarrow
+            import pyarrow.parquet
+            pyarrow.parquet.write_table(pyarrow.table(colonne), destinazione, compression="zstd")
+        else:
+            import numpy as np
+            np.savez_compressed(destinazione, **{
+                nome: np.array(valori, dtype=np.float32 if nome in ("confidence", "distanza_min")
+                               else np.int32 if nome == "documenti_count" else str)
+                for nome, valori in colonne.items()
+            })
+        return len(colonne["timestamp"])
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "in_coda": self._coda.qsize(),
+            "scritte": self.scritte,
+            "scartate": self.scartate,
+            "rotazioni": self.rotazioni,
+            "archivi": len(self.archivi())
+        }
+
+
+class Metriche:
+    """Tempi per fase (span) aggregati in memoria ed esposti in formato testo Prometheus.
+
+    Per ogni fase si tengono conteggio, somma e le ultime `finestra` durate, da cui si calcolano
+    p50/p95/p99. Gli span aperti durante una richiesta vengono anche raccolti nel dettaglio della
+    richiesta corrente (contextvar), che può finire nel log delle interazioni."""
+
+    QUANTILI = (0.5, 0.95, 0.99)
+
+    def __init__(self, finestra=2048):
+        self.finestra = finestra
+        self._fasi = {}
+        self._lock = threading.Lock()
+        self._richiesta = contextvars.ContextVar("tempi_richiesta", default=None)
+
+    def registra(self, fase, durata):
+        with self._lock:
+            voce = self._fasi.get(fase)
+            if voce is None:
+                voce = self._fasi[fase] = {"count": 0, "sum": 0.0, "ultime": collections.deque(maxlen=self.finestra)}
+            voce["count"] += 1
+            voce["sum"] += durata
+            voce["ultime"].append(durata)
+        tempi = self._richiesta.get()
+        if tempi is not None:
+            tempi[fase] = round(tempi.get(fase, 0.0) + durata * 1000, 2)
+
+    @contextlib.contextmanager
+    def fase(self, nome):
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registra(nome, time.perf_counter() - inizio)
+
+    def inizia_richiesta(self):
+        """Nuovo dettaglio dei tempi (ms per fase) per la richiesta in corso in questo contesto"""
+        tempi = {}
+        self._richiesta.set(tempi)
+        return tempi
+
+    def tempi_richiesta(self):
+        return self._richiesta.get()
+
+    @staticmethod
+    def _quantile(ordinati, q):
+        if not ordinati:
+            return 0.0
+        return ordinati[min(int(q * len(ordinati)), len(ordinati) - 1)]
+
+    def riepilogo(self):
+        with self._lock:
+            fasi = {nome: (voce["count"], voce["sum"], sorted(voce["ultime"])) for nome, voce in self._fasi.items()}
+        return {
+            nome: {"count": count, "sum": round(somma, 6),
+                   **{f"p{int(q * 100)}": round(self._quantile(ordinati, q), 6) for q in self.QUANTILI}}
+            for nome, (count, somma, ordinati) in sorted(fasi.items())
+        }
+
+    def prometheus(self, valori=None):
+        """Esposizione testuale: un summary per le fasi più eventuali gauge (nome -> valore)"""
+        righe = [
+            "# HELP bot_fase_durata_secondi Durata delle fasi di richieste e caricamenti",
+            "# TYPE bot_fase_durata_secondi summary"
+        ]
+        for nome, voce in self.riepilogo().items():
+            for q in self.QUANTILI:
+                righe.append(f'bot_fase_durata_secondi{{fase="{nome}",quantile="{q}"}} {voce[f"p{int(q * 100)}"]}')
+            righe.append(f'bot_fase_durata_secondi_sum{{fase="{nome}"}} {voce["sum"]}')
+            righe.append(f'bot_fase_durata_secondi_count{{fase="{nome}"}} {voce["count"]}')
+        for nome, valore in (valori or {}).items():
+            righe.append(f"# TYPE {nome} gauge")
+            righe.append(f"{nome} {valore}")
+        return "\n".join(righe) + "\n"
+
+
+# Unica istanza per processo: usata dal Bot, dai loader e dalle route
+metriche = Metriche()
+
+
+class LLMError(Exception):
+    """Errore della chiamata al modello (HTTP o di rete)"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class GroqClient:
+    """Client chat-completions (protocollo OpenAI) con connessioni HTTP condivise.
+
+    Dentro scadenza(secondi) tutte le chiamate (generazione, validazione e i loro retry) stanno
+    entro un'unica scadenza: il timeout di ogni tentativo si riduce al tempo rimasto e un retry
+    che la supererebbe non parte."""
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url=None, model=None, timeout=30, max_retries=2, backoff=0.5, api_key=None):
+        self.base_url = (base_url or os.environ.get("GROQ_BASE_URL", "https://api.groq.com/openai/v1")).rstrip("/")
+        self.model = model or os.environ.get("GROQ_MODEL", "llama-3.3-70b-versatile")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._api_key = api_key
+        self._client = None
+        self._aclient = None
+        self._aclient_loop = None
+        self._lock = threading.Lock()
+        self._scadenza = contextvars.ContextVar("scadenza_llm", default=None)
+
+    @contextlib.contextmanager
+    def scadenza(self, secondi):
+        """Scadenza (time.monotonic) per le chiamate fatte in questo contesto; vale la più vicina"""
+        attuale = self._scadenza.get()
+        nuova = time.monotonic() + secondi if secondi else None
+        if attuale is not None and (nuova is None or attuale < nuova):
+            nuova = attuale
+        token = self._scadenza.set(nuova)
+        try:
+            yield
+        finally:
+            try:
+                self._scadenza.reset(token)
+            except ValueError:
+                # Generatore (stream_query) chiuso in un altro contesto
+                self._scadenza.set(attuale)
+
+    def _timeout(self, timeout=None):
+        """Timeout di un tentativo: mai oltre la scadenza della richiesta"""
+        timeout = timeout or self.timeout
+        scadenza = self._scadenza.get()
+        if scadenza is None:
+            return timeout
+        rimasto = scadenza - time.monotonic()
+        if rimasto <= 0:
+            raise LLMError("Tempo della richiesta esaurito")
+        return min(timeout, rimasto)
+
+    def _pausa(self, tentativo, response=None):
+        """Attesa prima di un nuovo tentativo; LLMError se il tentativo partirebbe dopo la scadenza"""
+        attesa = self._attesa(tentativo, response)
+        scadenza = self._scadenza.get()
+        if scadenza is not None and time.monotonic() + attesa >= scadenza:
+            raise LLMError("Tempo della richiesta esaurito",
+                           response.status_code if response is not None else None)
+        return attesa
+
+    @property
+    def api_key(self):
+        return self._api_key or os.environ.get("GROQ_API_KEY")
+
+    @property
+    def client(self):
+        # Un solo pool di connessioni per processo: niente handshake TCP+TLS a ogni domanda
+        if self._client is None:
+            import httpx
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(
+                        base_url=self.base_url,
+                        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                        timeout=self.timeout
+                    )
+        return self._client
+
+    @property
+    def aclient(self):
+        """Client asincrono condiviso, legato all'event loop in cui è stato creato.
+
+        Se cambia il loop il client precedente viene chiuso: nel suo loop se è ancora attivo
+        (in un altro thread), altrimenti qui, ignorando gli errori delle connessioni rimaste
+        legate al loop chiuso."""
+        import asyncio
+        import httpx
+        loop = asyncio.get_running_loop()
+        if self._aclient is not None and self._aclient_loop is loop:
+            return self._aclient
+        with self._lock:
+            if self._aclient is None or self._aclient_loop is not loop:
+                vecchio, vecchio_loop = self._aclient, self._aclient_loop
+                self._aclient = httpx.AsyncClient(
+                    base_url=self.base_url,
+                    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                    timeout=self.timeout
+                )
+                self._aclient_loop = loop
+                if vecchio is not None:
+                    if vecchio_loop.is_running():
+                        asyncio.run_coroutine_threadsafe(self._chiudi(vecchio), vecchio_loop)
+                    else:
+                        loop.create_task(self._chiudi(vecchio))
+            return self._aclient
+
+    @staticmethod
+    async def _chiudi(client):
+        # Le connessioni legate a un loop già chiuso non si possono chiudere in modo ordinato
+        with contextlib.suppress(RuntimeError):
+            await client.aclose()
+
+    def reset(self):
+        """Dimentica i client ereditati (dopo un fork le connessioni non vanno condivise)"""
+        self._client = None
+        self._aclient = None
+        self._aclient_loop = None
+
+    async def achiudi(self):
+        """Chiude il client asincrono; da chiamare prima di chiudere l'event loop"""
+        if self._aclient is not None:
+            await self._chiudi(self._aclient)
+        self._aclient = None
+        self._aclient_loop = None
+
+    def _headers(self):
+        return {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json'
+        }
+
+    def _payload(self, messages, stream=False, **params):
+        payload = {"model": self.model, "messages": messages}
+        payload.update(params)
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def _attesa(self, tentativo, response=None):
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after and retry_after.replace(".", "", 1).isdigit():
+            # Mai oltre il timeout: un Retry-After enorme bloccherebbe la richiesta dell'utente
+            return min(float(retry_after), self.timeout)
+        return self.backoff * (2 ** tentativo)
+
+    def chat(self, messages, timeout=None, **params):
+        """Risposta completa del modello; ritenta con backoff su 429/5xx ed errori di rete"""
+        import httpx
+        payload = self._payload(messages, **params)
+        for tentativo in range(self.max_retries + 1):
+            try:
+                response = self.client.post(
+                    "/chat/completions",
+                    headers=self._headers(),
+                    json=payload,
+                    timeout=self._timeout(timeout)
+                )
+            except httpx.TransportError as e:
+                if tentativo == self.max_retries:
+                    raise LLMError(f"Errore di rete: {e}")
+                time.sleep(self._pausa(tentativo))
+                continue
+            if response.status_code == 200:
+                return response.json()['choices'][0]['message']['content'].strip()
+            if response.status_code in self.RETRY_STATUS and tentativo < self.max_retries:
+                time.sleep(self._pausa(tentativo, response))
+                continue
+            raise LLMError(f"Errore API Groq: {response.status_code}", response.status_code)
+
+    @staticmethod
+    def _delta(riga):
+        """Estrae il testo da una riga SSE dello stream chat-completions"""
+        if not riga or not riga.startswith("data:"):
+            return None
+        dati = riga[5:].strip()
+        if dati == "[DONE]":
+            return None
+        scelte = json.loads(dati).get("choices") or [{}]
+        return scelte[0].get("delta", {}).get("content")
+
+    def stream_chat(self, messages, timeout=None, **params):
+        """Generatore dei token man mano che arrivano (i retry valgono solo prima del primo token)"""
+        import httpx
+        payload = self._payload(messages, stream=True, **params)
+        emesso = False
+        for tentativo in range(self.max_retries + 1):
+            try:
+                with self.client.stream(
+                    "POST", "/chat/completions",
+                    headers=self._headers(),
+                    json=payload,
+                    timeout=self._timeout(timeout)
+                ) as response:
+                    if response.status_code != 200:
+                        response.read()
+                        if response.status_code in self.RETRY_STATUS and tentativo < self.max_retries:
+                            time.sleep(self._pausa(tentativo, response))
+                            continue
+                        raise LLMError(f"Errore API Groq: {response.status_code}", response.status_code)
+                    for riga in response.iter_lines():
+                        testo = self._delta(riga)
+                        if testo:
+                            emesso = True
+                            yield testo
+                    return
+            except httpx.TransportError as e:
+                # Dopo il primo token un nuovo tentativo ripeterebbe il testo già inviato
+                if emesso:
+                    raise LLMError(f"Stream interrotto: {e}")
+                if tentativo == self.max_retries:
+                    raise LLMError(f"Errore di rete: {e}")
+                time.sleep(self._pausa(tentativo))
+
+    async def achat(self, messages, timeout=None, **params):
+        """Versione asincrona di chat(), per chiamanti asyncio"""
+        import asyncio
+        import httpx
+        payload = self._payload(messages, **params)
+        for tentativo in range(self.max_retries + 1):
+            try:
+                response = await self.aclient.post(
+                    "/chat/completions",
+                    headers=self._headers(),
+                    json=payload,
+                    timeout=self._timeout(timeout)
+                )
+            except httpx.TransportError as e:
+                if tentativo == self.max_retries:
+                    raise LLMError(f"Errore di rete: {e}")
+                await asyncio.sleep(self._pausa(tentativo))
+                continue
+            if response.status_code == 200:
+                return response.json()['choices'][0]['message']['content'].strip()
+            if response.status_code in self.RETRY_STATUS and tentativo < self.max_retries:
+                await asyncio.sleep(self._pausa(tentativo, response))
+                continue
+            raise LLMError(f"Errore API Groq: {response.status_code}", response.status_code)
+
+    async def astream_chat(self, messages, timeout=None, **params):
+        """Versione asincrona di stream_chat()"""
+        payload = self._payload(messages, stream=True, **params)
+        async with self.aclient.stream(
+            "POST", "/chat/completions",
+            headers=self._headers(),
+            json=payload,
+            timeout=self._timeout(timeout)
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise LLMError(f"Errore API Groq: {response.status_code}", response.status_code)
+            async for riga in response.aiter_lines():
+                testo = self._delta(riga)
+                if testo:
+                    yield testo
+
+
+class GroundingValidator:
+    """Validazione locale: la risposta deve essere ancorata al testo del contesto (overlap di n-grammi)"""
+
+    nome = "grounding"
+
+    FRASI_RIFIUTO = (
+        "non trovo informazioni",
+        "non ho trovato informazioni",
+        "la domanda è troppo generica",
+    )
+
+    # Parole con cui il modello introduce le citazioni: non vanno cercate nel contesto
+    PAROLE_CORNICE = {"secondo", "documento", "documenti", "indicato", "indica", "riporta", "citazione"}
+
+    # Recapiti citati: finiscono sempre su un carattere alfanumerico, mai sul punto che chiude la frase
+    EMAIL = r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"
+    TELEFONO = r"\d(?:[ /.-]?\d){5,}"
+
+    def __init__(self, n=3, soglia_frase=0.5, soglia_parole=0.8, soglia_risposta=0.6):
+        self.n = n
+        self.soglia_frase = soglia_frase
+        self.soglia_parole = soglia_parole
+        self.soglia_risposta = soglia_risposta
+
+    @staticmethod
+    def _parole(testo):
+        return re.findall(r"\w+", testo.lower())
+
+    def _ngrammi(self, parole):
+        return {tuple(parole[i:i + self.n]) for i in range(len(parole) - self.n + 1)}
+
+    def valida(self, risposta, domanda, contesto, confidence=None):
+        testo = risposta.lower()
+        if any(frase in testo for frase in self.FRASI_RIFIUTO):
+            return True
+
+        # Recapiti e numeri citati devono comparire letteralmente nel contesto
+        contesto_compatto = re.sub(r"\s+", "", contesto.lower())
+        for dato in re.findall(f"{self.EMAIL}|{self.TELEFONO}", testo):
+            if re.sub(r"\s+", "", dato) not in contesto_compatto:
+                return False
+
+        parole_contesto = self._parole(contesto)
+        ngrammi_contesto = self._ngrammi(parole_contesto)
+        set_contesto = set(parole_contesto)
+
+        frasi = [f for f in re.split(r"(?<=[.!?])\s+|\n+", risposta) if f.strip()]
+        valutate = 0
+        ancorate = 0
+        for frase in frasi:
+            parole = self._parole(frase)
+            if len(parole) < 3:
+                continue
+            valutate += 1
+            # Citazione quasi letterale (n-grammi) oppure parole di contenuto tutte presenti
+            ngrammi = self._ngrammi(parole)
+            overlap_ngrammi = len(ngrammi & ngrammi_contesto) / len(ngrammi) if ngrammi else 0
+            contenuto = [p for p in parole if len(p) > 3 and p not in self.PAROLE_CORNICE]
+            overlap_parole = (
+                sum(1 for p in contenuto if p in set_contesto) / len(contenuto) if contenuto else 1
+            )
+            if overlap_ngrammi >= self.soglia_frase or overlap_parole >= self.soglia_parole:
+                ancorate += 1
+
+        if not valutate:
+            return True
+        return ancorate / valutate >= self.soglia_risposta
+
+
+class LLMValidator:
+    """Validazione remota con una seconda chiamata al modello"""
+
+    nome = "llm"
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def valida(self, risposta, domanda, contesto, confidence=None):
+        return self.bot.validate_response_enhanced(risposta, domanda, contesto)
+
+
+class ValidationPipeline:
+    """Esegue le strategie di validazione e ne misura latenza e tasso di scarto.
+
+    Modalità (VALIDATION_MODE):
+    - "local": solo controllo di grounding locale
+    - "llm": solo validatore remoto (comportamento storico)
+    - "auto": grounding locale; il validatore remoto solo se la confidenza è sotto soglia
+
+    valida() restituisce True, False oppure None se una strategia non ha potuto rispondere
+    (timeout, 429, 5xx del validatore remoto): la risposta va trattata come non validata, ma
+    l'esito non dice nulla sulla risposta e non va messo in cache.
+    """
+
+    def __init__(self, strategie, modo="auto", soglia_confidenza=0.6):
+        self.strategie = {s.nome: s for s in strategie}
+        self.modo = modo
+        self.soglia_confidenza = soglia_confidenza
+        self._lock = threading.Lock()
+        self.metriche = {
+            nome: {"chiamate": 0, "scartate": 0, "errori": 0, "tempo_totale_ms": 0.0, "tempo_max_ms": 0.0}
+            for nome in self.strategie
+        }
+
+    def _esegui(self, nome, risposta, domanda, contesto, confidence):
+        inizio = time.perf_counter()
+        try:
+            valida = self.strategie[nome].valida(risposta, domanda, contesto, confidence)
+        except Exception as e:
+            print(f"⚠️ Validazione {nome} non riuscita: {e}")
+            valida = None
+        durata = (time.perf_counter() - inizio) * 1000
+        with self._lock:
+            m = self.metriche[nome]
+            m["chiamate"] += 1
+            if valida is None:
+                m["errori"] += 1
+            else:
+                m["scartate"] += 0 if valida else 1
+            m["tempo_totale_ms"] += durata
+            m["tempo_max_ms"] = max(m["tempo_max_ms"], durata)
+        return valida
+
+    def valida(self, risposta, domanda, contesto, confidence=1.0):
+        if self.modo == "llm":
+            return self._esegui("llm", risposta, domanda, contesto, confidence)
+        if not self._esegui("grounding", risposta, domanda, contesto, confidence):
+            return False
+        if self.modo == "auto" and confidence < self.soglia_confidenza:
+            return self._esegui("llm", risposta, domanda, contesto, confidence)
+        return True
+
+    def stats(self):
+        with self._lock:
+            out = {"modo": self.modo, "soglia_confidenza": self.soglia_confidenza, "strategie": {}}
+            for nome, m in self.metriche.items():
+                out["strategie"][nome] = {
+                    "chiamate": m["chiamate"],
+                    "reject_rate": round(m["scartate"] / m["chiamate"], 3) if m["chiamate"] else 0.0,
+                    "errori": m["errori"],
+                    "latenza_media_ms": round(m["tempo_totale_ms"] / m["chiamate"], 2) if m["chiamate"] else 0.0,
+                    "latenza_max_ms": round(m["tempo_max_ms"], 2)
+                }
+            return out
+
+
+class TemplatePrompt:
+    """Template analizzato una sola volta: a ogni richiesta si concatenano solo le parti"""
+
+    def __init__(self, testo):
+        # (testo letterale, nome del campo che lo segue o None)
+        self.parti = [(letterale, campo) for letterale, campo, _, _ in string.Formatter().parse(testo)]
+        self.campi = {campo for _, campo in self.parti if campo}
+
+    def render(self, **valori):
+        return "".join(letterale + (valori[campo] if campo else "") for letterale, campo in self.parti)
+
+
+class CostruttoreContesto:
+    """Contesto del prompt entro un budget di token stimato localmente.
+
+    I chunk (nell'ordine della ricerca) sono tenuti se il loro punteggio (pertinenza) non scende
+    sotto soglia_relativa volte il migliore; i quasi-duplicati si scartano, le righe già incluse da
+    un chunk precedente (overlap tra finestre) non si ripetono e ogni chunk è ridotto alle frasi
+    pertinenti alla domanda, con la prima riga (di solito l'intestazione) e le frasi adiacenti."""
+
+    SEPARATORE = "\n\n--- DOCUMENTO ---\n\n"
+    FRASI = re.compile(r"(?<=[.!?])\s+|\n")
+    PAROLE_VUOTE = {
+        "il", "lo", "la", "gli", "le", "un", "una", "uno", "di", "da", "del", "della", "dei", "delle",
+        "che", "per", "con", "come", "cosa", "chi", "non", "sono", "nel", "nella", "alla", "allo",
+        "agli", "quale", "quali", "qual", "quando", "dove", "mio", "mia", "suo", "sua", "questo", "questa",
+        "dell", "nell", "dall", "sull", "all"
+    }
+    TOKEN_MINIMI = 40   # sotto questa disponibilità non si tronca un altro chunk per farlo entrare
+
+    def __init__(self, budget_token=500, max_chunks=4, soglia_relativa=0.6, soglia_duplicati=0.8, riduci=True):
+        self.budget_token = budget_token
+        self.max_chunks = max_chunks
+        self.soglia_relativa = soglia_relativa
+        self.soglia_duplicati = soglia_duplicati
+        self.riduci = riduci
+        self.contesti = 0
+        self.token_totali = 0
+        self.caratteri_originali = 0
+        self.caratteri_usati = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def pertinenza(doc):
+        """Punteggio del cross-encoder se il documento è stato riordinato, altrimenti 1 - distanza"""
+        return doc['pertinenza'] if 'pertinenza' in doc else max(0.0, 1 - doc['distance'])
+
+    @staticmethod
+    def stima_token(testo):
+        """Stima per tokenizer BPE: un token per parola o segno, uno in più ogni 6 caratteri di parola"""
+        return sum(1 + (len(pezzo) - 1) // 6 for pezzo in re.findall(r"\w+|[^\w\s]", testo))
+
+    def _radici(self, testo):
+        # Prime 5 lettere: "prenotare" e "prenotazione" coincidono
+        return {parola[:5] for parola in re.findall(r"\w+", testo.lower())
+                if len(parola) > 2 and parola not in self.PAROLE_VUOTE}
+
+    def _frasi_pertinenti(self, testo, radici_domanda):
+        frasi = [frase.strip() for frase in self.FRASI.split(testo) if frase.strip()]
+        if len(frasi) <= 3 or not radici_domanda:
+            return frasi
+        tenute = {0}
+        for i, frase in enumerate(frasi):
+            if self._radici(frase) & radici_domanda:
+                tenute.update((i - 1, i, i + 1))
+        if tenute == {0}:
+            # Nessuna frase in comune con la domanda: il chunk è pertinente solo per similarità
+            return frasi
+        return [frase for i, frase in enumerate(frasi) if i in tenute]
+
+    def _tronca(self, frasi, disponibili):
+        tenute = []
+        for frase in frasi:
+            token = self.stima_token(frase)
+            if token > disponibili:
+                if not tenute:
+                    # Nemmeno la prima frase entra: se ne tengono le prime parole
+                    parole = []
+                    for parola in frase.split():
+                        disponibili -= self.stima_token(parola)
+                        if disponibili < 0:
+                            break
+                        parole.append(parola)
+                    if parole:
+                        tenute.append(" ".join(parole))
+                break
+            tenute.append(frase)
+            disponibili -= token
+        return tenute
+
+    def costruisci(self, domanda, docs):
+        """(contesto, documenti usati, token stimati)"""
+        candidati = docs[:self.max_chunks]
+        if not candidati:
+            return "", [], 0
+        punteggi = [self.pertinenza(doc) for doc in candidati]
+        minimo = self.soglia_relativa * max(punteggi)
+        radici = self._radici(domanda)
+        token_separatore = self.stima_token(self.SEPARATORE)
+
+        usati, testi, firme, righe_viste = [], [], [], set()
+        token_usati = 0
+        for doc, punteggio in zip(candidati, punteggi):
+            if usati and punteggio < minimo:
+                continue
+            firma = frozenset(re.findall(r"\w+", doc['content'].lower()))
+            if any(len(firma & f) / (len(firma | f) or 1) >= self.soglia_duplicati for f in firme):
+                continue
+            frasi = self._frasi_pertinenti(doc['content'], radici) if self.riduci else [doc['content']]
+            frasi = [frase for frase in frasi if frase not in righe_viste]
+            if not frasi:
+                continue
+            disponibili = self.budget_token - token_usati - (token_separatore if usati else 0)
+            token = sum(self.stima_token(frase) for frase in frasi)
+            if token > disponibili:
+                if usati and disponibili < self.TOKEN_MINIMI:
+                    break
+                frasi = self._tronca(frasi, disponibili)
+                if not frasi:
+                    break
+                token = sum(self.stima_token(frase) for frase in frasi)
+            firme.append(firma)
+            righe_viste.update(frasi)
+            usati.append(doc)
+            testi.append("\n".join(frasi))
+            token_usati += token + (token_separatore if len(usati) > 1 else 0)
+
+        contesto = self.SEPARATORE.join(testi)
+        with self._lock:
+            self.contesti += 1
+            self.token_totali += token_usati
+            self.caratteri_originali += sum(len(doc['content']) for doc in candidati)
+            self.caratteri_usati += len(contesto)
+        return contesto, usati, token_usati
+
+    def stats(self):
+        with self._lock:
+            return {
+                "contesti": self.contesti,
+                "budget_token": self.budget_token,
+                "token_medi": round(self.token_totali / self.contesti, 1) if self.contesti else 0.0,
+                "caratteri_originali": self.caratteri_originali,
+                "caratteri_usati": self.caratteri_usati
+            }
+
+
+class IndicePersistente:
+    """Base per gli indici costruiti in fase di caricamento e salvati in JSON accanto alla collection"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+
+    def _esporta(self):
+        raise NotImplementedError
+
+    def _importa(self, dati):
+        raise NotImplementedError
+
+    def carica(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                dati = json.load(f)
+            with self._lock:
+                self._importa(dati)
+                self._mtime = os.path.getmtime(self.path)
+        except Exception as e:
+            print(f"Errore nel caricamento indice {self.path}: {e}")
+
+    def salva(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temporaneo = f"{self.path}.{os.getpid()}.tmp"
+        with self._lock:
+            with open(temporaneo, 'w', encoding='utf-8') as f:
+                json.dump(self._esporta(), f, ensure_ascii=False)
+            os.replace(temporaneo, self.path)
+            self._mtime = os.path.getmtime(self.path)
+
+    def copia(self, path):
+        """Copia indipendente (riletta dal disco) che verrà salvata in path"""
+        copia = type(self)(path=self.path)
+        copia.path = path
+        copia._mtime = None
+        return copia
+
+    def _ricarica_se_modificato(self):
+        # Un altro worker può aver reindicizzato: si ricarica solo se il file è cambiato
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.carica()
+
+
+class BM25Index(IndicePersistente):
+    """Indice lessicale BM25 sui chunk, persistito su disco accanto alla collection.
+
+    Contiene solo le statistiche dei token (postings e lunghezze) per ID: testo e metadati
+    dei chunk restano nella collection. Gli ID dipendono dal contenuto, quindi un ID già
+    indicizzato non va ricalcolato."""
+
+    STOPWORDS = {
+        "il", "lo", "la", "i", "gli", "le", "un", "uno", "una", "di", "a", "da", "in", "con", "su",
+        "per", "tra", "fra", "e", "o", "ed", "che", "chi", "cui", "non", "si", "come", "dove", "quando",
+        "del", "dello", "della", "dei", "degli", "delle", "al", "allo", "alla", "ai", "agli", "alle",
+        "dal", "dallo", "dalla", "dai", "dagli", "dalle", "nel", "nello", "nella", "nei", "negli",
+        "nelle", "sul", "sullo", "sulla", "sui", "sugli", "sulle", "è", "sono", "mi", "ti", "ci", "vi",
+        "ne", "qual", "quale", "quali", "cosa", "mio", "mia", "suo", "sua", "posso", "devo", "fare",
+        # forme elise: dell'utente, all'applicativo, l'accesso
+        "l", "dell", "all", "dall", "nell", "sull", "un", "c", "d"
+    }
+
+    def __init__(self, path="db/bm25_index.json", k1=1.5, b=0.75):
+        super().__init__(path)
+        self.k1 = k1
+        self.b = b
+        self.lunghezze = {}   # id -> numero di token
+        self.postings = {}    # termine -> {id: tf}
+        self.lunghezza_totale = 0
+        self.carica()
+
+    @classmethod
+    def tokenizza(cls, testo):
+        """Tokenizzazione per l'italiano: email e numeri interi, elisioni, stopword, stemming leggero"""
+        testo = testo.lower()
+        tokens = re.findall(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+", testo)
+        for parola in re.findall(r"\w+", testo):
+            if parola in cls.STOPWORDS:
+                continue
+            # referente/referenti, applicativo/applicativi -> stessa radice
+            if len(parola) > 4 and not parola.isdigit() and parola[-1] in "aeiou":
+                parola = parola[:-1]
+            tokens.append(parola)
+        return tokens
+
+    def _esporta(self):
+        return {"lunghezze": self.lunghezze, "postings": self.postings}
+
+    def _importa(self, dati):
+        if "docs" in dati:
+            # Formato precedente, con testo e metadati dei chunk
+            dati = {"lunghezze": {i: d["len"] for i, d in dati["docs"].items()}, "postings": dati["postings"]}
+        self.lunghezze = dati["lunghezze"]
+        self.postings = dati["postings"]
+        self.lunghezza_totale = sum(self.lunghezze.values())
+
+    def upsert(self, ids, documents):
+        """Indicizza i chunk non ancora presenti (un ID già presente ha lo stesso testo)"""
+        with self._lock:
+            for chunk_id, testo in zip(ids, documents):
+                if chunk_id not in self.lunghezze:
+                    self._aggiungi(chunk_id, testo)
+
+    def rimuovi(self, ids, documents=None):
+        """Toglie i chunk dall'indice; col loro testo si visitano solo i postings dei loro token"""
+        with self._lock:
+            if documents is None:
+                rimossi = {chunk_id for chunk_id in ids if chunk_id in self.lunghezze}
+                token_rimossi = [token for token, posting in self.postings.items() if rimossi & posting.keys()]
+                for chunk_id in rimossi:
+                    self._rimuovi(chunk_id, token_rimossi)
+            else:
+                for chunk_id, testo in zip(ids, documents):
+                    self._rimuovi(chunk_id, set(self.tokenizza(testo)))
+
+    def ricostruisci(self, ids, documents):
+        with self._lock:
+            self.lunghezze = {}
+            self.postings = {}
+            self.lunghezza_totale = 0
+            for chunk_id, testo in zip(ids, documents):
+                self._aggiungi(chunk_id, testo)
+
+    def _aggiungi(self, chunk_id, testo):
+        tokens = self.tokenizza(testo)
+        self.lunghezze[chunk_id] = len(tokens)
+        self.lunghezza_totale += len(tokens)
+        for token in tokens:
+            posting = self.postings.setdefault(token, {})
+            posting[chunk_id] = posting.get(chunk_id, 0) + 1
+
+    def _rimuovi(self, chunk_id, tokens):
+        lunghezza = self.lunghezze.pop(chunk_id, None)
+        if lunghezza is None:
+            return
+        self.lunghezza_totale -= lunghezza
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is not None and posting.pop(chunk_id, None) is not None and not posting:
+                del self.postings[token]
+
+    def __len__(self):
+        return len(self.lunghezze)
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self.lunghezze
+
+    def search(self, query, k=8):
+        """Restituisce [(id, score)] ordinati per punteggio BM25"""
+        self._ricarica_se_modificato()
+        with self._lock:
+            n = len(self.lunghezze)
+            if not n:
+                return []
+            lunghezza_media = self.lunghezza_totale / n
+            punteggi = {}
+            for token in set(self.tokenizza(query)):
+                posting = self.postings.get(token)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                for chunk_id, tf in posting.items():
+                    norma = self.k1 * (1 - self.b + self.b * self.lunghezze[chunk_id] / lunghezza_media)
+                    punteggi[chunk_id] = punteggi.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norma)
+        return sorted(punteggi.items(), key=lambda x: -x[1])[:k]
+
+    def contenenti_tutti(self, query):
+        """ID dei chunk che contengono tutti i termini della query"""
+        tokens = set(self.tokenizza(query))
+        with self._lock:
+            posting_lists = [self.postings.get(token, {}) for token in tokens]
+        if not posting_lists:
+            return set()
+        posting_lists.sort(key=len)
+        risultato = set(posting_lists[0])
+        for posting in posting_lists[1:]:
+            risultato &= posting.keys()
+        return risultato
+
+
+class IndiceSezioni(IndicePersistente):
+    """Indice strutturato del catalogo: sezione -> applicativo -> campo -> testo"""
+
+    HEADER = re.compile(r"^(\d+)\s+([A-Z].*?)\s*$")
+    CAMPO = re.compile(r"^([A-Z][^:]{1,60}):\s*(.*?)\s*$")
+    EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+    SALTO_MAX = 5
+    TELEFONO = re.compile(r"(?<![\d/])(?:\+39\s?)?\d{2,4}[\s/.-]?\d{5,8}(?![\d/])")
+
+    INTENTI = {
+        'referente': re.compile(r"\b(referent\w*|responsabil\w*)"),
+        # Solo richieste esplicite: "numero" o "indirizzo" da soli ("quanti numeri di scenario",
+        # "indirizzo della sede") non chiedono un contatto e devono passare al retrieval
+        'telefono': re.compile(r"\b(telefon\w*|cellular\w*|tel)\b"),
+        'email': re.compile(r"\b(e-?mail|mail|posta elettronica|pec)\b"),
+    }
+
+    def __init__(self, path="db/sezioni_index.json"):
+        super().__init__(path)
+        self.sources = {}   # source -> {numero: {"nome", "campi": {campo: [testo]}, "testo"}}
+        self.alias = {}     # nome normalizzato -> [[source, numero]]
+        self.nomi = {}      # nome completo normalizzato -> [[source, numero]]
+        self.carica()
+
+    def _esporta(self):
+        return {"sources": self.sources}
+
+    def _importa(self, dati):
+        self.sources = dati["sources"]
+        self._ricostruisci_alias()
+
+    @staticmethod
+    def normalizza(testo):
+        return " ".join(re.findall(r"\w+", testo.lower()))
+
+    @classmethod
+    def analizza(cls, testo):
+        """Estrae le sezioni numerate ("1 AOUS- Pleiade", "2 AURORA", ...) con i loro campi"""
+        sezioni = {}
+        corrente = None
+        ultimo_numero = 0
+        campo = None
+        for riga in testo.splitlines():
+            header = cls.HEADER.match(riga)
+            # I numeri di sezione crescono di poco: evita falsi header ("112 Were Are U...")
+            if header and ultimo_numero < int(header.group(1)) <= ultimo_numero + cls.SALTO_MAX:
+                ultimo_numero = int(header.group(1))
+                corrente = {"nome": header.group(2), "campi": {}, "righe": []}
+                sezioni[header.group(1)] = corrente
+                campo = None
+                continue
+            if corrente is None or not riga.strip():
+                continue
+            corrente["righe"].append(riga.strip())
+            match = cls.CAMPO.match(riga.strip())
+            if match and not match.group(2):
+                # Intestazione di blocco ("Referenti:", "Contatti:"): raccoglie le righe seguenti
+                campo = match.group(1).strip().lower()
+                corrente["campi"].setdefault(campo, []).append("")
+            elif match:
+                nome_campo = match.group(1).strip().lower()
+                corrente["campi"].setdefault(nome_campo, []).append(match.group(2))
+                if campo is not None:
+                    corrente["campi"][campo][-1] += riga.strip() + "\n"
+            elif campo is not None:
+                corrente["campi"][campo][-1] += riga.strip() + "\n"
+        for sezione in sezioni.values():
+            sezione["testo"] = "\n".join(sezione.pop("righe"))
+            sezione["campi"] = {k: [v.strip() for v in valori] for k, valori in sezione["campi"].items()}
+        return sezioni
+
+    def aggiorna_source(self, source, testo):
+        return self.imposta_source(source, self.analizza(testo))
+
+    def imposta_source(self, source, sezioni):
+        with self._lock:
+            if sezioni:
+                self.sources[source] = sezioni
+            else:
+                self.sources.pop(source, None)
+            self._ricostruisci_alias()
+        return len(sezioni)
+
+    def _ricostruisci_alias(self):
+        alias = {}
+        nomi = {}
+        for source, sezioni in self.sources.items():
+            for numero, sezione in sezioni.items():
+                nome = self.normalizza(re.sub(r"\(.*?\)", " ", sezione["nome"]))
+                # Nome completo con e senza la parte tra parentesi: "ELIOT(AREZZO)" -> "eliot arezzo", "eliot"
+                for completo in {nome, self.normalizza(sezione["nome"])}:
+                    if completo:
+                        nomi.setdefault(completo, []).append([source, numero])
+                varianti = {self.normalizza(parte) for parte in re.sub(r"\(.*?\)", " ", sezione["nome"]).split("-")}
+                varianti.add(nome)
+                for variante in varianti:
+                    if len(variante) >= 3:
+                        alias.setdefault(variante, []).append([source, numero])
+        self.alias = alias
+        self.nomi = nomi
+
+    @staticmethod
+    def _cerca(parole, nomi, lunghezza_max=None):
+        """Sezioni del nome più lungo presente in parole: None se nessuno, un insieme (anche di più
+        sezioni, se il nome è ambiguo) altrimenti"""
+        lunghezza = len(parole) if lunghezza_max is None else min(lunghezza_max, len(parole))
+        for n in range(lunghezza, 0, -1):
+            candidati = set()
+            for i in range(len(parole) - n + 1):
+                candidati.update(tuple(c) for c in nomi.get(" ".join(parole[i:i + n])) or [])
+            if candidati:
+                return candidati
+        return None
+
+    def trova_sezione(self, domanda):
+        """Sezione citata nella domanda, se identifica un solo applicativo.
+
+        Prima si cerca il nome completo più lungo di una sezione ("AURORA" è il nome esatto della
+        sezione 2, anche se compare in "AURORA- problema stampa etichette"), senza limiti di lunghezza; in mancanza,
+        la parte di nome più lunga. Se il nome trovato corrisponde a più sezioni ("AOUS": tutte
+        le sezioni "AOUS- ...") restituisce None, così la domanda passa al retrieval che può
+        citarle tutte."""
+        self._ricarica_se_modificato()
+        parole = self.normalizza(domanda).split()
+        with self._lock:
+            candidati = self._cerca(parole, self.nomi) or self._cerca(parole, self.alias, lunghezza_max=6)
+            if not candidati or len(candidati) > 1:
+                return None
+            source, numero = candidati.pop()
+            return source, numero, self.sources[source][numero]
+
+    def intento(self, domanda):
+        testo = domanda.lower()
+        for nome, pattern in self.INTENTI.items():
+            if pattern.search(testo):
+                return nome
+        return None
+
+    def rispondi(self, domanda):
+        """Risposta diretta dall'indice per referenti, telefoni ed email (None se non applicabile)"""
+        intento = self.intento(domanda)
+        if intento is None:
+            return None
+        trovata = self.trova_sezione(domanda)
+        if trovata is None:
+            return None
+        source, numero, sezione = trovata
+
+        if intento == 'referente':
+            # Blocco "Referenti:" più le righe "Referente XYZ: nome" sparse nella sezione
+            righe = []
+            for campo in ("referenti", "referente"):
+                for valore in sezione["campi"].get(campo, []):
+                    righe.extend(valore.splitlines())
+            for riga in sezione["testo"].splitlines():
+                match = self.CAMPO.match(riga)
+                if match and "referent" in match.group(1).lower() and match.group(2):
+                    righe.append(riga)
+        else:
+            pattern = self.TELEFONO if intento == 'telefono' else self.EMAIL
+            righe = [riga for riga in sezione["testo"].splitlines() if pattern.search(riga)]
+        righe = list(dict.fromkeys(r for r in righe if r.strip()))
+        if not righe:
+            return None
+        return source, numero, sezione, righe
+
+
+class CatalogoStatistiche(IndicePersistente):
+    """Statistiche per source mantenute dai caricamenti: /stats non scorre mai la collection"""
+
+    def __init__(self, path="db/catalogo.json"):
+        super().__init__(path)
+        self.sources = {}          # source -> {"chunks", "caratteri", "ultimo_caricamento"}
+        self.dimensione_db = 0     # byte occupati dalla cartella db/ all'ultima pubblicazione
+        self.carica()
+
+    def _esporta(self):
+        return {"sources": self.sources, "dimensione_db": self.dimensione_db}
+
+    def _importa(self, dati):
+        self.sources = dati["sources"]
+        self.dimensione_db = dati.get("dimensione_db", 0)
+
+    def aggiorna_source(self, source, chunks, caratteri):
+        with self._lock:
+            if chunks:
+                self.sources[source] = {
+                    "chunks": chunks,
+                    "caratteri": caratteri,
+                    "ultimo_caricamento": datetime.now().isoformat()
+                }
+            else:
+                self.sources.pop(source, None)
+
+    def ricostruisci(self, metadatas):
+        """Catalogo iniziale dai metadati dei chunk della collection"""
+        with self._lock:
+            self.sources = {}
+            for metadata in metadatas:
+                source = (metadata or {}).get("source")
+                if not source:
+                    continue
+                voce = self.sources.setdefault(source, {"chunks": 0, "caratteri": 0, "ultimo_caricamento": ""})
+                voce["chunks"] += 1
+                voce["caratteri"] += metadata.get("chunk_length", 0)
+                voce["ultimo_caricamento"] = max(voce["ultimo_caricamento"], metadata.get("upload_date", ""))
+
+    def misura_db(self, cartella):
+        self.dimensione_db = sum(
+            os.path.getsize(os.path.join(radice, nome))
+            for radice, _, nomi in os.walk(cartella) for nome in nomi
+        )
+
+    def riepilogo(self):
+        self._ricarica_se_modificato()
+        with self._lock:
+            sources = dict(self.sources)
+        return {
+            "chunks": sum(voce["chunks"] for voce in sources.values()),
+            "caratteri": sum(voce["caratteri"] for voce in sources.values()),
+            "file": len(sources),
+            "ultimo_caricamento": max((voce["ultimo_caricamento"] for voce in sources.values()), default=None),
+            "dimensione_db": self.dimensione_db,
+            "sources": sources
+        }
+
+
+class EmbeddingBackend:
+    """Embedding MiniLM (ONNX) con batch vettorizzati, padding dinamico e cache su disco.
+
+    Stesso modello e stessi vettori dell'embedder di default di Chroma, ma:
+    - i testi sono ordinati per lunghezza e paddati al più lungo del batch (non sempre a 256 token)
+    - numero di thread ONNX e dimensione dei batch configurabili
+    - cache persistente hash del contenuto -> vettore, indipendente dalla collection
+    - onnxruntime, tokenizers e numpy vengono importati solo al primo embedding
+    """
+
+    MODEL_NAME = "all-MiniLM-L6-v2"
+
+    def __init__(self, batch_size=64, threads=None, cache_path="db/embedding_cache.sqlite3"):
+        self.batch_size = batch_size
+        self.threads = threads
+        self.cache_path = cache_path
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.model = None
+        self.tokenizer = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        with self._connetti() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS vettori (hash TEXT, modello TEXT, vettore BLOB, "
+                "PRIMARY KEY (hash, modello))"
+            )
+
+    def _connetti(self):
+        return sqlite3.connect(self.cache_path, timeout=10)
+
+    def _init_model_and_tokenizer(self):
+        with self._lock:
+            if self.model is not None:
+                return
+            import onnxruntime
+            from tokenizers import Tokenizer
+            from chromadb.utils import embedding_functions
+            # Download ed estrazione del modello restano quelli di Chroma
+            originale = embedding_functions.ONNXMiniLM_L6_V2()
+            originale._download_model_if_not_exists()
+            cartella = os.path.join(originale.DOWNLOAD_PATH, originale.EXTRACTED_FOLDER_NAME)
+            tokenizer = Tokenizer.from_file(os.path.join(cartella, "tokenizer.json"))
+            tokenizer.enable_truncation(max_length=256)
+            # Padding dinamico: al testo più lungo del batch
+            tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+            opzioni = onnxruntime.SessionOptions()
+            if self.threads:
+                opzioni.intra_op_num_threads = self.threads
+            self.tokenizer = tokenizer
+            self.model = onnxruntime.InferenceSession(
+                os.path.join(cartella, "model.onnx"),
+                sess_options=opzioni,
+                providers=onnxruntime.get_available_providers()
+            )
+
+    def _forward(self, documents, batch_size=32):
+        import numpy as np
+        # Ordinando per lunghezza i batch contengono testi simili e il padding è minimo
+        ordine = sorted(range(len(documents)), key=lambda i: len(documents[i]))
+        risultato = [None] * len(documents)
+        for start in range(0, len(ordine), batch_size):
+            indici = ordine[start:start + batch_size]
+            encoded = self.tokenizer.encode_batch([documents[i] for i in indici])
+            input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+            last_hidden_state = self.model.run(None, {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "token_type_ids": np.zeros_like(input_ids)
+            })[0]
+            # Mean pooling pesato sull'attention mask, poi normalizzazione L2
+            maschera = attention_mask[:, :, None].astype(np.float32)
+            embeddings = (last_hidden_state * maschera).sum(1) / np.clip(maschera.sum(1), 1e-9, None)
+            norme = np.linalg.norm(embeddings, axis=1)
+            norme[norme == 0] = 1e-12
+            embeddings = (embeddings / norme[:, None]).astype(np.float32)
+            for j, i in enumerate(indici):
+                risultato[i] = embeddings[j]
+        return np.stack(risultato) if risultato else np.zeros((0, 384), dtype=np.float32)
+
+    def _calcola(self, testi):
+        self._init_model_and_tokenizer()
+        return self._forward(testi, batch_size=self.batch_size)
+
+    def embed(self, testi, hashes=None, persistente=True):
+        """Embedding dei testi; con persistente=True usa (e alimenta) la cache su disco"""
+        if not testi:
+            return []
+        if not persistente:
+            return self._calcola(list(testi)).tolist()
+        import numpy as np
+
+        hashes = hashes or [hashlib.sha256(t.encode('utf-8')).hexdigest() for t in testi]
+        trovati = {}
+        with self._connetti() as conn:
+            for start in range(0, len(hashes), 500):
+                blocco = hashes[start:start + 500]
+                righe = conn.execute(
+                    f"SELECT hash, vettore FROM vettori WHERE modello = ? AND hash IN ({','.join('?' * len(blocco))})",
+                    [self.MODEL_NAME] + blocco
+                ).fetchall()
+                trovati.update((h, np.frombuffer(v, dtype=np.float32)) for h, v in righe)
+
+        mancanti = [i for i, h in enumerate(hashes) if h not in trovati]
+        self.cache_hits += len(hashes) - len(mancanti)
+        self.cache_misses += len(mancanti)
+        if mancanti:
+            calcolati = self._calcola([testi[i] for i in mancanti])
+            with self._connetti() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO vettori VALUES (?, ?, ?)",
+                    [(hashes[i], self.MODEL_NAME, calcolati[j].tobytes()) for j, i in enumerate(mancanti)]
+                )
+            for j, i in enumerate(mancanti):
+                trovati[hashes[i]] = calcolati[j]
+        return [trovati[h].tolist() for h in hashes]
+
+    def __call__(self, texts):
+        return self.embed(list(texts))
+
+    def stats(self):
+        totale = self.cache_hits + self.cache_misses
+        with self._connetti() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM vettori").fetchone()[0]
+        return {
+            "modello": self.MODEL_NAME,
+            "batch_size": self.batch_size,
+            "threads": self.threads,
+            "entries": entries,
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "hit_rate": round(self.cache_hits / totale, 3) if totale else 0.0
+        }
+
+
+class RerankerCrossEncoder:
+    """Re-ranking opzionale con un cross-encoder ONNX locale (CPU), es. ms-marco-MiniLM-L-6-v2.
+
+    Le coppie (domanda, chunk) sono valutate in un unico batch; i punteggi restano in cache per
+    (hash della domanda, ID del chunk): gli ID dipendono dal contenuto, quindi un chunk modificato
+    non riusa il vecchio punteggio. Il modello gira in un thread dedicato: se non risponde entro
+    budget_ms si tiene l'ordine della ricerca, e il calcolo in corso alimenta comunque la cache.
+    Al più max_in_coda calcoli tra in corso e in attesa: oltre, la richiesta salta il re-ranking
+    invece di accodare lavoro che arriverebbe comunque fuori budget."""
+
+    def __init__(self, model_path, budget_ms=150, max_length=256, threads=None, cache_size=4096,
+                 max_in_coda=2):
+        self.model_path = model_path
+        self.budget_ms = budget_ms
+        self.max_length = max_length
+        self.threads = threads
+        self.cache_size = cache_size
+        self.max_in_coda = max_in_coda
+        self.model = None
+        self.tokenizer = None
+        self._cache = OrderedDict()
+        self._executor = None
+        self._posti = threading.BoundedSemaphore(max_in_coda)
+        self._lock = threading.Lock()
+        self.riordinamenti = 0
+        self.fuori_budget = 0
+        self.saltati = 0
+        self.errori = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @classmethod
+    def da_ambiente(cls):
+        """None se RERANK_MODEL_PATH non è impostato (cartella con model.onnx e tokenizer.json)"""
+        model_path = os.environ.get("RERANK_MODEL_PATH")
+        if not model_path:
+            return None
+        threads = os.environ.get("RERANK_THREADS")
+        return cls(
+            model_path,
+            budget_ms=float(os.environ.get("RERANK_BUDGET_MS", 150)),
+            max_length=int(os.environ.get("RERANK_MAX_LENGTH", 256)),
+            threads=int(threads) if threads else None,
+            cache_size=int(os.environ.get("RERANK_CACHE_SIZE", 4096)),
+            max_in_coda=int(os.environ.get("RERANK_MAX_IN_CODA", 2))
+        )
+
+    def reset(self):
+        """Dopo un fork: sessione ONNX e thread non sopravvivono, si ricreano al primo uso"""
+        self.model = None
+        self.tokenizer = None
+        self._executor = None
+        self._posti = threading.BoundedSemaphore(self.max_in_coda)
+        self._lock = threading.Lock()
+
+    def _init_model(self):
+        if self.model is not None:
+            return
+        import onnxruntime
+        from tokenizers import Tokenizer
+        tokenizer = Tokenizer.from_file(os.path.join(self.model_path, "tokenizer.json"))
+        tokenizer.enable_truncation(max_length=self.max_length)
+        tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+        opzioni = onnxruntime.SessionOptions()
+        if self.threads:
+            opzioni.intra_op_num_threads = self.threads
+        self.tokenizer = tokenizer
+        self.model = onnxruntime.InferenceSession(
+            os.path.join(self.model_path, "model.onnx"),
+            sess_options=opzioni,
+            providers=["CPUExecutionProvider"]
+        )
+
+    def _calcola(self, domanda, chiave_domanda, docs):
+        """Punteggi delle coppie in un unico batch, salvati in cache (gira nel thread del modello)"""
+        import numpy as np
+        self._init_model()
+        encoded = self.tokenizer.encode_batch([(domanda, doc['content']) for doc in docs])
+        ingressi = {
+            "input_ids": np.array([e.ids for e in encoded], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encoded], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encoded], dtype=np.int64)
+        }
+        nomi = {i.name for i in self.model.get_inputs()}
+        logits = self.model.run(None, {k: v for k, v in ingressi.items() if k in nomi})[0]
+        # Un logit per coppia; con due classi conta quella "pertinente"
+        punteggi = logits[:, -1] if logits.ndim == 2 else logits
+        with self._lock:
+            for doc, punteggio in zip(docs, punteggi):
+                self._cache[(chiave_domanda, doc['id'])] = float(punteggio)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _thread_modello(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+            return self._executor
+
+    def riscalda(self):
+        self._thread_modello().submit(self._init_model).result()
+
+    def riordina(self, domanda, docs):
+        """docs ordinati per punteggio del cross-encoder (con 'pertinenza' in [0, 1]),
+        oppure None se il budget di latenza è superato o il modello non è disponibile"""
+        if not docs:
+            return docs
+        chiave_domanda = hashlib.sha1(EmbeddingCache.normalizza(domanda).encode('utf-8')).hexdigest()
+        with self._lock:
+            mancanti = [doc for doc in docs if (chiave_domanda, doc['id']) not in self._cache]
+        self.cache_hits += len(docs) - len(mancanti)
+        self.cache_misses += len(mancanti)
+        if mancanti:
+            if not self._posti.acquire(blocking=False):
+                # Modello già occupato da richieste precedenti: niente coda di lavori vecchi
+                self.saltati += 1
+                return None
+            futuro = self._thread_modello().submit(self._calcola, domanda, chiave_domanda, mancanti)
+            futuro.add_done_callback(lambda _: self._posti.release())
+            try:
+                futuro.result(timeout=self.budget_ms / 1000)
+            except concurrent.futures.TimeoutError:
+                # Se non è ancora partito non serve più; se è in corso finisce e riempie la cache
+                futuro.cancel()
+                self.fuori_budget += 1
+                return None
+            except Exception as e:
+                self.errori += 1
+                print(f"⚠️ Re-ranking non disponibile: {e}")
+                return None
+        with self._lock:
+            punteggi = {doc['id']: self._cache.get((chiave_domanda, doc['id'])) for doc in docs}
+        if any(punteggio is None for punteggio in punteggi.values()):
+            return None
+        self.riordinamenti += 1
+        riordinati = sorted(docs, key=lambda doc: -punteggi[doc['id']])
+        return [dict(doc, pertinenza=1 / (1 + math.exp(-punteggi[doc['id']]))) for doc in riordinati]
+
+    def stats(self):
+        totale = self.cache_hits + self.cache_misses
+        return {
+            "modello": self.model_path,
+            "budget_ms": self.budget_ms,
+            "riordinamenti": self.riordinamenti,
+            "fuori_budget": self.fuori_budget,
+            "saltati": self.saltati,
+            "errori": self.errori,
+            "cache_entries": len(self._cache),
+            "hit_rate": round(self.cache_hits / totale, 3) if totale else 0.0
+        }
+
+
+class Chunker:
+    """Divisione dei documenti in chunk, senza stato: usata dal Bot e dai processi di caricamento"""
+
+    SECTION_HEADER = re.compile(r'\n\d+\s+[A-Z]')
+    SENTENCE_ENDS = ('. ', '.\n', '? ', '! ', '\n')
+    ESTENSIONI = ('.txt', '.csv', '.pdf')
+
+    def __init__(self, chunk_size=None, overlap=None, pdf_workers=None, pdf_pages_per_task=None,
+                 csv_rows_per_chunk=None):
+        # Dimensione e sovrapposizione dei chunk configurabili (es. per il benchmark)
+        self.chunk_size = chunk_size or int(os.environ.get("CHUNK_SIZE", 800))
+        self.overlap = overlap if overlap is not None else int(os.environ.get("CHUNK_OVERLAP", 150))
+        # Righe CSV brevi raggruppate nello stesso chunk (1 = una riga per chunk)
+        self.csv_rows_per_chunk = csv_rows_per_chunk or int(os.environ.get("CSV_ROWS_PER_CHUNK", 1))
+        # Estrazione PDF in parallelo
+        self.pdf_workers = pdf_workers or int(os.environ.get("PDF_WORKERS", os.cpu_count() or 1))
+        self.pdf_pages_per_task = pdf_pages_per_task or int(os.environ.get("PDF_PAGES_PER_TASK", 4))
+
+    def _iter_sections(self, text, start=0, end=None):
+        """Offset (inizio, fine) delle sezioni numerate, senza copiare il testo"""
+        end = len(text) if end is None else end
+        inizio = start
+        for match in self.SECTION_HEADER.finditer(text, start, end):
+            if match.start() + 1 > inizio:
+                yield inizio, match.start() + 1
+                inizio = match.start() + 1
+        if inizio < end:
+            yield inizio, end
+
+    def _fine_frase(self, text, start, end):
+        """Ultimo confine di frase in text[start:end] (nella seconda metà), altrimenti end"""
+        minimo = start + (end - start) // 2
+        migliore = -1
+        for sep in self.SENTENCE_ENDS:
+            pos = text.rfind(sep, minimo, end)
+            if pos != -1:
+                migliore = max(migliore, pos + len(sep))
+        return migliore if migliore != -1 else end
+
+    def _inizio_frase(self, text, start, end):
+        """Primo inizio di frase in text[start:end], altrimenti start"""
+        migliore = end
+        for sep in self.SENTENCE_ENDS:
+            pos = text.find(sep, start, end)
+            if pos != -1:
+                migliore = min(migliore, pos + len(sep))
+        return migliore if migliore < end else start
+
+    def _iter_windows(self, text, start, end, chunk_size, overlap):
+        """Finestre di al più chunk_size caratteri che terminano a fine frase, con overlap per frasi intere"""
+        while start < end:
+            if end - start <= chunk_size:
+                yield start, end
+                return
+            fine = self._fine_frase(text, start, start + chunk_size)
+            yield start, fine
+            prossimo = self._inizio_frase(text, fine - overlap, fine)
+            start = prossimo if prossimo > start else fine
+
+    def _strip_offsets(self, text, start, end):
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        return start, end
+
+    def iter_chunks(self, text, start=0, end=None):
+        """Chunker lineare: produce (inizio, fine) dei chunk come generatore.
+
+        Le sezioni numerate vengono accorpate finché stanno in chunk_size; quelle troppo
+        lunghe sono divise in finestre che rispettano i confini di frase."""
+        end = len(text) if end is None else end
+        chunk_size, overlap = self.chunk_size, self.overlap
+        corrente = None
+        for sez_inizio, sez_fine in self._iter_sections(text, start, end):
+            if corrente is not None and sez_fine - corrente[0] <= chunk_size:
+                corrente = (corrente[0], sez_fine)
+                continue
+            if corrente is not None:
+                yield corrente
+                corrente = None
+            if sez_fine - sez_inizio > chunk_size:
+                yield from self._iter_windows(text, sez_inizio, sez_fine, chunk_size, overlap)
+            else:
+                corrente = (sez_inizio, sez_fine)
+        if corrente is not None:
+            yield corrente
+
+    def iter_chunk_offsets(self, text, min_length=50):
+        """Offset dei chunk già ripuliti dagli spazi e filtrati per lunghezza minima"""
+        for inizio, fine in self.iter_chunks(text):
+            inizio, fine = self._strip_offsets(text, inizio, fine)
+            if fine - inizio >= min_length:
+                yield inizio, fine
+
+    def chunks_testo(self, contenuto):
+        """(testo, metadati) dei chunk di un TXT, con gli offset nel file"""
+        for i, (inizio, fine) in enumerate(self.iter_chunk_offsets(contenuto)):
+            chunk = contenuto[inizio:fine]
+            yield chunk, {
+                "chunk_id": i,
+                "chunk_length": len(chunk),
+                "first_words": chunk[:100],
+                "char_start": inizio,
+                "char_end": fine
+            }
+
+    def chunks_csv(self, file_path):
+        """Chunk di un CSV letti in streaming, riga per riga.
+
+        Con csv_rows_per_chunk > 1 le righe consecutive vengono unite finché restano entro
+        chunk_size; row_start/row_end indicano l'intervallo di righe del chunk."""
+        import csv
+        righe = []
+        lunghezza = 0
+
+        def emetti():
+            testo = "\n".join(testo for _, testo in righe)
+            return testo, {
+                "chunk_id": righe[0][0] - 1,
+                "chunk_length": len(testo),
+                "row_number": righe[0][0],
+                "row_start": righe[0][0],
+                "row_end": righe[-1][0]
+            }
+
+        with open(file_path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.DictReader(f)
+            for i, row in enumerate(reader):
+                testo = " | ".join([f"{k}: {v}" for k, v in row.items() if v])
+                if not testo.strip():
+                    continue
+                if righe and (len(righe) >= self.csv_rows_per_chunk
+                              or lunghezza + 1 + len(testo) > self.chunk_size):
+                    if lunghezza >= 20:
+                        yield emetti()
+                    righe = []
+                    lunghezza = 0
+                lunghezza += len(testo) + (1 if righe else 0)
+                righe.append((i + 1, testo))
+            if righe and lunghezza >= 20:
+                yield emetti()
+
+    def _iter_finestre_pdf(self, file_path):
+        """Finestre di pagine estratte in parallelo, restituite in ordine man mano che sono pronte"""
+        import pypdf
+        with open(file_path, 'rb') as f:
+            num_pagine = len(pypdf.PdfReader(f).pages)
+        pagine_per_task = self.pdf_pages_per_task
+        intervalli = [(i, min(i + pagine_per_task, num_pagine)) for i in range(0, num_pagine, pagine_per_task)]
+        workers = min(self.pdf_workers, len(intervalli))
+
+        if workers <= 1:
+            for inizio, fine in intervalli:
+                yield _estrai_pagine_pdf(file_path, inizio, fine)
+            return
+
+        # Finestra scorrevole di task: al più 2 per worker in memoria, in ordine di pagina
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            in_corso = collections.deque()
+            for inizio, fine in intervalli:
+                in_corso.append(executor.submit(_estrai_pagine_pdf, file_path, inizio, fine))
+                if len(in_corso) >= workers * 2:
+                    yield in_corso.popleft().result()
+            while in_corso:
+                yield in_corso.popleft().result()
+
+    def chunks_pdf(self, file_path):
+        """Chunk della PDF finestra per finestra, con le pagine di provenienza nei metadati"""
+        i = 0
+        for pagine in self._iter_finestre_pdf(file_path):
+            if not pagine:
+                continue
+            inizi_pagina = []
+            posizione = 0
+            for numero, text in pagine:
+                inizi_pagina.append((posizione, numero))
+                posizione += len(text) + 2
+            testo = "".join(text + "\n\n" for _, text in pagine)
+            for inizio, fine in self.iter_chunk_offsets(testo):
+                # Pagina di inizio e di fine del chunk, e offset relativo alla pagina iniziale
+                pagina_inizio = max((p for p in inizi_pagina if p[0] <= inizio), key=lambda p: p[0])
+                pagina_fine = max((p for p in inizi_pagina if p[0] < fine), key=lambda p: p[0])
+                chunk_text = testo[inizio:fine]
+                yield chunk_text, {
+                    "chunk_id": i,
+                    "chunk_length": len(chunk_text),
+                    "first_words": chunk_text[:100],
+                    "page_start": pagina_inizio[1],
+                    "page_end": pagina_fine[1],
+                    "char_start": inizio - pagina_inizio[0],
+                    "char_end": fine - pagina_inizio[0]
+                }
+                i += 1
+
+
+def _prepara_file(file_path):
+    """Lettura e chunking di un file (eseguita nei processi worker del caricamento massivo)"""
+    chunker = Chunker()
+    sezioni = None
+    if file_path.endswith('.txt'):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            contenuto = f.read()
+        chunks = list(chunker.chunks_testo(contenuto))
+        sezioni = IndiceSezioni.analizza(contenuto)
+    elif file_path.endswith(('.csv', '.pdf')):
+        # CSV e PDF vengono letti in streaming direttamente dal writer: memoria limitata
+        # (le pagine PDF sono comunque estratte in parallelo, vedi Chunker.chunks_pdf)
+        chunks = None
+    else:
+        raise Exception(f"Formato non supportato: {file_path}")
+    return chunks, sezioni
+
+
+def _estrai_pagine_pdf(file_path, inizio, fine):
+    """Estrae il testo delle pagine [inizio, fine) di un PDF (eseguita nei processi worker)"""
+    import pypdf
+    with open(file_path, 'rb') as f:
+        reader = pypdf.PdfReader(f)
+        pagine = []
+        for numero in range(inizio, fine):
+            text = reader.pages[numero].extract_text()
+            if text:
+                pagine.append((numero + 1, text))
+    return pagine
+
+
+class VersioniCollection:
+    """Accesso alla collection Chroma: molti lettori, un solo writer, versioni scambiate via alias.
+
+    I lettori usano sempre la versione indicata dal file alias. Il writer (uno per volta tra
+    thread e processi, tramite flock) lavora su una copia di staging e la pubblica riscrivendo
+    l'alias in modo atomico: fino a quel momento le query continuano sulla versione precedente,
+    che viene conservata fino alla pubblicazione successiva. Ogni versione ha i suoi indici
+    laterali (BM25 e sezioni, file indicati nell'alias), scambiati insieme alla collection.
+
+    La copia costa O(chunk totali) per pubblicazione, anche se cambia un solo file: per questo
+    la usa solo il caricamento massivo (Bot.carica_cartella), mentre un singolo documento si
+    scrive direttamente sulla versione attiva. Con staging=False (CHROMA_STAGING=0) anche il
+    caricamento massivo scrive sulla versione attiva, mantenendo solo l'esclusività."""
+
+    def __init__(self, embedding_function, path="db", nome="documenti_toscana", staging=True):
+        self.embedding_function = embedding_function
+        self.path = path
+        self.nome = nome
+        self.staging = staging
+        self.alias_path = os.path.join(path, "collection_attiva.json")
+        self.lock_path = os.path.join(path, "scrittura.lock")
+        self.client = None
+        self._collection = None
+        self._alias_mtime = None
+        self._alias = None
+        self._alias_letto = None
+        self._staging = None
+        self._lock = threading.Lock()
+        self._lock_scrittura = threading.Lock()
+
+    def reset(self):
+        """Dopo una fork: client e handle si riaprono al primo uso"""
+        self.client = None
+        self._collection = None
+        self._alias_mtime = None
+
+    def _apri(self, nome):
+        if self.client is None:
+            import chromadb
+            self.client = chromadb.PersistentClient(path=self.path)
+            try:
+                # WAL: i lettori non bloccano (e non vengono bloccati da) il writer
+                with sqlite3.connect(os.path.join(self.path, "chroma.sqlite3"), timeout=10) as conn:
+                    conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.Error as e:
+                print(f"⚠️ WAL non attivato su chroma.sqlite3: {e}")
+        return self.client.get_or_create_collection(
+            nome,
+            metadata={"hnsw:space": "cosine"},
+            embedding_function=self.embedding_function
+        )
+
+    @staticmethod
+    def indici(nome):
+        """File degli indici laterali di una versione della collection"""
+        return {"bm25": f"bm25_{nome}.json", "sezioni": f"sezioni_{nome}.json"}
+
+    def _leggi_alias(self):
+        try:
+            with open(self.alias_path, 'r', encoding='utf-8') as f:
+                alias = json.load(f)
+        except (OSError, ValueError):
+            alias = {"attiva": self.nome, "precedente": None}
+        alias.setdefault("indici", self.indici(alias["attiva"]))
+        return alias
+
+    def alias(self):
+        """Contenuto dell'alias, riletto solo quando il file cambia (non apre Chroma)"""
+        try:
+            mtime = os.path.getmtime(self.alias_path)
+        except OSError:
+            mtime = None
+        if self._alias is None or mtime != self._alias_letto:
+            self._alias = self._leggi_alias()
+            self._alias_letto = mtime
+        return self._alias
+
+    def percorsi_indici(self, nome=None):
+        """Percorsi degli indici laterali della versione pubblicata (o della versione nome)"""
+        indici = self.indici(nome) if nome is not None else self.alias()["indici"]
+        return {chiave: os.path.join(self.path, file) for chiave, file in indici.items()}
+
+    def _elimina_indici(self, nome):
+        for percorso in self.percorsi_indici(nome).values():
+            try:
+                os.remove(percorso)
+            except OSError:
+                pass
+
+    def attiva(self):
+        """Collection della versione pubblicata; segue gli scambi fatti da altri processi"""
+        try:
+            mtime = os.path.getmtime(self.alias_path)
+        except OSError:
+            mtime = None
+        if self._collection is None or mtime != self._alias_mtime:
+            with self._lock:
+                if self._collection is None or mtime != self._alias_mtime:
+                    self._collection = self._apri(self._leggi_alias()["attiva"])
+                    self._alias_mtime = mtime
+        return self._collection
+
+    @contextlib.contextmanager
+    def scrittura(self):
+        """Sessione di scrittura esclusiva; una staging non pubblicata viene scartata all'uscita"""
+        import fcntl
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock_scrittura, open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if self._staging is not None:
+                    self.client.delete_collection(self._staging.name)
+                    self._elimina_indici(self._staging.name)
+                    self._staging = None
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def crea_staging(self, batch_size=1000):
+        """Copia della versione attiva (embedding compresi: nessun ricalcolo) su cui scrivere"""
+        attiva = self.attiva()
+        self._staging = self._apri(f"{self.nome}_{int(time.time() * 1000)}")
+        totale = attiva.count()
+        for offset in range(0, totale, batch_size):
+            blocco = attiva.get(include=["embeddings", "documents", "metadatas"],
+                                limit=batch_size, offset=offset)
+            if blocco["ids"]:
+                self._staging.add(ids=blocco["ids"], embeddings=blocco["embeddings"],
+                                  documents=blocco["documents"], metadatas=blocco["metadatas"])
+        return self._staging
+
+    def pubblica(self):
+        """Scambio atomico dell'alias (collection e indici laterali) sulla staging; si elimina
+        la versione di due scambi fa. Gli indici della staging devono essere già salvati."""
+        alias = self._leggi_alias()
+        nuovo = {"attiva": self._staging.name, "precedente": alias["attiva"],
+                 "indici": self.indici(self._staging.name)}
+        temporaneo = f"{self.alias_path}.{os.getpid()}.tmp"
+        with open(temporaneo, 'w', encoding='utf-8') as f:
+            json.dump(nuovo, f)
+        os.replace(temporaneo, self.alias_path)
+        with self._lock:
+            self._collection = self._staging
+            self._alias_mtime = os.path.getmtime(self.alias_path)
+        self._staging = None
+        if alias["precedente"] and alias["precedente"] not in nuovo.values():
+            try:
+                self.client.delete_collection(alias["precedente"])
+                self._elimina_indici(alias["precedente"])
+            except Exception as e:
+                print(f"⚠️ Versione {alias['precedente']} non eliminata: {e}")
+        print(f"🔀 Collection attiva: {nuovo['attiva']} (precedente: {nuovo['precedente']})")
+
+    def stats(self):
+        alias = self._leggi_alias()
+        return {"attiva": alias["attiva"], "precedente": alias["precedente"],
+                "scrittura_in_corso": self._lock_scrittura.locked()}
+
+
 class Bot:
     def __init__(self):
-        self.client = chromadb.PersistentClient(path="db")
-        self.collection = self.client.get_or_create_collection(
-            "documenti_toscana",
-            metadata={"hnsw:space": "cosine"}
+        self.embedding_function = EmbeddingBackend(
+            batch_size=int(os.environ.get("EMBEDDING_BATCH_SIZE", 64)),
+            threads=int(os.environ.get("EMBEDDING_THREADS", 0)) or None,
+            cache_path=os.path.join("db", "embedding_cache.sqlite3")
+        )
+        # Client Chroma aperto al primo accesso a self.collection, nel processo che lo usa
+        self.documenti = VersioniCollection(
+            self.embedding_function,
+            staging=os.environ.get("CHROMA_STAGING", "1") == "1"
+        )
+        # Copie di lavoro della sessione di scrittura in corso (vedi _scrittura)
+        self._staging = None
+        self.embedding_cache = EmbeddingCache(
+            max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", 512)),
+            ttl=int(os.environ.get("EMBEDDING_CACHE_TTL", 3600))
+        )
+        self.llm = GroqClient(
+            timeout=int(os.environ.get("GROQ_TIMEOUT", 30)),
+            max_retries=int(os.environ.get("GROQ_MAX_RETRIES", 2)),
+            backoff=float(os.environ.get("GROQ_BACKOFF", 0.5))
+        )
+        self.validazione = ValidationPipeline(
+            [GroundingValidator(), LLMValidator(self)],
+            modo=os.environ.get("VALIDATION_MODE", "auto"),
+            soglia_confidenza=float(os.environ.get("VALIDATION_LLM_THRESHOLD", 0.6))
+        )
+        # BM25 e sezioni della versione pubblicata (vedi _indici_laterali)
+        self._laterali = None
+        self._lock_laterali = threading.Lock()
+        self.chunker = Chunker()
+        self.catalogo = CatalogoStatistiche(path=os.path.join("db", "catalogo.json"))
+        # Re-ranking con cross-encoder ONNX locale, attivo solo con RERANK_MODEL_PATH
+        self.reranker = RerankerCrossEncoder.da_ambiente()
+        self.contesto = CostruttoreContesto(
+            budget_token=int(os.environ.get("CONTEXT_TOKEN_BUDGET", 500)),
+            max_chunks=int(os.environ.get("CONTEXT_MAX_CHUNKS", 4)),
+            soglia_relativa=float(os.environ.get("CONTEXT_MIN_SCORE_RATIO", 0.6)),
+            riduci=os.environ.get("CONTEXT_TRIM", "1") == "1"
         )
-        self.chat_history = []
-        self.awaiting_ticket_field = None
-        self.ticket_data = {}
+        self.answer_cache = AnswerCache(
+            path=os.environ.get("ANSWER_CACHE_PATH", "answer_cache.sqlite3"),
+            similarity=float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.95)),
+            ttl=int(os.environ.get("ANSWER_CACHE_TTL", 86400))
+        )
+        self.coda_ticket = CodaTicket(
+            path=os.environ.get("TICKET_QUEUE_PATH", "ticket_queue.sqlite3"),
+            workers=int(os.environ.get("TICKET_WORKERS", 2)),
+            max_tentativi=int(os.environ.get("TICKET_MAX_TENTATIVI", 8)),
+            backoff=float(os.environ.get("TICKET_BACKOFF", 2.0)),
+            conservazione=float(os.environ.get("TICKET_CONSERVAZIONE_GIORNI", 30)) * 86400
+        )
+        self.registro = RegistroInterazioni(
+            path=os.environ.get("INTERACTION_LOG_PATH", "interaction_log.jsonl"),
+            flush_righe=int(os.environ.get("INTERACTION_LOG_FLUSH_RIGHE", 100)),
+            flush_secondi=float(os.environ.get("INTERACTION_LOG_FLUSH_SECONDI", 2.0)),
+            max_bytes=int(os.environ.get("INTERACTION_LOG_MAX_MB", 50)) * 1024 * 1024,
+            max_archivi=int(os.environ.get("INTERACTION_LOG_ARCHIVI", 30))
+        )
+        # Cronologia e ticket in compilazione sono per sessione, non globali
+        self.sessioni_chat = ArchivioSessioni.da_ambiente()
         self.ticket_fields = [
             "nome e cognome",
             "reparto",
@@ -29,8 +2573,196 @@ class Bot:
             "telefono",
             "problema"
         ]
+        # Readiness: diventa True dopo il riscaldamento (modello e indice HNSW in memoria)
+        self.avvio = {"pronto": False, "riscaldamento_s": None, "errore": None}
+
+    @property
+    def collection(self):
+        """Versione pubblicata della collection (sola lettura per le query)"""
+        return self.documenti.attiva()
+
+    def _indici_laterali(self):
+        """(BM25, sezioni) della versione indicata dall'alias: quando un altro processo pubblica
+        una nuova versione si passa ai suoi file, senza mai leggere indici non ancora pubblicati.
+
+        Caricati al primo uso (riscalda() o prima richiesta), non all'import: il master gunicorn
+        non apre Chroma né onnxruntime."""
+        percorsi = self.documenti.percorsi_indici()
+        laterali = self._laterali
+        if laterali is None or laterali[0].path != percorsi["bm25"]:
+            with self._lock_laterali:
+                laterali = self._laterali
+                if laterali is None or laterali[0].path != percorsi["bm25"]:
+                    laterali = (BM25Index(path=percorsi["bm25"]), IndiceSezioni(path=percorsi["sezioni"]))
+                    self._ricostruisci_indici(*laterali)
+                    self._laterali = laterali
+        return laterali
+
+    @property
+    def bm25(self):
+        return self._indici_laterali()[0]
+
+    @property
+    def sezioni(self):
+        return self._indici_laterali()[1]
+
+    def _ricostruisci_indici(self, bm25, sezioni):
+        """BM25, indice delle sezioni e catalogo assenti (database creato prima di loro, o
+        clonato senza i file degli indici) si ricostruiscono una volta sola dalla collection"""
+        manca_bm25 = not os.path.exists(bm25.path)
+        manca_sezioni = not os.path.exists(sezioni.path)
+        esistenti = None
+        if (manca_bm25 or manca_sezioni) and self.collection.count():
+            esistenti = self.collection.get(include=["documents", "metadatas"])
+            if manca_bm25:
+                bm25.ricostruisci(esistenti["ids"], esistenti["documents"])
+                bm25.salva()
+            if manca_sezioni:
+                per_source = {}
+                for testo, metadata in zip(esistenti["documents"], esistenti["metadatas"]):
+                    source = (metadata or {}).get("source", "")
+                    if source.endswith(".txt"):
+                        per_source.setdefault(source, []).append((testo, metadata))
+                for source, chunks in per_source.items():
+                    sezioni.imposta_source(source, IndiceSezioni.analizza(self._ricomponi_testo(chunks)))
+                sezioni.salva()
+            print(f"🧱 Indici ricostruiti dalla collection: BM25 {len(bm25)} chunk, "
+                  f"sezioni di {len(sezioni.sources)} file")
+        if not self.catalogo.sources and len(bm25):
+            esistenti = esistenti or self.collection.get(include=["metadatas"])
+            self.catalogo.ricostruisci(esistenti["metadatas"])
+            self.catalogo.misura_db(self.documenti.path)
+            self.catalogo.salva()
+
+    @staticmethod
+    def _ricomponi_testo(chunks):
+        """Testo di un file rimesso insieme dai suoi (testo, metadati), senza le sovrapposizioni.
+
+        char_start/char_end sono aggiornati a ogni caricamento, quindi la parte in comune tra
+        chunk consecutivi si ricava dagli offset. I chunk salvati prima degli offset (solo
+        chunk_id) si concatenano nell'ordine dei chunk_id."""
+        parti = []
+        fine = None
+        chunks = sorted(chunks, key=lambda c: (c[1].get("char_start", 0), c[1].get("chunk_id", 0)))
+        for testo, metadata in chunks:
+            inizio = metadata.get("char_start")
+            if inizio is None or fine is None:
+                parti.append(("\n" if parti else "") + testo)
+            elif metadata["char_end"] > fine:
+                # Overlap del chunker: si aggiunge solo la parte dopo la fine del precedente
+                parti.append(testo[fine - inizio:] if inizio <= fine else "\n" + testo)
+            else:
+                continue
+            fine = metadata.get("char_end")
+        return "".join(parti)
+
+    @contextlib.contextmanager
+    def _scrittura(self, versione=False):
+        """Sessione di scrittura esclusiva. Con versione=True (e CHROMA_STAGING attivo) collection,
+        BM25 e sezioni vengono modificati su copie e pubblicati insieme all'uscita; altrimenti si
+        scrive direttamente sulla versione attiva, senza copiarla. Rientrante nello stesso thread
+        (caricamento massivo): vale la modalità della sessione più esterna."""
+        if self._staging is not None and self._staging["thread"] == threading.get_ident():
+            yield self._staging
+            return
+        with self.documenti.scrittura():
+            self._staging = {"thread": threading.get_ident(), "collection": None, "bm25": None,
+                             "sezioni": None, "catalogo": None,
+                             "versione": versione and self.documenti.staging}
+            try:
+                yield self._staging
+                if self._staging["collection"] is not None:
+                    # Gli indici della staging hanno file propri: nessuno li legge prima dello scambio
+                    self._staging["bm25"].salva()
+                    self._staging["sezioni"].salva()
+                    if self._staging["versione"]:
+                        with metriche.fase("ingest_pubblicazione"):
+                            self.documenti.pubblica()
+                        self._laterali = (self._staging["bm25"], self._staging["sezioni"])
+                    self._staging["catalogo"].misura_db(self.documenti.path)
+                    self._staging["catalogo"].salva()
+                    self.catalogo = self._staging["catalogo"]
+                    self.answer_cache.invalida()
+            finally:
+                self._staging = None
+
+    def _destinazione(self):
+        """Copie di lavoro della sessione, create alla prima modifica effettiva"""
+        if self._staging["collection"] is None and not self._staging["versione"]:
+            self._staging.update(collection=self.collection, bm25=self.bm25, sezioni=self.sezioni,
+                                 catalogo=self.catalogo)
+        elif self._staging["collection"] is None:
+            with metriche.fase("ingest_staging"):
+                collection = self.documenti.crea_staging()
+            percorsi = self.documenti.percorsi_indici(collection.name)
+            self._staging["bm25"] = self.bm25.copia(percorsi["bm25"])
+            self._staging["sezioni"] = self.sezioni.copia(percorsi["sezioni"])
+            self._staging["catalogo"] = CatalogoStatistiche(path=self.catalogo.path)
+            self._staging["collection"] = collection
+        return self._staging
+
+    def dopo_fork(self):
+        """Nel worker appena creato da gunicorn (preload_app): connessioni e modello propri.
+
+        Le connessioni SQLite di Chroma, il pool HTTP e la sessione ONNX (con i suoi thread)
+        non sopravvivono a una fork: si riaprono al primo uso nel worker. Il master non carica
+        gli indici BM25 e delle sezioni: ogni worker li legge in riscalda()."""
+        self.documenti.reset()
+        self.embedding_function.model = None
+        self.embedding_function.tokenizer = None
+        self.llm.reset()
+        if self.reranker is not None:
+            self.reranker.reset()
+        self.avvio = {"pronto": False, "riscaldamento_s": None, "errore": None}
+
+    def riscalda(self, domanda=None):
+        """Carica modello e indice HNSW con una query sintetica prima di accettare traffico"""
+        domanda = domanda or os.environ.get("WARMUP_QUERY", "orari e contatti del reparto")
+        inizio = time.time()
+        try:
+            self.coda_ticket.riprendi()
+            self._indici_laterali()
+            self.embedding_function.embed([domanda], persistente=False)
+            if self.reranker is not None:
+                self.reranker.riscalda()
+            if self.collection.count():
+                self.enhanced_search(domanda)
+            self.avvio.update(pronto=True, riscaldamento_s=round(time.time() - inizio, 3), errore=None)
+            print(f"🔥 Worker {os.getpid()} pronto in {self.avvio['riscaldamento_s']}s")
+        except Exception as e:
+            self.avvio.update(pronto=False, errore=str(e))
+            print(f"❌ Riscaldamento fallito nel worker {os.getpid()}: {e}")
+        return self.avvio["pronto"]
+
+    # Dimensione dei batch di scrittura su Chroma e journal del caricamento massivo
+    INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 256))
+    JOURNAL_PATH = os.path.join("db", "ingest_journal.json")
+    BULK_FILE_PER_VERSIONE = int(os.environ.get("BULK_FILE_PER_VERSIONE", 50))
+    # Ogni versione copia la collection: si pubblica solo dopo aver scritto almeno questa
+    # frazione dei chunk già presenti, così la copia totale resta O(chunk) e non O(chunk²)
+    BULK_QUOTA_COPIA = float(os.environ.get("BULK_QUOTA_COPIA", 0.25))
+    # Tempo massimo per tutte le chiamate al modello di una domanda (generazione, validazione,
+    # retry): sotto il timeout dei worker gunicorn
+    SCADENZA_RICHIESTA = float(os.environ.get("LLM_SCADENZA_RICHIESTA", 60))
+    # Tempi per fase di ogni richiesta anche nel log delle interazioni
+    LOG_TEMPI = os.environ.get("INTERACTION_LOG_TEMPI", "0") == "1"
+    # Cartella dei documenti: i source dei chunk sono percorsi relativi a essa
+    DOCUMENTS_ROOT = os.path.realpath(os.environ.get("DOCUMENTS_ROOT", "."))
+
+    @classmethod
+    def source_di(cls, file_path):
+        """Identificativo di un file nella collection, nel catalogo e nell'indice delle sezioni:
+        il percorso relativo a DOCUMENTS_ROOT (assoluto se il file è fuori), così due file con
+        lo stesso nome in cartelle diverse non si sovrascrivono i chunk a vicenda"""
+        percorso = os.path.realpath(file_path)
+        if os.path.commonpath([cls.DOCUMENTS_ROOT, percorso]) != cls.DOCUMENTS_ROOT:
+            return percorso
+        return os.path.relpath(percorso, cls.DOCUMENTS_ROOT).replace(os.sep, "/")
 
     def carica_documento(self, file_path):
+        """Carica (o aggiorna) un singolo file scrivendo sulla versione attiva: riscrive solo i
+        chunk cambiati, senza copiare la collection. Se fallisce a metà, i chunk vecchi restano
+        e il caricamento successivo completa l'aggiornamento."""
         try:
             if file_path.endswith('.txt'):
                 return self._carica_txt(file_path)
@@ -43,246 +2775,455 @@ class Bot:
         except Exception as e:
             raise Exception(f"Errore durante il caricamento: {str(e)}")
 
+    def _registra_file(self, file_path, nuovi_chunks, sezioni=None):
+        """Scrive i chunk di un file nella collection e, per i TXT, aggiorna l'indice delle sezioni"""
+        with self._scrittura(), metriche.fase("ingest_file"):
+            caricati = self._sincronizza_chunks(file_path, nuovi_chunks, batch_size=self.INGEST_BATCH_SIZE)
+            source = self.source_di(file_path)
+            if sezioni is not None and self._indici()[2].sources.get(source) != sezioni:
+                self._destinazione()["sezioni"].imposta_source(source, sezioni)
+        return caricati
+
+    def _indici(self):
+        """(collection, BM25, sezioni) su cui leggere durante una scrittura: la staging se esiste"""
+        if self._staging is not None and self._staging["collection"] is not None:
+            return self._staging["collection"], self._staging["bm25"], self._staging["sezioni"]
+        return self.collection, self.bm25, self.sezioni
+
     def _carica_txt(self, file_path):
         with open(file_path, 'r', encoding='utf-8') as f:
             contenuto = f.read()
-
-        existing_ids = self.collection.get(where={"source": os.path.basename(file_path)})["ids"]
-        if existing_ids:
-            self.collection.delete(ids=existing_ids)
-
-        chunks = self._split_text(contenuto, chunk_size=800, overlap=150)
-
-        documents = []
-        metadatas = []
-        ids = []
-
-        for i, chunk in enumerate(chunks):
-            if len(chunk.strip()) < 50:
-                continue
-            documents.append(chunk.strip())
-            metadatas.append({
-                "source": os.path.basename(file_path),
-                "full_path": file_path,
-                "chunk_id": i,
-                "chunk_length": len(chunk),
-                "upload_date": datetime.now().isoformat(),
-                "first_words": chunk[:100]
-            })
-            ids.append(f"{os.path.basename(file_path)}_{i}")
-
-        batch_size = 20
-        for i in range(0, len(documents), batch_size):
-            try:
-                self.collection.add(
-                    documents=documents[i:i + batch_size],
-                    metadatas=metadatas[i:i + batch_size],
-                    ids=ids[i:i + batch_size]
-                )
-            except Exception as e:
-                print(f"Errore batch {i}: {e}")
-
-        return len(documents)
+        return self._registra_file(file_path, self.chunker.chunks_testo(contenuto),
+                                   sezioni=IndiceSezioni.analizza(contenuto))
 
     def _carica_csv(self, file_path):
-        import csv
-        existing_ids = self.collection.get(where={"source": os.path.basename(file_path)})["ids"]
-        if existing_ids:
-            self.collection.delete(ids=existing_ids)
+        return self._registra_file(file_path, self.chunker.chunks_csv(file_path))
 
-        documents = []
-        metadatas = []
-        ids = []
-
-        with open(file_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for i, row in enumerate(reader):
-                testo = " | ".join([f"{k}: {v}" for k, v in row.items() if v])
-                if len(testo.strip()) < 20:
-                    continue
+    def _carica_pdf_original(self, file_path):
+        return self._registra_file(file_path, self.chunker.chunks_pdf(file_path))
+
+    @staticmethod
+    def trova_file(percorso, radice=None):
+        """File caricabili in una cartella (ricorsivamente) o corrispondenti a un glob.
+
+        Con radice, percorso è relativo a essa e si scarta ogni file che (dopo realpath,
+        quindi anche attraverso link simbolici o '..') cade fuori dalla radice."""
+        if radice is not None:
+            radice = os.path.realpath(radice)
+            percorso = os.path.join(radice, percorso.lstrip("/"))
+        if os.path.isdir(percorso):
+            candidati = glob.glob(os.path.join(percorso, '**', '*'), recursive=True)
+        else:
+            candidati = glob.glob(percorso, recursive=True)
+        if radice is not None:
+            candidati = [f for f in candidati
+                         if os.path.commonpath([radice, os.path.realpath(f)]) == radice]
+        return sorted(f for f in candidati if os.path.isfile(f) and f.endswith(Chunker.ESTENSIONI))
+
+    @staticmethod
+    def _impronta_file(file_path):
+        stat = os.stat(file_path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _carica_journal(self):
+        try:
+            with open(self.JOURNAL_PATH, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _salva_journal(self, journal):
+        temporaneo = f"{self.JOURNAL_PATH}.{os.getpid()}.tmp"
+        with open(temporaneo, 'w', encoding='utf-8') as f:
+            json.dump(journal, f, ensure_ascii=False)
+        os.replace(temporaneo, self.JOURNAL_PATH)
+
+    def carica_cartella(self, percorso, workers=None, riprendi=True, progresso=print, radice=None):
+        """Caricamento massivo di una cartella o di un glob.
+
+        Lettura e chunking avvengono in un pool di processi (CSV e PDF sono letti in streaming
+        dal writer, senza materializzarli); la scrittura su Chroma (con gli
+        embedding a batch) resta in questo processo, unico writer. Ogni gruppo di file completato
+        viene pubblicato e segnato nel journal: dopo un crash si riparte dai file mancanti o
+        modificati. Ogni versione nasce da una copia completa della collection (vedi
+        VersioniCollection): i gruppi sono di almeno BULK_FILE_PER_VERSIONE file e crescono con
+        la collection (BULK_QUOTA_COPIA), quindi le pubblicazioni sono O(log chunk). Se un file fallisce a metà scrittura la versione in corso viene scartata
+        e gli altri file del gruppo si riscrivono in una nuova. Con radice si caricano solo
+        file al suo interno (vedi trova_file)."""
+        file_list = self.trova_file(percorso, radice=radice)
+        journal = self._carica_journal() if riprendi else {}
+        da_fare = [f for f in file_list
+                   if journal.get(os.path.abspath(f)) != self._impronta_file(f)]
+        riepilogo = {
+            'file_totali': len(file_list),
+            'saltati': len(file_list) - len(da_fare),
+            'caricati': {},
+            'errori': {}
+        }
+        if not da_fare:
+            return riepilogo
+
+        workers = workers or min(len(da_fare), os.cpu_count() or 1)
+        # I file caricati vengono pubblicati (e segnati nel journal) a gruppi: ogni
+        # pubblicazione crea una nuova versione della collection
+        in_sessione = {}
+        scritti = []
+        chunk_in_sessione = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor, \
+                contextlib.ExitStack() as sessione:
+
+            def pubblica():
+                nonlocal chunk_in_sessione
+                sessione.close()
+                journal.update(in_sessione)
+                self._salva_journal(journal)
+                in_sessione.clear()
+                scritti.clear()
+                chunk_in_sessione = 0
+
+            def scarta(errore):
+                # Un file fallito a metà lascerebbe scritture parziali nella staging: la versione
+                # non viene pubblicata e i file già scritti in essa tornano in coda
+                nonlocal chunk_in_sessione
+                sessione.__exit__(type(errore), errore, errore.__traceback__)
+                in_sessione.clear()
+                chunk_in_sessione = 0
+                for scritto in scritti:
+                    del riepilogo['caricati'][scritto]
+                    in_corso[executor.submit(_prepara_file, scritto)] = scritto
+                if progresso and scritti:
+                    progresso(f"↩️ Versione scartata per l'errore su {file_path}: {len(scritti)} file rimessi in coda")
+                scritti.clear()
+
+            in_attesa = iter(da_fare)
+            in_corso = {}
+            # Al più 2 file per worker già letti in memoria in attesa del writer
+            for file_path in itertools.islice(in_attesa, workers * 2):
+                in_corso[executor.submit(_prepara_file, file_path)] = file_path
+            while in_corso:
+                completati, _ = concurrent.futures.wait(in_corso, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in completati:
+                    file_path = in_corso.pop(future)
+                    try:
+                        chunks, sezioni = future.result()
+                        impronta = self._impronta_file(file_path)
+                        if chunks is None:
+                            chunks = (self.chunker.chunks_pdf(file_path) if file_path.endswith('.pdf')
+                                      else self.chunker.chunks_csv(file_path))
+                        if self._staging is None:
+                            sessione.enter_context(self._scrittura(versione=True))
+                        try:
+                            riepilogo['caricati'][file_path] = self._registra_file(file_path, chunks, sezioni)
+                        except Exception as e:
+                            scarta(e)
+                            raise
+                        in_sessione[os.path.abspath(file_path)] = impronta
+                        scritti.append(file_path)
+                        chunk_in_sessione += riepilogo['caricati'][file_path]
+                    except Exception as e:
+                        riepilogo['errori'][file_path] = str(e) or type(e).__name__
+                    if progresso:
+                        fatti = len(riepilogo['caricati']) + len(riepilogo['errori'])
+                        esito = riepilogo['errori'].get(file_path) or f"{riepilogo['caricati'][file_path]} chunks"
+                        progresso(f"[{fatti}/{len(da_fare)}] {file_path}: {esito}")
+                    if len(in_sessione) >= self.BULK_FILE_PER_VERSIONE and \
+                            chunk_in_sessione >= self.BULK_QUOTA_COPIA * self.collection.count():
+                        pubblica()
+                    for prossimo in itertools.islice(in_attesa, 1):
+                        in_corso[executor.submit(_prepara_file, prossimo)] = prossimo
+            pubblica()
+        return riepilogo
+
+    @staticmethod
+    def _hash_contenuto(testo):
+        return hashlib.sha256(testo.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _a_blocchi(iterabile, dimensione):
+        iteratore = iter(iterabile)
+        while True:
+            blocco = list(itertools.islice(iteratore, dimensione))
+            if not blocco:
+                return
+            yield blocco
+
+    def _sincronizza_chunks(self, file_path, nuovi_chunks, batch_size=256):
+        """Aggiornamento incrementale: ricalcola gli embedding solo dei chunk modificati.
+
+        nuovi_chunks può essere un generatore di (testo, metadati): viene consumato a blocchi
+        di batch_size, quindi la memoria non dipende dalla dimensione del file. Va chiamato
+        dentro _scrittura(): le modifiche vanno sulla staging, le query restano sulla versione
+        pubblicata."""
+        source = self.source_di(file_path)
+
+        # Solo gli ID: i metadati esistenti si leggono batch per batch
+        ids_esistenti = set(self._indici()[0].get(where={"source": source}, include=[])["ids"])
+
+        visti = set()
+        totale = aggiunti = aggiornati = caratteri = 0
+
+        # Prima si scrivono i chunk nuovi, poi si eliminano i vecchi:
+        # le query non vedono mai la collection vuota durante il caricamento
+        # La lettura del file (generatore) avviene tra un blocco e l'altro
+        fine_blocco = time.perf_counter()
+        for blocco in self._a_blocchi(nuovi_chunks, batch_size):
+            metriche.registra("ingest_lettura", time.perf_counter() - fine_blocco)
+            documents = []
+            metadatas = []
+            ids = []
+            for testo, extra in blocco:
+                # Gli ID dipendono dal contenuto: un chunk invariato mantiene il suo ID
+                # anche se cambia posizione nel file
+                content_hash = self._hash_contenuto(testo)
+                chunk_id = f"{source}_{content_hash[:16]}"
+                n = 0
+                while chunk_id in visti:
+                    n += 1
+                    chunk_id = f"{source}_{content_hash[:16]}_{n}"
+                visti.add(chunk_id)
                 documents.append(testo)
-                metadatas.append({
-                    "source": os.path.basename(file_path),
+                metadata = {
+                    "source": source,
+                    "nome_file": os.path.basename(file_path),
                     "full_path": file_path,
-                    "chunk_id": i,
-                    "chunk_length": len(testo),
-                    "upload_date": datetime.now().isoformat(),
-                    "row_number": i + 1
-                })
-                ids.append(f"{os.path.basename(file_path)}_row_{i}")
-
-        batch_size = 50
-        for i in range(0, len(documents), batch_size):
-            self.collection.add(
-                documents=documents[i:i + batch_size],
-                metadatas=metadatas[i:i + batch_size],
-                ids=ids[i:i + batch_size]
-            )
-
-        return len(documents)
-
-    def _carica_pdf_original(self, file_path):
-        with open(file_path, 'rb') as f:
-            reader = pypdf.PdfReader(f)
-            full_text = ""
-            for page in reader.pages:
-                text = page.extract_text()
-                if text:
-                    full_text += text + "\n\n"
-
-        existing_ids = self.collection.get(where={"source": os.path.basename(file_path)})["ids"]
-        if existing_ids:
-            self.collection.delete(ids=existing_ids)
-
-        chunks = self._split_text(full_text, chunk_size=800, overlap=150)
-
-        documents = []
-        metadatas = []
-        ids = []
-
-        for i, chunk in enumerate(chunks):
-            chunk_text = chunk.strip()
-            if len(chunk_text) < 50:
+                    "content_hash": content_hash,
+                    "upload_date": datetime.now().isoformat()
+                }
+                metadata.update(extra)
+                metadatas.append(metadata)
+                ids.append(chunk_id)
+            totale += len(ids)
+            caratteri += sum(len(testo) for testo in documents)
+
+            gia_presenti = [chunk_id for chunk_id in ids if chunk_id in ids_esistenti]
+            metadata_esistenti = {}
+            if gia_presenti:
+                esistenti = self._indici()[0].get(ids=gia_presenti, include=["metadatas"])
+                metadata_esistenti = dict(zip(esistenti["ids"], esistenti["metadatas"]))
+
+            da_aggiungere = []
+            da_aggiornare = []
+            for i, chunk_id in enumerate(ids):
+                vecchio = metadata_esistenti.get(chunk_id)
+                if vecchio is None or vecchio.get("content_hash") != metadatas[i]["content_hash"]:
+                    da_aggiungere.append(i)
+                    continue
+                # Contenuto identico: si conserva la data del primo caricamento
+                metadatas[i]["upload_date"] = vecchio.get("upload_date", metadatas[i]["upload_date"])
+                # Metadati cambiati (tipicamente la posizione, dopo una modifica più in alto nel
+                # file): si aggiornano solo quelli, l'embedding resta valido
+                if vecchio != metadatas[i] or chunk_id not in self._indici()[1]:
+                    da_aggiornare.append(i)
+
+            if not da_aggiungere and not da_aggiornare:
+                fine_blocco = time.perf_counter()
                 continue
-            documents.append(chunk_text)
-            metadatas.append({
-                "source": os.path.basename(file_path),
-                "full_path": file_path,
-                "chunk_id": i,
-                "chunk_length": len(chunk_text),
-                "upload_date": datetime.now().isoformat(),
-                "first_words": chunk_text[:100]
-            })
-            ids.append(f"{os.path.basename(file_path)}_{i}")
+            destinazione = self._destinazione()
+
+            if da_aggiungere:
+                # Un errore qui interrompe il file: la sessione di scrittura non viene pubblicata
+                # e il file non entra nel journal, così il caricamento successivo lo riprova
+                with metriche.fase("ingest_embedding"):
+                    # Embedding calcolati qui in un unico batch (o letti dalla cache su disco)
+                    embeddings = self.embedding_function.embed(
+                        [documents[i] for i in da_aggiungere],
+                        hashes=[metadatas[i]["content_hash"] for i in da_aggiungere]
+                    )
+                with metriche.fase("ingest_scrittura"):
+                    destinazione["collection"].upsert(
+                        documents=[documents[i] for i in da_aggiungere],
+                        embeddings=embeddings,
+                        metadatas=[metadatas[i] for i in da_aggiungere],
+                        ids=[ids[i] for i in da_aggiungere]
+                    )
+                aggiunti += len(da_aggiungere)
+
+            # Solo metadati cambiati (es. posizione): nessun nuovo embedding
+            if da_aggiornare:
+                with metriche.fase("ingest_scrittura"):
+                    destinazione["collection"].update(
+                        metadatas=[metadatas[i] for i in da_aggiornare],
+                        ids=[ids[i] for i in da_aggiornare]
+                    )
+                aggiornati += len(da_aggiornare)
 
-        batch_size = 20
-        for i in range(0, len(documents), batch_size):
-            try:
-                self.collection.add(
-                    documents=documents[i:i + batch_size],
-                    metadatas=metadatas[i:i + batch_size],
-                    ids=ids[i:i + batch_size]
+            with metriche.fase("ingest_bm25"):
+                destinazione["bm25"].upsert(
+                    [ids[i] for i in da_aggiungere + da_aggiornare],
+                    [documents[i] for i in da_aggiungere + da_aggiornare]
                 )
-            except Exception as e:
-                print(f"Errore batch {i}: {e}")
+            fine_blocco = time.perf_counter()
+
+        da_eliminare = list(ids_esistenti - visti)
+        if da_eliminare:
+            destinazione = self._destinazione()
+            for start in range(0, len(da_eliminare), batch_size):
+                blocco = da_eliminare[start:start + batch_size]
+                # Il testo serve al BM25 per sapere da quali postings togliere i chunk
+                eliminati = destinazione["collection"].get(ids=blocco, include=["documents"])
+                destinazione["collection"].delete(ids=blocco)
+                destinazione["bm25"].rimuovi(eliminati["ids"], eliminati["documents"])
 
-        return len(documents)
+        catalogo = self._staging["catalogo"] or self.catalogo
+        voce = catalogo.sources.get(source)
+        if aggiunti or aggiornati or da_eliminare or voce is None or \
+                (voce["chunks"], voce["caratteri"]) != (totale, caratteri):
+            self._destinazione()["catalogo"].aggiorna_source(source, totale, caratteri)
+
+        print(f"🔄 {source}: {aggiunti} nuovi, {aggiornati} aggiornati, "
+              f"{len(da_eliminare)} eliminati, {totale - aggiunti - aggiornati} invariati")
+
+        return totale
 
     def _split_text(self, text, chunk_size=800, overlap=150):
-        if not text or len(text) < chunk_size:
-            return [text] if text else []
-
-        section_headers = re.findall(r'\n\d+\s+[A-Z]', text)
-        if section_headers:
-            sections = re.split(r'(\n\d+\s+[A-Z])', text)
-            reconstructed = []
-            for i in range(1, len(sections), 2):
-                if i + 1 < len(sections):
-                    reconstructed.append(sections[i] + sections[i + 1].lstrip())
-                else:
-                    reconstructed.append(sections[i])
-            if len(sections) % 2 == 1 and sections[-1].strip():
-                reconstructed.append(sections[-1])
-
-            chunks = []
-            current = ""
-            for sec in reconstructed:
-                if len(current) + len(sec) <= chunk_size:
-                    current += sec
-                else:
-                    if current:
-                        chunks.append(current)
-                    if len(sec) > chunk_size:
-                        chunks.extend(self._split_text_simple(sec, chunk_size, overlap))
-                    else:
-                        current = sec
-            if current:
-                chunks.append(current)
-            return [c.strip() for c in chunks if c.strip() and len(c.strip()) >= 50]
-        else:
-            return self._split_text_simple(text, chunk_size, overlap)
+        if not text:
+            return []
+        return [text[inizio:fine] for inizio, fine in
+                Chunker(chunk_size, overlap).iter_chunk_offsets(text)]
 
     def _split_text_simple(self, text, chunk_size=800, overlap=150):
         if not text:
             return []
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = start + chunk_size
-            chunk = text[start:end]
-            if len(chunk.strip()) >= 50:
-                chunks.append(chunk)
-            start += (chunk_size - overlap)
-        return chunks
+        return [
+            text[inizio:fine] for inizio, fine in Chunker()._iter_windows(text, 0, len(text), chunk_size, overlap)
+            if len(text[inizio:fine].strip()) >= 50
+        ]
 
-    def _similar_content(self, text1, text2):
-        """Calcola similarità approssimativa tra due testi"""
-        words1 = set(text1.lower().split()[:20])
-        words2 = set(text2.lower().split()[:20])
+    @staticmethod
+    def _token_set(text):
+        """Firma lessicale di un chunk: prime 20 parole in minuscolo"""
+        return frozenset(text.lower().split()[:20])
 
+    @staticmethod
+    def _jaccard(words1, words2):
         if not words1 or not words2:
             return 0
+        union = words1 | words2
+        return len(words1 & words2) / len(union) if union else 0
 
-        intersection = words1.intersection(words2)
-        union = words1.union(words2)
-
-        return len(intersection) / len(union) if union else 0
+    def _similar_content(self, text1, text2):
+        """Calcola similarità approssimativa tra due testi"""
+        return self._jaccard(self._token_set(text1), self._token_set(text2))
+
+    def embed_queries(self, testi):
+        """Embedding delle query passando dalla cache: il modello gira solo sui testi nuovi"""
+        embeddings = [self.embedding_cache.get(t) for t in testi]
+        mancanti = [i for i, e in enumerate(embeddings) if e is None]
+        if mancanti:
+            calcolati = self.embedding_function.embed([testi[i] for i in mancanti], persistente=False)
+            for i, embedding in zip(mancanti, calcolati):
+                embedding = [float(x) for x in embedding]
+                self.embedding_cache.put(testi[i], embedding)
+                embeddings[i] = embedding
+        return embeddings
+
+    def _lessicale_sufficiente(self, domanda, lessicali):
+        """Domande 'a parola chiave' (nomi, email, numeri) che individuano pochi chunk: basta l'indice BM25"""
+        if len(domanda.split()) > 3 or not lessicali:
+            return False
+        corrispondenze = self.bm25.contenenti_tutti(domanda)
+        return 0 < len(corrispondenze) <= self.BM25_SKIP_MAX_MATCHES
+
+    # Reciprocal Rank Fusion e soglia per saltare la ricerca vettoriale
+    RRF_K = 60
+    BM25_SKIP_MAX_MATCHES = 3
+    # Candidati (dopo la fusione) valutati dal cross-encoder
+    RERANK_CANDIDATI = int(os.environ.get("RERANK_CANDIDATES", 8))
+
+    def _docs_lessicali(self, lessicali, score_max, esclusi=()):
+        """Chunk trovati dal BM25, che ha solo gli ID: testo e metadati in un'unica lettura dalla collection"""
+        mancanti = [(chunk_id, score) for chunk_id, score in lessicali if chunk_id not in esclusi]
+        if not mancanti:
+            return {}
+        with metriche.fase("bm25_documenti"):
+            trovati = self.collection.get(ids=[chunk_id for chunk_id, _ in mancanti],
+                                          include=["documents", "metadatas"])
+        letti = dict(zip(trovati["ids"], zip(trovati["documents"], trovati["metadatas"])))
+        return {
+            chunk_id: {
+                'id': chunk_id,
+                'content': letti[chunk_id][0],
+                'metadata': letti[chunk_id][1],
+                # Distanza equivalente per i chunk trovati solo lessicalmente (il migliore vale 0.3)
+                'distance': 1 - 0.7 * score / score_max,
+                'source': 'bm25'
+            }
+            for chunk_id, score in mancanti if chunk_id in letti
+        }
 
     def enhanced_search(self, domanda, n_results=8):
-        """Ricerca focalizzata sulla precisione"""
+        """Ricerca ibrida focalizzata sulla precisione: BM25 + vettoriale fusi con RRF"""
+
+        with metriche.fase("bm25"):
+            lessicali = self.bm25.search(domanda, k=n_results)
+            score_max = lessicali[0][1] if lessicali else 1.0
+            sufficiente = self._lessicale_sufficiente(domanda, lessicali)
+        if sufficiente:
+            return list(self._docs_lessicali(lessicali, score_max).values())
 
         # Strategy 1: Query esatta
-        results1 = self.collection.query(
-            query_texts=[domanda],
-            n_results=n_results,
-            include=["documents", "metadatas", "distances"]
-        )
+        strategie = [('primary', domanda, n_results)]
 
-        # Strategy 2: Ricerca per frasi chiave (più conservativa)
+        # Strategy 2: Ricerca per frasi chiave (solo se manca l'indice lessicale, che la sostituisce)
         parole_significative = [p for p in domanda.split() if len(p) > 4]
         query_keywords = ' '.join(parole_significative[:3])  # Solo 3 parole più lunghe
-
-        if query_keywords:
-            results2 = self.collection.query(
-                query_texts=[query_keywords],
-                n_results=max(3, n_results // 3),
+        if not len(self.bm25) and query_keywords and \
+                EmbeddingCache.normalizza(query_keywords) != EmbeddingCache.normalizza(domanda):
+            strategie.append(('keywords', query_keywords, max(3, n_results // 3)))
+
+        with metriche.fase("embedding_query"):
+            query_embeddings = self.embed_queries([testo for _, testo, _ in strategie])
+
+        # Un'unica query batch per tutte le strategie vettoriali
+        with metriche.fase("query_vettoriale"):
+            results = self.collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results,
                 include=["documents", "metadatas", "distances"]
             )
-        else:
-            results2 = {"documents": [[]], "metadatas": [[]], "distances": [[]]}
-
-        # Combina eliminando duplicati
-        all_docs = []
-
-        # Aggiungi da results1
-        if results1["documents"][0]:
-            for doc, metadata, distance in zip(results1["documents"][0], results1["metadatas"][0],
-                                               results1["distances"][0]):
-                all_docs.append({
-                    'content': doc,
-                    'metadata': metadata,
-                    'distance': distance,
-                    'source': 'primary'
-                })
-
-        # Aggiungi da results2 solo se molto diversi
-        if results2["documents"][0]:
-            for doc, metadata, distance in zip(results2["documents"][0], results2["metadatas"][0],
-                                               results2["distances"][0]):
-                is_duplicate = any(
-                    self._similar_content(existing['content'], doc) > 0.7
-                    for existing in all_docs
-                )
-                if not is_duplicate:
-                    all_docs.append({
+
+        # Combina eliminando duplicati (per ID e per contenuto quasi identico)
+        inizio_fusione = time.perf_counter()
+        candidati = {}
+        rrf = {}
+        firme = []
+        for q, (nome, _, limite) in enumerate(strategie):
+            hits = list(zip(results["ids"][q], results["documents"][q],
+                            results["metadatas"][q], results["distances"][q]))[:limite]
+            for rank, (chunk_id, doc, metadata, distance) in enumerate(hits):
+                if chunk_id not in candidati:
+                    firma = self._token_set(doc)
+                    # Aggiungi dalla ricerca per parole chiave solo se molto diversi
+                    if nome != 'primary' and any(self._jaccard(firma, f) > 0.7 for f in firme):
+                        continue
+                    firme.append(firma)
+                    candidati[chunk_id] = {
+                        'id': chunk_id,
                         'content': doc,
                         'metadata': metadata,
                         'distance': distance,
-                        'source': 'keywords'
-                    })
-
-        # Ordina per distanza e prendi i migliori
-        all_docs.sort(key=lambda x: x['distance'])
+                        'source': nome
+                    }
+                rrf[chunk_id] = rrf.get(chunk_id, 0.0) + 1 / (self.RRF_K + rank + 1)
+
+        solo_lessicali = self._docs_lessicali(lessicali, score_max, esclusi=candidati)
+        for rank, (chunk_id, score) in enumerate(lessicali):
+            if chunk_id not in candidati:
+                if chunk_id not in solo_lessicali:
+                    continue
+                candidati[chunk_id] = solo_lessicali[chunk_id]
+            rrf[chunk_id] = rrf.get(chunk_id, 0.0) + 1 / (self.RRF_K + rank + 1)
+
+        # Ordina per punteggio fuso (a parità, per distanza) e prendi i migliori
+        all_docs = sorted(candidati.values(), key=lambda x: (-rrf[x['id']], x['distance']))
+        metriche.registra("fusione", time.perf_counter() - inizio_fusione)
+
+        # Re-ranking opzionale dei migliori candidati con il cross-encoder (entro il budget di latenza)
+        if self.reranker is not None:
+            with metriche.fase("rerank"):
+                riordinati = self.reranker.riordina(domanda, all_docs[:self.RERANK_CANDIDATI])
+            if riordinati is not None:
+                all_docs = riordinati + all_docs[self.RERANK_CANDIDATI:]
         return all_docs[:n_results]
 
     def validate_response_enhanced(self, response, domanda, contesto):
@@ -307,37 +3248,20 @@ class Bot:
         Risposta:
         """
 
-        try:
-            groq_api_key = os.environ.get('GROQ_API_KEY')
-            if not groq_api_key:
-                return True  # Fallback
-
-            headers = {
-                'Authorization': f'Bearer {groq_api_key}',
-                'Content-Type': 'application/json'
-            }
+        # Errori del modello (timeout, 429, 5xx) risalgono a ValidationPipeline: un validatore
+        # non raggiungibile non equivale a una risposta non valida
+        if not self.llm.api_key:
+            return True  # Fallback
 
-            payload = {
-                "model": "llama-3.3-70b-versatile",
-                "messages": [{"role": "user", "content": validation_prompt}],
-                "temperature": 0.1,
-                "max_tokens": 50
-            }
-
-            response_val = requests.post(
-                'https://api.groq.com/openai/v1/chat/completions',
-                headers=headers,
-                json=payload,
-                timeout=10
-            )
-
-            if response_val.status_code == 200:
-                result = response_val.json()['choices'][0]['message']['content'].strip()
-                return "VALIDA" in result.upper()
-            return False
-
-        except Exception:
-            return False
+        result = self.llm.chat(
+            [{"role": "user", "content": validation_prompt}],
+            timeout=10,
+            temperature=0.1,
+            max_tokens=50
+        )
+        # "NON_VALIDA" contiene "VALIDA": va escluso esplicitamente
+        esito = result.upper()
+        return "VALIDA" in esito and "NON_VALIDA" not in esito and "NON VALIDA" not in esito
 
     def get_fallback_response(self, domanda, documenti):
         """Risposta di fallback ultra-conservativa"""
@@ -348,7 +3272,7 @@ class Bot:
         # Costruisci risposta basata solo su citazioni esatte
         citazioni = []
         for doc in documenti[:3]:  # Solo primi 3 documenti
-            source = doc['metadata'].get('source', 'documento')
+            source = doc['metadata'].get('nome_file') or os.path.basename(doc['metadata'].get('source', 'documento'))
             # Estrai frasi rilevanti (semplificato)
             contenuto = doc['content']
             # Cerca parole chiave della domanda
@@ -387,12 +3311,14 @@ class Bot:
             ]
         }
 
-        # Salva in file JSON
-        try:
-            with open('interaction_log.jsonl', 'a', encoding='utf-8') as f:
-                f.write(json.dumps(log_entry, ensure_ascii=False) + '\n')
-        except Exception as e:
-            print(f"Errore nel logging: {e}")
+        # Dettaglio dei tempi per fase della richiesta (INTERACTION_LOG_TEMPI=1)
+        tempi = metriche.tempi_richiesta()
+        if tempi is not None and self.LOG_TEMPI:
+            log_entry['tempi_ms'] = dict(tempi)
+
+        # Scrittura su file in background: la richiesta non attende mai il disco
+        with metriche.fase("log"):
+            self.registro.scrivi(log_entry)
 
     def calculate_confidence(self, documenti_utilizzati):
         """Calcola punteggio di confidenza basato sulla qualità dei documenti"""
@@ -410,29 +3336,27 @@ class Bot:
 
         # Calcola confidence score
         distance_score = max(0, 1 - avg_distance)  # 1 per distanza 0, 0 per distanza >=1
+        if all('pertinenza' in doc for doc in documenti_utilizzati):
+            # Documenti riordinati dal cross-encoder: il suo punteggio è più affidabile della distanza
+            distance_score = sum(doc['pertinenza'] for doc in documenti_utilizzati) / doc_count
         count_score = min(1.0, doc_count / 5)  # Massimo 1.0 per 5+ documenti
         length_score = min(1.0, avg_length / 500)  # Bonus per documenti lunghi
 
         confidence = (distance_score * 0.6 + count_score * 0.3 + length_score * 0.1)
         return round(confidence, 2)
 
-    def query_con_groq(self, domanda, n_results=5):
-        try:
-            # Ricerca avanzata
-            relevant_docs = self.enhanced_search(domanda, n_results=n_results)
-
-            if not relevant_docs:
-                return "🤔 Non ho trovato informazioni sufficientemente rilevanti nei documenti."
-
-            # Calcola confidence score
-            confidence = self.calculate_confidence(relevant_docs)
-
-            # Prendi i documenti migliori
-            top_docs = relevant_docs[:3]  # Solo 3 documenti per massima precisione
-            contesto = "\n\n--- DOCUMENTO ---\n\n".join([doc['content'] for doc in top_docs])
+    # PARAMETRI API ULTRA-CONSERVATIVI
+    GENERATION_PARAMS = {
+        "temperature": 0.01,  # Quasi zero creatività
+        "top_p": 0.1,
+        "max_tokens": 800,
+        "frequency_penalty": 0.5,
+        "presence_penalty": 0.3,
+        "stop": ["\n\nNote:", "\n\nDisclaimer:"]
+    }
 
-            # PROMPT MOLTO PIÙ STRINGENTE
-            prompt = f"""# ISTRUZIONI ASSOLUTE - MODALITÀ PRECISA COME NOTEBOOKLM
+    # PROMPT MOLTO PIÙ STRINGENTE (analizzato una volta sola, vedi TemplatePrompt)
+    PROMPT_RISPOSTA = TemplatePrompt("""# ISTRUZIONI ASSOLUTE - MODALITÀ PRECISA COME NOTEBOOKLM
 
 ## CONTESTO DOCUMENTALE (FONTE DELLA VERITÀ):
 {contesto}
@@ -470,129 +3394,205 @@ class Bot:
 - **NON SPIEGARE** concetti non esplicitati
 
 ## RISPOSTA (SOLO BASATA SUI DOCUMENTI SOPRA):
-"""
+""")
 
-            groq_api_key = os.environ.get('GROQ_API_KEY')
-            if not groq_api_key:
-                return "❌ Errore: GROQ_API_KEY non configurata."
+    def _prepara_query(self, domanda, n_results=5):
+        """Ricerca, contesto e prompt per una domanda (None se non ci sono documenti)"""
+        # Ricerca avanzata
+        relevant_docs = self.enhanced_search(domanda, n_results=n_results)
 
-            headers = {
-                'Authorization': f'Bearer {groq_api_key}',
-                'Content-Type': 'application/json'
-            }
+        if not relevant_docs:
+            return None
 
-            # PARAMETRI API ULTRA-CONSERVATIVI
-            payload = {
-                "model": "llama-3.3-70b-versatile",
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.01,  # Quasi zero creatività
-                "top_p": 0.1,
-                "max_tokens": 800,
-                "frequency_penalty": 0.5,
-                "presence_penalty": 0.3,
-                "stop": ["\n\nNote:", "\n\nDisclaimer:"]
-            }
+        # Calcola confidence score
+        confidence = self.calculate_confidence(relevant_docs)
 
-            response = requests.post(
-                'https://api.groq.com/openai/v1/chat/completions',
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
+        # Contesto entro il budget di token: solo chunk e frasi pertinenti
+        with metriche.fase("contesto"):
+            contesto, top_docs, token_contesto = self.contesto.costruisci(domanda, relevant_docs)
+        prompt = self.PROMPT_RISPOSTA.render(contesto=contesto, domanda=domanda)
 
-            if response.status_code == 200:
-                risposta = response.json()['choices'][0]['message']['content'].strip()
+        return {
+            'confidence': confidence,
+            'top_docs': top_docs,
+            'contesto': contesto,
+            'prompt': prompt,
+            'embedding': self.embed_queries([domanda])[0],
+            'chunk_ids': [doc['id'] for doc in top_docs],
+            'token_contesto': token_contesto
+        }
 
-                # Validazione rinforzata
-                if not self.validate_response_enhanced(risposta, domanda, contesto):
-                    risposta = self.get_fallback_response(domanda, top_docs)
+    def _registra_risposta(self, domanda, risposta, prep, sessione=None):
+        # Log dell'interazione
+        self.log_interaction(domanda, risposta, prep['top_docs'], prep['confidence'])
+
+        if sessione is not None:
+            sessione["chat_history"].append({"domanda": domanda, "risposta": risposta})
+            del sessione["chat_history"][:-ArchivioSessioni.STORICO_MAX]
+        return risposta
+
+    def _finalizza_risposta(self, domanda, risposta, prep, sessione=None):
+        """Validazione, indicatore di confidenza, cache e log della risposta generata"""
+        # Validazione rinforzata
+        with metriche.fase("validazione"):
+            valida = self.validazione.valida(risposta, domanda, prep['contesto'], prep['confidence'])
+        if not valida:
+            risposta = self.get_fallback_response(domanda, prep['top_docs'])
+
+        # Aggiungi confidence indicator solo se bassa
+        if prep['confidence'] < 0.6:
+            risposta = f"📊 *Confidenza: {prep['confidence'] * 100}% - Informazioni limitate*\n\n{risposta}"
+
+        # Con il validatore in errore (valida è None) il fallback è solo temporaneo: non in cache
+        if valida is not None:
+            self.answer_cache.put(domanda, prep['embedding'], prep['chunk_ids'], risposta)
+        return self._registra_risposta(domanda, risposta, prep, sessione)
+
+    def risposta_strutturata(self, domanda, sessione=None):
+        """Risposta immediata dall'indice delle sezioni, senza embedding né LLM"""
+        trovata = self.sezioni.rispondi(domanda)
+        if trovata is None:
+            return None
+        source, numero, sezione, righe = trovata
+        risposta = f"📄 **Da {source}, sezione {numero} {sezione['nome']}**:\n\n" + "\n".join(righe)
+        prep = {
+            'top_docs': [{'metadata': {'source': source, 'nome_file': os.path.basename(source)}, 'content': sezione['testo'], 'distance': 0.0}],
+            'confidence': 1.0
+        }
+        return self._registra_risposta(domanda, risposta, prep, sessione)
 
-                # Aggiungi confidence indicator solo se bassa
-                if confidence < 0.6:
-                    risposta = f"📊 *Confidenza: {confidence * 100}% - Informazioni limitate*\n\n{risposta}"
+    def query_con_groq(self, domanda, n_results=5, sessione=None):
+        """sessione: stato della conversazione (da ArchivioSessioni) in cui registrare la risposta"""
+        with self.llm.scadenza(self.SCADENZA_RICHIESTA):
+            try:
+                with metriche.fase("risposta_strutturata"):
+                    risposta = self.risposta_strutturata(domanda, sessione)
+                if risposta is not None:
+                    return risposta
+
+                with metriche.fase("preparazione"):
+                    prep = self._prepara_query(domanda, n_results=n_results)
+                if prep is None:
+                    return "🤔 Non ho trovato informazioni sufficientemente rilevanti nei documenti."
+
+                # Cache delle risposte: stessa domanda (o quasi) sugli stessi chunk
+                with metriche.fase("cache_risposte"):
+                    risposta_cache = self.answer_cache.get(domanda, prep['embedding'], prep['chunk_ids'])
+                if risposta_cache is not None:
+                    return self._registra_risposta(domanda, risposta_cache, prep, sessione)
+
+                if not self.llm.api_key:
+                    return "❌ Errore: GROQ_API_KEY non configurata."
+
+                try:
+                    with metriche.fase("generazione"):
+                        risposta = self.llm.chat(
+                            [{"role": "user", "content": prep['prompt']}],
+                            **self.GENERATION_PARAMS
+                        )
+                except LLMError as e:
+                    if e.status_code is not None:
+                        return f"❌ Errore API Groq: {e.status_code}"
+                    raise
+
+                return self._finalizza_risposta(domanda, risposta, prep, sessione)
 
-                # Log dell'interazione
-                self.log_interaction(domanda, risposta, top_docs, confidence)
+            except Exception as e:
+                return f"❌ Errore durante la ricerca: {str(e)}"
 
-                self.chat_history.append({"domanda": domanda, "risposta": risposta})
-                if len(self.chat_history) > 10:
-                    self.chat_history.pop(0)
-                return risposta
-            else:
-                return f"❌ Errore API Groq: {response.status_code}"
+    def stream_query(self, domanda, n_results=5, sessione=None):
+        """Come query_con_groq, ma produce eventi ('token', testo) e infine ('done', risposta)"""
+        with self.llm.scadenza(self.SCADENZA_RICHIESTA):
+            try:
+                with metriche.fase("risposta_strutturata"):
+                    risposta = self.risposta_strutturata(domanda, sessione)
+                if risposta is not None:
+                    yield 'done', risposta
+                    return
 
-        except Exception as e:
-            return f"❌ Errore durante la ricerca: {str(e)}"
+                with metriche.fase("preparazione"):
+                    prep = self._prepara_query(domanda, n_results=n_results)
+                if prep is None:
+                    yield 'done', "🤔 Non ho trovato informazioni sufficientemente rilevanti nei documenti."
+                    return
+
+                with metriche.fase("cache_risposte"):
+                    risposta_cache = self.answer_cache.get(domanda, prep['embedding'], prep['chunk_ids'])
+                if risposta_cache is not None:
+                    yield 'done', self._registra_risposta(domanda, risposta_cache, prep, sessione)
+                    return
+
+                if not self.llm.api_key:
+                    yield 'done', "❌ Errore: GROQ_API_KEY non configurata."
+                    return
+
+                parti = []
+                inizio = time.perf_counter()
+                try:
+                    for token in self.llm.stream_chat(
+                            [{"role": "user", "content": prep['prompt']}],
+                            **self.GENERATION_PARAMS
+                    ):
+                        if not parti:
+                            metriche.registra("primo_token", time.perf_counter() - inizio)
+                        parti.append(token)
+                        yield 'token', token
+                    metriche.registra("generazione", time.perf_counter() - inizio)
+                except LLMError as e:
+                    if e.status_code is not None:
+                        yield 'done', f"❌ Errore API Groq: {e.status_code}"
+                        return
+                    raise
+
+                # La risposta definitiva (validata) può sostituire quella mostrata in streaming
+                yield 'done', self._finalizza_risposta(domanda, "".join(parti).strip(), prep, sessione)
+
+            except Exception as e:
+                yield 'done', f"❌ Errore durante la ricerca: {str(e)}"
 
     def get_stats(self):
+        # Dal catalogo in memoria: costo indipendente dal numero di chunk
         try:
-            collection_data = self.collection.get()
-            if not collection_data["ids"]:
+            riepilogo = self.catalogo.riepilogo()
+            if not riepilogo["chunks"]:
                 return "📊 Database vuoto."
-            total_docs = len(collection_data["ids"])
-            sources = set()
-            for metadata in collection_data["metadatas"]:
-                if metadata and "source" in metadata:
-                    sources.add(metadata["source"])
-            return f"📊 Database: {total_docs} chunks da {len(sources)} file(s): {', '.join(sources)}"
+            sources = sorted(riepilogo["sources"])
+            return f"📊 Database: {riepilogo['chunks']} chunks da {len(sources)} file(s): {', '.join(sources)}"
         except Exception as e:
             return f"❌ Errore nel recuperare le statistiche: {str(e)}"
 
-    def cancella_cronologia(self):
-        self.chat_history = []
+    def get_stats_dettaglio(self):
+        """Forma estesa di get_stats: per source chunk, caratteri e ultimo caricamento"""
+        riepilogo = self.catalogo.riepilogo()
+        riepilogo["collection"] = self.documenti.stats()
+        return riepilogo
+
+    def cancella_cronologia(self, sessione):
+        sessione["chat_history"] = []
         return "🧹 Cronologia della chat cancellata!"
 
     def invia_email_ticket_async(self, dati_ticket):
-        """Invia email tramite SendGrid in background"""
-
-        def _invio():
-            try:
-                sendgrid_api_key = os.environ.get("SENDGRID_API_KEY")
-                mittente = os.environ.get("SENDGRID_FROM_EMAIL", "marco.dimico@gmail.com")
-                destinatario = os.environ.get("SUPPORT_EMAIL", "toscanaticket@gmail.com")
-
-                if not sendgrid_api_key:
-                    print("📧 SENDGRID_API_KEY non configurata")
-                    return
-
-                import httpx
-                corpo = "Un utente ha aperto un ticket tramite il bot:\n\n"
-                for campo, valore in dati_ticket.items():
-                    corpo += f"{campo.capitalize()}: {valore}\n"
-
-                data = {
-                    "personalizations": [{
-                        "to": [{"email": destinatario}],
-                        "reply_to": {"email": "toscanaticket@gmail.com"}
-                    }],
-                    "from": {"email": mittente, "name": "Bot Sanità Toscana"},
-                    "subject": "🆕 Ticket aperto dal bot - Sanità Toscana",
-                    "content": [{"type": "text/plain", "value": corpo}]
-                }
-
-                response = httpx.post(
-                    "https://api.sendgrid.com/v3/mail/send",
-                    headers={
-                        "Authorization": f"Bearer {sendgrid_api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json=data,
-                    timeout=10
-                )
-                if response.status_code == 202:
-                    print("✅ Email inviata con successo via SendGrid")
-                else:
-                    print(f"❌ Errore SendGrid: {response.status_code} - {response.text}")
-            except Exception as e:
-                print(f"❌ Errore invio email SendGrid: {e}")
-
-        thread = threading.Thread(target=_invio)
-        thread.daemon = True
-        thread.start()
+        """Accoda l'email del ticket: la invia in background il pool della coda persistente"""
+        return self.coda_ticket.accoda(dati_ticket)
 
 
 bot = Bot()
 
+# Budget del tempo di import: l'autoscaling avvia container a freddo
+TEMPO_IMPORT_MS = round((time.perf_counter() - _INIZIO_IMPORT) * 1000, 1)
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", 600))
+if TEMPO_IMPORT_MS > IMPORT_BUDGET_MS:
+    print(f"⚠️ Import di app.py in {TEMPO_IMPORT_MS} ms, oltre il budget di {IMPORT_BUDGET_MS:.0f} ms")
+
+# Sotto gunicorn (gunicorn.conf.py) il riscaldamento avviene in ogni worker prima di accettare
+# traffico; altrimenti parte subito in background e /health/ready segnala quando è finito
+if os.environ.get("WARMUP_IN_BACKGROUND", "1") == "1":
+    riscaldamento = threading.Thread(target=bot.riscalda, name="riscaldamento", daemon=True)
+    riscaldamento.start()
+    # Uscire con il thread ancora dentro onnxruntime fa abortire il processo
+    # ("terminate called without an active exception"): all'uscita si attende che finisca
+    atexit.register(riscaldamento.join, float(os.environ.get("WARMUP_JOIN_TIMEOUT", 60)))
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
@@ -745,13 +3745,38 @@ HTML_TEMPLATE = """
         chat.scrollTop = chat.scrollHeight;
 
         try {
-            const response = await fetch('/chat', {
+            const response = await fetch('/chat/stream', {
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
                 body: JSON.stringify({message: message})
             });
-            const data = await response.json();
-            chat.innerHTML += `<div class="message bot">🤖 ${data.response}</div>`;
+            if (!response.ok || !response.body) throw new Error(`HTTP ${response.status}`);
+
+            const botMessage = document.createElement('div');
+            botMessage.className = 'message bot';
+            botMessage.textContent = '🤖 ';
+            chat.appendChild(botMessage);
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const {value, done} = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, {stream: true});
+                const events = buffer.split('\\n\\n');
+                buffer = events.pop();
+                for (const event of events) {
+                    if (!event.startsWith('data:')) continue;
+                    const data = JSON.parse(event.slice(5));
+                    if (data.type === 'token') {
+                        botMessage.textContent += data.text;
+                    } else {
+                        botMessage.innerHTML = `🤖 ${data.text}`;
+                    }
+                    chat.scrollTop = chat.scrollHeight;
+                }
+            }
         } catch (error) {
             chat.innerHTML += `<div class="message bot" style="color: red;">❌ Errore: ${error.message}</div>`;
         } finally {
@@ -804,6 +3829,60 @@ def home():
     return render_template_string(HTML_TEMPLATE)
 
 
+SESSION_COOKIE = os.environ.get("SESSION_COOKIE", "sessione_id")
+
+
+def sessione_corrente():
+    """ID e stato della sessione della richiesta (cookie o header X-Session-Id); ne crea una se manca"""
+    id_sessione = request.cookies.get(SESSION_COOKIE) or request.headers.get('X-Session-Id')
+    if not id_sessione:
+        id_sessione = ArchivioSessioni.nuovo_id()
+        g.nuova_sessione = id_sessione
+    return id_sessione, bot.sessioni_chat.carica(id_sessione)
+
+
+@app.after_request
+def imposta_cookie_sessione(response):
+    if g.get('nuova_sessione'):
+        response.set_cookie(SESSION_COOKIE, g.nuova_sessione, httponly=True, samesite='Lax',
+                            max_age=int(os.environ.get("SESSION_TTL", 3600)))
+    return response
+
+
+def gestisci_ticket(query, sessione):
+    """Flusso di apertura ticket: restituisce la risposta, o None se il messaggio è una domanda"""
+    if query.lower() == "apertura ticket":
+        sessione["awaiting_ticket_field"] = 0
+        sessione["ticket_data"] = {}
+        first_field = bot.ticket_fields[0]
+        return f"📬 Apertura ticket in corso.\nPer favore, indicami il tuo **{first_field}**:"
+
+    if sessione["awaiting_ticket_field"] is not None:
+        current_index = sessione["awaiting_ticket_field"]
+        field_name = bot.ticket_fields[current_index]
+        sessione["ticket_data"][field_name] = query
+
+        if current_index + 1 < len(bot.ticket_fields):
+            sessione["awaiting_ticket_field"] += 1
+            next_field = bot.ticket_fields[sessione["awaiting_ticket_field"]]
+            return f"✅ {field_name.capitalize()} registrato.\nOra, per favore, indicami: **{next_field}**"
+        else:
+            summary = "\n".join([f"• **{k.capitalize()}**: {v}" for k, v in sessione["ticket_data"].items()])
+            bot.invia_email_ticket_async(sessione["ticket_data"])
+            sessione["awaiting_ticket_field"] = None
+            sessione["ticket_data"] = {}
+            return (
+                "✅ **Ticket compilato con successo!**\n\n"
+                "Ecco i dati che hai fornito:\n\n"
+                f"{summary}\n\n"
+                "📬 Il team di supporto è stato notificato via email. "
+                "Riceverai assistenza al più presto!\n\n"
+                "Puoi continuare a chiedermi informazioni sui documenti."
+            )
+
+    return None
+
+
 @app.route('/chat', methods=['POST'])
 def chat():
     try:
@@ -811,42 +3890,13 @@ def chat():
         if not query:
             return jsonify({'response': 'Per favore, scrivi una domanda.'})
 
-        if query.lower() == "apertura ticket":
-            bot.awaiting_ticket_field = 0
-            bot.ticket_data = {}
-            first_field = bot.ticket_fields[0]
-            return jsonify({
-                'response': f"📬 Apertura ticket in corso.\nPer favore, indicami il tuo **{first_field}**:"
-            })
-
-        if bot.awaiting_ticket_field is not None:
-            current_index = bot.awaiting_ticket_field
-            field_name = bot.ticket_fields[current_index]
-            bot.ticket_data[field_name] = query
-
-            if current_index + 1 < len(bot.ticket_fields):
-                bot.awaiting_ticket_field += 1
-                next_field = bot.ticket_fields[bot.awaiting_ticket_field]
-                return jsonify({
-                    'response': f"✅ {field_name.capitalize()} registrato.\nOra, per favore, indicami: **{next_field}**"
-                })
-            else:
-                summary = "\n".join([f"• **{k.capitalize()}**: {v}" for k, v in bot.ticket_data.items()])
-                bot.invia_email_ticket_async(bot.ticket_data)
-                bot.awaiting_ticket_field = None
-                bot.ticket_data = {}
-                return jsonify({
-                    'response': (
-                        "✅ **Ticket compilato con successo!**\n\n"
-                        "Ecco i dati che hai fornito:\n\n"
-                        f"{summary}\n\n"
-                        "📬 Il team di supporto è stato notificato via email. "
-                        "Riceverai assistenza al più presto!\n\n"
-                        "Puoi continuare a chiedermi informazioni sui documenti."
-                    )
-                })
-
-        risposta = bot.query_con_groq(query)
+        metriche.inizia_richiesta()
+        with metriche.fase("richiesta_chat"):
+            id_sessione, sessione = sessione_corrente()
+            risposta = gestisci_ticket(query, sessione)
+            if risposta is None:
+                risposta = bot.query_con_groq(query, sessione=sessione)
+            bot.sessioni_chat.salva(id_sessione, sessione)
         return jsonify({'response': risposta})
 
     except Exception as e:
@@ -854,10 +3904,53 @@ def chat():
         return jsonify({'response': f"❌ Errore imprevisto: {str(e)}"}), 500
 
 
+def _evento_sse(tipo, testo):
+    return f"data: {json.dumps({'type': tipo, 'text': testo}, ensure_ascii=False)}\n\n"
+
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Come /chat, ma invia i token al browser via Server-Sent Events man mano che arrivano"""
+    query = (request.json or {}).get('message', '').strip()
+    id_sessione, sessione = sessione_corrente()
+
+    def genera():
+        metriche.inizia_richiesta()
+        inizio = time.perf_counter()
+        try:
+            if not query:
+                yield _evento_sse('done', 'Per favore, scrivi una domanda.')
+                return
+
+            risposta_ticket = gestisci_ticket(query, sessione)
+            if risposta_ticket is not None:
+                bot.sessioni_chat.salva(id_sessione, sessione)
+                yield _evento_sse('done', risposta_ticket)
+                return
+
+            for tipo, testo in bot.stream_query(query, sessione=sessione):
+                if tipo == 'done':
+                    bot.sessioni_chat.salva(id_sessione, sessione)
+                yield _evento_sse(tipo, testo)
+        except Exception as e:
+            print(f"🚨 Errore critico in /chat/stream: {e}")
+            yield _evento_sse('done', f"❌ Errore imprevisto: {str(e)}")
+        finally:
+            metriche.registra("richiesta_stream", time.perf_counter() - inizio)
+
+    return Response(
+        stream_with_context(genera()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/stats')
 def stats():
     try:
         stats_info = bot.get_stats()
+        if request.args.get('formato') == 'json':
+            return jsonify({'stats': stats_info, 'dettaglio': bot.get_stats_dettaglio()})
         return jsonify({'stats': stats_info})
     except Exception as e:
         return jsonify({'stats': f'❌ Errore: {str(e)}'})
@@ -866,7 +3959,9 @@ def stats():
 @app.route('/clear-history', methods=['POST'])
 def clear_history():
     try:
-        message = bot.cancella_cronologia()
+        id_sessione, sessione = sessione_corrente()
+        message = bot.cancella_cronologia(sessione)
+        bot.sessioni_chat.salva(id_sessione, sessione)
         return jsonify({'message': message})
     except Exception as e:
         return jsonify({'message': f'❌ Errore: {str(e)}'})
@@ -874,7 +3969,38 @@ def clear_history():
 
 @app.route('/health')
 def health():
-    return jsonify({'status': 'OK', 'message': 'Bot Sanità Toscana funzionante!'})
+    """Liveness: il processo risponde. La readiness è riportata a parte in 'ready'"""
+    return jsonify({
+        'status': 'OK',
+        'message': 'Bot Sanità Toscana funzionante!',
+        'live': True,
+        'ready': bot.avvio['pronto'],
+        'avvio': bot.avvio,
+        'import_ms': TEMPO_IMPORT_MS
+    })
+
+
+@app.route('/health/ready')
+def health_ready():
+    """Readiness: 503 finché il worker non ha completato il riscaldamento"""
+    return jsonify({'ready': bot.avvio['pronto'], 'avvio': bot.avvio}), 200 if bot.avvio['pronto'] else 503
+
+
+@app.route('/metrics')
+def metrics():
+    """Tempi per fase in formato testo Prometheus (per processo: ogni worker va letto a parte)"""
+    catalogo = bot.catalogo.riepilogo()
+    coda = bot.coda_ticket.stats()
+    registro = bot.registro.stats()
+    valori = {
+        'bot_pronto': int(bot.avvio['pronto']),
+        'bot_chunks': catalogo['chunks'],
+        'bot_coda_ticket_profondita': coda['profondita'],
+        'bot_coda_ticket_attesa_max_secondi': coda['attesa_max_s'],
+        'bot_registro_in_coda': registro['in_coda'],
+        'bot_registro_scartate': registro['scartate']
+    }
+    return Response(metriche.prometheus(valori), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/force-load')
@@ -904,6 +4030,81 @@ def force_load():
         }), 500
 
 
+# Cartella dei documenti caricabili via HTTP e token degli endpoint di amministrazione
+DOCUMENTS_ROOT = Bot.DOCUMENTS_ROOT
+
+
+def admin_autorizzato():
+    """Header 'Authorization: Bearer <ADMIN_TOKEN>' o 'X-Admin-Token'; senza ADMIN_TOKEN nessuno è autorizzato"""
+    atteso = os.environ.get("ADMIN_TOKEN")
+    if not atteso:
+        return False
+    token = request.headers.get('X-Admin-Token') or ''
+    autorizzazione = request.headers.get('Authorization', '')
+    if autorizzazione.startswith('Bearer '):
+        token = autorizzazione[len('Bearer '):]
+    return secrets.compare_digest(token.encode(), atteso.encode())
+
+
+@app.route('/tickets/coda')
+def tickets_coda():
+    """Profondità e stato della coda di invio dei ticket"""
+    return jsonify(bot.coda_ticket.stats())
+
+
+@app.route('/tickets/coda/riprova', methods=['POST'])
+def tickets_riprova():
+    """Rimette in coda i ticket finiti in dead letter"""
+    if not admin_autorizzato():
+        return jsonify({'status': 'error', 'message': 'Non autorizzato'}), 401
+    return jsonify({'riaccodati': bot.coda_ticket.riaccoda_dead(), 'coda': bot.coda_ticket.stats()})
+
+
+bulk_job = {'stato': 'inattivo', 'progresso': []}
+bulk_lock = threading.Lock()
+
+
+@app.route('/bulk-load', methods=['POST'])
+def bulk_load():
+    """Avvia in background il caricamento massivo di una cartella o di un glob dentro DOCUMENTS_ROOT"""
+    if not admin_autorizzato():
+        return jsonify({'status': 'error', 'message': 'Non autorizzato'}), 401
+    percorso = (request.get_json(silent=True) or {}).get('path') or request.form.get('path') or '.'
+    richiesto = os.path.realpath(os.path.join(DOCUMENTS_ROOT, percorso.lstrip("/")))
+    if os.path.commonpath([DOCUMENTS_ROOT, richiesto]) != DOCUMENTS_ROOT:
+        return jsonify({'status': 'error', 'message': f"Percorso fuori dalla cartella dei documenti: '{percorso}'"}), 400
+    with bulk_lock:
+        if bulk_job['stato'] == 'in_corso':
+            return jsonify({'status': 'error', 'message': 'Caricamento già in corso', 'job': bulk_job}), 409
+        file_list = bot.trova_file(percorso, radice=DOCUMENTS_ROOT)
+        if not file_list:
+            return jsonify({
+                'status': 'error',
+                'message': f"Nessun file .txt/.csv/.pdf trovato in '{percorso}'."
+            }), 404
+        bulk_job.clear()
+        bulk_job.update({'stato': 'in_corso', 'percorso': percorso, 'file_totali': len(file_list),
+                         'progresso': [], 'avviato': datetime.now().isoformat()})
+
+    def _esegui():
+        try:
+            riepilogo = bot.carica_cartella(percorso, progresso=bulk_job['progresso'].append, radice=DOCUMENTS_ROOT)
+            bulk_job.update({'stato': 'completato', 'riepilogo': riepilogo})
+        except Exception as e:
+            bulk_job.update({'stato': 'errore', 'message': str(e)})
+        bulk_job['terminato'] = datetime.now().isoformat()
+
+    thread = threading.Thread(target=_esegui)
+    thread.daemon = True
+    thread.start()
+    return jsonify({'status': 'started', 'job': bulk_job}), 202
+
+
+@app.route('/bulk-load/status')
+def bulk_load_status():
+    return jsonify(bulk_job)
+
+
 @app.route('/debug')
 def debug():
     try:
@@ -918,6 +4119,18 @@ def debug():
             'csv_trovati': csv_files,
             'pdf_trovati': pdf_files,
             'statistiche_db': stats,
+            'statistiche_dettaglio': bot.get_stats_dettaglio(),
+            'cache_embedding': bot.embedding_cache.stats(),
+            'embedding_backend': bot.embedding_function.stats(),
+            'cache_risposte': bot.answer_cache.stats(),
+            'contesto': bot.contesto.stats(),
+            'reranker': bot.reranker.stats() if bot.reranker is not None else None,
+            'sessioni': bot.sessioni_chat.stats(),
+            'coda_ticket': bot.coda_ticket.stats(),
+            'registro_interazioni': bot.registro.stats(),
+            'collection': bot.documenti.stats(),
+            'validazione': bot.validazione.stats(),
+            'tempi_fasi': metriche.riepilogo(),
             'directory_corrente': os.getcwd(),
             'documento_txt_esiste': os.path.exists('documento.txt')
         })
@@ -0,0 +1,311 @@
+# benchmark.py
+"""Benchmark offline del retrieval: qualità (recall@k, MRR), latenza per fase, throughput e costo
+del caricamento, sul corpus incluso e su un corpus sintetico N volte più grande.
+
+Ogni scenario gira in un processo separato dentro una cartella temporanea (la db/ del progetto non
+viene toccata) e il modello LLM è sostituito da una risposta fissa. I risultati sono salvati in
+JSON per confrontare le esecuzioni nel tempo (--confronta)."""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+CARTELLA_PROGETTO = os.path.dirname(os.path.abspath(__file__))
+K_RECALL = (1, 3, 5)
+
+
+class LLMFinto:
+    """Al posto di GroqClient: nessuna rete, risposta fissa dopo `latenza` secondi"""
+
+    api_key = "benchmark"
+    RISPOSTA = "Secondo i documenti disponibili, queste sono le indicazioni da seguire."
+
+    def __init__(self, latenza=0.0):
+        self.latenza = latenza
+
+    def chat(self, messages, timeout=None, **params):
+        time.sleep(self.latenza)
+        if "VERIFICA RISPOSTA" in messages[-1]["content"]:
+            return "VALIDA"
+        return self.RISPOSTA
+
+    def stream_chat(self, messages, timeout=None, **params):
+        for parola in self.chat(messages, timeout=timeout, **params).split(" "):
+            yield parola + " "
+
+
+def carica_domande(path, log=None, max_log=200):
+    """Domande nel formato di interaction_log.jsonl; 'sezioni_attese' (numeri di sezione di
+    documento.txt) le rende valutabili, le altre contano solo per latenza e throughput"""
+    domande = []
+    with open(path, encoding='utf-8') as f:
+        domande.extend(json.loads(riga) for riga in f if riga.strip())
+    if log and os.path.exists(log):
+        viste = {d["domanda"] for d in domande}
+        aggiunte = 0
+        with open(log, encoding='utf-8') as f:
+            for riga in f:
+                if aggiunte >= max_log:
+                    break
+                voce = json.loads(riga)
+                if voce.get("domanda") and voce["domanda"] not in viste:
+                    viste.add(voce["domanda"])
+                    domande.append({"timestamp": voce.get("timestamp"), "domanda": voce["domanda"]})
+                    aggiunte += 1
+    return domande
+
+
+def genera_corpus(corpus, cartella, scala):
+    """Copie del corpus con ogni riga marcata dalla copia: le sezioni restano quelle originali,
+    ma i chunk cambiano contenuto (nessun riuso dalla cache degli embedding)"""
+    os.makedirs(cartella, exist_ok=True)
+    with open(corpus, encoding='utf-8') as f:
+        righe = f.read().splitlines()
+    base, estensione = os.path.splitext(os.path.basename(corpus))
+    for copia in range(scala):
+        marcate = righe if copia == 0 else [f"{riga} (c{copia})" if riga.strip() else riga for riga in righe]
+        with open(os.path.join(cartella, f"{base}_{copia:03d}{estensione}"), 'w', encoding='utf-8') as f:
+            f.write("\n".join(marcate) + "\n")
+    return cartella
+
+
+def offset_sezioni(testo, indice_sezioni):
+    """[(inizio, numero)] delle sezioni riconosciute da IndiceSezioni.analizza"""
+    sezioni = []
+    ultimo_numero = 0
+    posizione = 0
+    for riga in testo.splitlines(keepends=True):
+        header = indice_sezioni.HEADER.match(riga.rstrip("\r\n"))
+        if header and ultimo_numero < int(header.group(1)) <= ultimo_numero + indice_sezioni.SALTO_MAX:
+            ultimo_numero = int(header.group(1))
+            sezioni.append((posizione, header.group(1)))
+        posizione += len(riga)
+    return sezioni
+
+
+def sezioni_chunk(doc, offset):
+    """Numeri delle sezioni coperte da un chunk TXT (dagli offset nei metadati)"""
+    metadata = doc["metadata"]
+    sezioni = offset.get(metadata.get("source"))
+    if not sezioni or "char_start" not in metadata:
+        return set()
+    trovate = set()
+    for i, (inizio, numero) in enumerate(sezioni):
+        fine = sezioni[i + 1][0] if i + 1 < len(sezioni) else float("inf")
+        if inizio < metadata["char_end"] and metadata["char_start"] < fine:
+            trovate.add(numero)
+    return trovate
+
+
+def _rss_picco_mb(chi):
+    # ru_maxrss è in KB su Linux
+    return round(resource.getrusage(chi).ru_maxrss / 1024, 1)
+
+
+def esegui_scenario(cartella_corpus, domande, cartella_lavoro, k=10, thread=4, ripetizioni=3, latenza_llm=0.0):
+    """Caricamento, domande con LLM finto e throughput del retrieval, in un processo dedicato"""
+    # Un processo avviato con spawn lo usa anche per i propri figli: i worker di caricamento
+    # tornano al fork, come in produzione (altrimenti ognuno reimporterebbe app.py)
+    multiprocessing.set_start_method("fork", force=True)
+    os.chdir(cartella_lavoro)
+    os.environ["WARMUP_IN_BACKGROUND"] = "0"
+    sys.path.insert(0, CARTELLA_PROGETTO)
+
+    inizio = time.perf_counter()
+    import app
+    import_s = time.perf_counter() - inizio
+    bot = app.bot
+    bot.llm = LLMFinto(latenza_llm)
+
+    # Caricamento
+    inizio = time.perf_counter()
+    riepilogo = bot.carica_cartella(cartella_corpus, riprendi=False)
+    caricamento_s = time.perf_counter() - inizio
+    chunks = sum(riepilogo["caricati"].values())
+    fasi_caricamento = {nome: voce for nome, voce in app.metriche.riepilogo().items() if nome.startswith("ingest_")}
+
+    offset = {}
+    caratteri = 0
+    for nome in os.listdir(cartella_corpus):
+        with open(os.path.join(cartella_corpus, nome), encoding='utf-8') as f:
+            testo = f.read()
+        caratteri += len(testo)
+        offset[nome] = offset_sezioni(testo, app.IndiceSezioni)
+
+    # Pipeline completa (cache fredde): latenza per fase ed end-to-end
+    end_to_end = app.Metriche()
+    inizio = time.perf_counter()
+    for domanda in domande:
+        with end_to_end.fase("end_to_end"):
+            bot.query_con_groq(domanda["domanda"])
+    sequenziale_s = time.perf_counter() - inizio
+    fasi_query = {nome: voce for nome, voce in app.metriche.riepilogo().items() if not nome.startswith("ingest_")}
+
+    # Qualità del ranking
+    per_domanda = []
+    for domanda in domande:
+        attese = set(domanda.get("sezioni_attese") or [])
+        inizio = time.perf_counter()
+        docs = bot.enhanced_search(domanda["domanda"], n_results=k)
+        ms = (time.perf_counter() - inizio) * 1000
+        trovate = [sorted(sezioni_chunk(doc, offset)) for doc in docs]
+        rank = next((i + 1 for i, sezioni in enumerate(trovate) if attese & set(sezioni)), None)
+        per_domanda.append({
+            "domanda": domanda["domanda"],
+            "sezioni_attese": sorted(attese),
+            "sezioni_trovate": trovate,
+            "rank": rank,
+            "ms": round(ms, 2)
+        })
+
+    valutate = [voce for voce in per_domanda if voce["sezioni_attese"]]
+    qualita = {"domande": len(valutate)}
+    for soglia in sorted(set(K_RECALL + (k,))):
+        richiamo = [
+            len(set(voce["sezioni_attese"]) & {s for sezioni in voce["sezioni_trovate"][:soglia] for s in sezioni})
+            / len(voce["sezioni_attese"])
+            for voce in valutate
+        ]
+        qualita[f"recall@{soglia}"] = round(sum(richiamo) / len(valutate), 4) if valutate else None
+    qualita["mrr"] = round(sum(1 / voce["rank"] for voce in valutate if voce["rank"]) / len(valutate), 4) \
+        if valutate else None
+
+    # Throughput del solo retrieval a cache calde, con più thread
+    testi = [domanda["domanda"] for domanda in domande] * ripetizioni
+    inizio = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread) as executor:
+        list(executor.map(lambda testo: bot.enhanced_search(testo, n_results=k), testi))
+    retrieval_s = time.perf_counter() - inizio
+
+    bot.registro.chiudi()
+    return {
+        "corpus": {"file": len(offset), "caratteri": caratteri, "chunks": chunks},
+        "import_s": round(import_s, 3),
+        "caricamento": {
+            "secondi": round(caricamento_s, 2),
+            "chunks_al_secondo": round(chunks / caricamento_s, 1) if caricamento_s else None,
+            "errori": riepilogo["errori"],
+            "rss_picco_mb": _rss_picco_mb(resource.RUSAGE_SELF),
+            "rss_picco_worker_mb": _rss_picco_mb(resource.RUSAGE_CHILDREN),
+            "fasi": fasi_caricamento
+        },
+        "qualita": qualita,
+        "latenza": {"end_to_end": end_to_end.riepilogo()["end_to_end"], "fasi": fasi_query},
+        "throughput": {
+            "sequenziale_qps": round(len(domande) / sequenziale_s, 2),
+            "retrieval_qps": round(len(testi) / retrieval_s, 2),
+            "thread": thread
+        },
+        "per_domanda": per_domanda
+    }
+
+
+def revisione_git():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=CARTELLA_PROGETTO,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+INDICATORI = (
+    ("qualita", "recall@5"), ("qualita", "mrr"),
+    ("caricamento", "secondi"), ("caricamento", "rss_picco_mb"),
+    ("throughput", "sequenziale_qps"), ("throughput", "retrieval_qps"),
+    ("latenza", "end_to_end", "p95")
+)
+
+
+def confronta(precedente, attuale):
+    print(f"📊 Confronto con {precedente.get('revisione')} del {precedente.get('data')}")
+    for nome, scenario in attuale["scenari"].items():
+        vecchio = precedente["scenari"].get(nome)
+        if vecchio is None:
+            continue
+        print(f"  {nome}")
+        for percorso in INDICATORI:
+            prima, dopo = vecchio, scenario
+            for chiave in percorso:
+                prima = (prima or {}).get(chiave)
+                dopo = (dopo or {}).get(chiave)
+            if prima is None or dopo is None:
+                continue
+            print(f"    {'.'.join(percorso)}: {prima} → {dopo} ({dopo - prima:+.4g})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark offline di qualità e latenza del retrieval")
+    parser.add_argument("--corpus", default=os.path.join(CARTELLA_PROGETTO, "documento.txt"))
+    parser.add_argument("--domande", default=os.path.join(CARTELLA_PROGETTO, "benchmark_domande.jsonl"),
+                        help="JSONL nel formato di interaction_log.jsonl, con 'sezioni_attese'")
+    parser.add_argument("--log", default=None, help="aggiunge (senza etichette) le domande di un interaction_log.jsonl")
+    parser.add_argument("--k", type=int, default=10, help="chunk recuperati per domanda")
+    parser.add_argument("--scala", type=int, default=100, help="fattore del corpus sintetico (0 = solo corpus incluso)")
+    parser.add_argument("--thread", type=int, default=4, help="thread per la misura del throughput")
+    parser.add_argument("--ripetizioni", type=int, default=3, help="passate delle domande per il throughput")
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--overlap", type=int, default=None)
+    parser.add_argument("--latenza-llm", type=float, default=0.0, help="secondi di attesa del LLM finto")
+    parser.add_argument("--output", default=None, help="file JSON dei risultati")
+    parser.add_argument("--confronta", default=None, help="risultati JSON di un'esecuzione precedente")
+    args = parser.parse_args()
+
+    # Ereditate dai processi degli scenari e dai loro worker di caricamento
+    if args.chunk_size:
+        os.environ["CHUNK_SIZE"] = str(args.chunk_size)
+    if args.overlap is not None:
+        os.environ["CHUNK_OVERLAP"] = str(args.overlap)
+
+    domande = carica_domande(args.domande, log=args.log)
+    scenari = {"base": 1}
+    if args.scala > 1:
+        scenari[f"sintetico_{args.scala}x"] = args.scala
+
+    risultati = {
+        "data": datetime.now().isoformat(),
+        "revisione": revisione_git(),
+        "parametri": {
+            "k": args.k, "thread": args.thread, "ripetizioni": args.ripetizioni,
+            "chunk_size": int(os.environ.get("CHUNK_SIZE", 800)),
+            "overlap": int(os.environ.get("CHUNK_OVERLAP", 150)),
+            "latenza_llm": args.latenza_llm, "domande": len(domande)
+        },
+        "scenari": {}
+    }
+    contesto = multiprocessing.get_context("spawn")
+    for nome, scala in scenari.items():
+        cartella_lavoro = tempfile.mkdtemp(prefix="benchmark_")
+        try:
+            cartella_corpus = genera_corpus(args.corpus, os.path.join(cartella_lavoro, "corpus"), scala)
+            print(f"⏱️ Scenario {nome}: {scala} copie di {os.path.basename(args.corpus)}, {len(domande)} domande")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=contesto) as executor:
+                esito = executor.submit(esegui_scenario, cartella_corpus, domande, cartella_lavoro, k=args.k,
+                                        thread=args.thread, ripetizioni=args.ripetizioni,
+                                        latenza_llm=args.latenza_llm).result()
+        finally:
+            shutil.rmtree(cartella_lavoro, ignore_errors=True)
+        risultati["scenari"][nome] = esito
+        print(f"✅ {nome}: {esito['corpus']['chunks']} chunks in {esito['caricamento']['secondi']}s "
+              f"(picco {esito['caricamento']['rss_picco_mb']} MB), "
+              f"recall@5 {esito['qualita']['recall@5']}, MRR {esito['qualita']['mrr']}, "
+              f"p95 {esito['latenza']['end_to_end']['p95'] * 1000:.1f} ms, "
+              f"{esito['throughput']['retrieval_qps']} query/s di retrieval")
+
+    output = args.output or os.path.join(CARTELLA_PROGETTO, "benchmark_risultati",
+                                         f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(risultati, f, ensure_ascii=False, indent=2)
+    print(f"💾 Risultati salvati in {output}")
+
+    if args.confronta:
+        with open(args.confronta, encoding='utf-8') as f:
+            confronta(json.load(f), risultati)
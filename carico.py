@@ -0,0 +1,319 @@
+# carico.py
+"""Test di carico: avvia gunicorn con LLM e SendGrid finti (mock_servizi.py) per ogni
+configurazione workers x thread e invia sessioni concorrenti a un ritmo obiettivo (RPS).
+
+Le sessioni sono domande semplici oppure flussi completi di "apertura ticket"; per ogni
+configurazione si riportano throughput, percentili di latenza e tasso di errore."""
+import argparse
+import json
+import os
+import random
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import httpx
+
+import mock_servizi
+
+CARTELLA_PROGETTO = os.path.dirname(os.path.abspath(__file__))
+QUANTILI = (0.5, 0.95, 0.99)
+
+
+def riepilogo_latenze(durate):
+    if not durate:
+        return None
+    ordinate = sorted(durate)
+    riepilogo = {f"p{int(q * 100)}": round(ordinate[min(int(q * len(ordinate)), len(ordinate) - 1)], 4)
+                 for q in QUANTILI}
+    riepilogo["media"] = round(sum(ordinate) / len(ordinate), 4)
+    riepilogo["max"] = round(ordinate[-1], 4)
+    return riepilogo
+
+
+class Pianificatore:
+    """Distribuisce le richieste a intervalli regolari (1/rps) fino alla scadenza"""
+
+    def __init__(self, rps, durata):
+        self.intervallo = 1 / rps
+        self.fine = time.monotonic() + durata
+        self.prossimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def attendi(self):
+        """Attende il proprio turno; False se il test è finito"""
+        with self._lock:
+            turno = self.prossimo
+            self.prossimo += self.intervallo
+        if turno >= self.fine:
+            return False
+        attesa = turno - time.monotonic()
+        if attesa > 0:
+            time.sleep(attesa)
+        return True
+
+
+class Esito:
+    """Richieste completate, raccolte da tutti i thread del driver"""
+
+    def __init__(self):
+        self.richieste = []
+        self.ticket_completati = 0
+        self._lock = threading.Lock()
+
+    def registra(self, tipo, durata, errore=None, primo_token=None):
+        with self._lock:
+            self.richieste.append({"tipo": tipo, "durata": durata, "errore": errore, "primo_token": primo_token})
+
+    def ticket_completato(self):
+        with self._lock:
+            self.ticket_completati += 1
+
+
+class Driver:
+    def __init__(self, url, domande, rps, durata, concorrenza, quota_ticket=0.2, stream=False, timeout=60):
+        self.url = url.rstrip("/")
+        self.domande = domande
+        self.pianificatore = Pianificatore(rps, durata)
+        self.concorrenza = concorrenza
+        self.quota_ticket = quota_ticket
+        self.stream = stream
+        self.esito = Esito()
+        self.client = httpx.Client(timeout=timeout, limits=httpx.Limits(max_connections=concorrenza))
+
+    def _invia(self, tipo, sessione, messaggio):
+        """Una richiesta /chat (o /chat/stream): testo della risposta, None in caso di errore"""
+        if not self.pianificatore.attendi():
+            return None
+        headers = {"X-Session-Id": sessione}
+        inizio = time.perf_counter()
+        try:
+            if self.stream and tipo == "domanda":
+                return self._invia_stream(inizio, headers, messaggio)
+            risposta = self.client.post(f"{self.url}/chat", json={"message": messaggio}, headers=headers)
+            durata = time.perf_counter() - inizio
+            if risposta.status_code != 200:
+                self.esito.registra(tipo, durata, errore=f"http_{risposta.status_code}")
+                return None
+            testo = risposta.json()["response"]
+            self.esito.registra(tipo, durata, errore="applicativo" if testo.startswith("❌") else None)
+            return testo
+        except httpx.HTTPError as e:
+            self.esito.registra(tipo, time.perf_counter() - inizio, errore=type(e).__name__)
+            return None
+
+    def _invia_stream(self, inizio, headers, messaggio):
+        primo_token = None
+        testo = None
+        with self.client.stream("POST", f"{self.url}/chat/stream", json={"message": messaggio},
+                                headers=headers) as risposta:
+            if risposta.status_code != 200:
+                self.esito.registra("domanda", time.perf_counter() - inizio, errore=f"http_{risposta.status_code}")
+                return None
+            for riga in risposta.iter_lines():
+                if not riga.startswith("data: "):
+                    continue
+                if primo_token is None:
+                    primo_token = time.perf_counter() - inizio
+                evento = json.loads(riga[6:])
+                if evento["type"] == "done":
+                    testo = evento["text"]
+        durata = time.perf_counter() - inizio
+        errore = "incompleta" if testo is None else ("applicativo" if testo.startswith("❌") else None)
+        self.esito.registra("domanda", durata, errore=errore, primo_token=primo_token)
+        return testo
+
+    def _sessione_ticket(self, sessione):
+        testo = self._invia("ticket", sessione, "apertura ticket")
+        # Un valore per ogni campo richiesto, finché il bot non conferma il ticket
+        for campo in range(10):
+            if testo is None:
+                return
+            if "Ticket compilato" in testo:
+                self.esito.ticket_completato()
+                return
+            testo = self._invia("ticket", sessione, f"valore di prova {campo} ({sessione})")
+
+    def _lavora(self):
+        while time.monotonic() < self.pianificatore.fine:
+            sessione = secrets.token_hex(8)
+            if random.random() < self.quota_ticket:
+                self._sessione_ticket(sessione)
+            else:
+                self._invia("domanda", sessione, random.choice(self.domande))
+
+    def esegui(self):
+        inizio = time.perf_counter()
+        threads = [threading.Thread(target=self._lavora, daemon=True) for _ in range(self.concorrenza)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        durata = time.perf_counter() - inizio
+        self.client.close()
+        return durata
+
+    def rapporto(self, durata):
+        richieste = self.esito.richieste
+        errori = {}
+        for richiesta in richieste:
+            if richiesta["errore"]:
+                errori[richiesta["errore"]] = errori.get(richiesta["errore"], 0) + 1
+        latenze = {"tutte": riepilogo_latenze([r["durata"] for r in richieste if not r["errore"]])}
+        for tipo in ("domanda", "ticket"):
+            latenze[tipo] = riepilogo_latenze([r["durata"] for r in richieste if r["tipo"] == tipo and not r["errore"]])
+        return {
+            "richieste": len(richieste),
+            "durata_s": round(durata, 2),
+            "rps_effettivo": round(len(richieste) / durata, 2) if durata else None,
+            "errori": sum(errori.values()),
+            "tasso_errori": round(sum(errori.values()) / len(richieste), 4) if richieste else None,
+            "errori_per_tipo": errori,
+            "latenza_s": latenze,
+            "primo_token_s": riepilogo_latenze([r["primo_token"] for r in richieste if r["primo_token"] is not None]),
+            "ticket_completati": self.esito.ticket_completati
+        }
+
+
+def attendi_pronto(url, processo, timeout):
+    """Attende /health/ready (i worker gunicorn accettano connessioni solo dopo il riscaldamento)"""
+    scadenza = time.monotonic() + timeout
+    while time.monotonic() < scadenza:
+        if processo is not None and processo.poll() is not None:
+            raise RuntimeError(f"gunicorn terminato con codice {processo.returncode}")
+        try:
+            if httpx.get(f"{url}/health/ready", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"server non pronto entro {timeout}s")
+
+
+def avvia_gunicorn(workers, thread, porta, url_mock, cartella_stato, cache_risposte):
+    env = dict(os.environ)
+    env.update({
+        "WEB_CONCURRENCY": str(workers),
+        "GUNICORN_THREADS": str(thread),
+        "PORT": str(porta),
+        "GROQ_BASE_URL": f"{url_mock}/openai/v1",
+        "GROQ_API_KEY": "carico",
+        "SENDGRID_URL": f"{url_mock}/v3/mail/send",
+        "SENDGRID_API_KEY": "carico",
+        # Code, log e cache in una cartella temporanea: nessun effetto sui file del progetto
+        "TICKET_QUEUE_PATH": os.path.join(cartella_stato, "ticket_queue.sqlite3"),
+        "INTERACTION_LOG_PATH": os.path.join(cartella_stato, "interaction_log.jsonl"),
+        "SESSION_DB_PATH": os.path.join(cartella_stato, "sessioni.sqlite3"),
+        "ANSWER_CACHE_PATH": os.path.join(cartella_stato, "answer_cache.sqlite3"),
+    })
+    # Sessioni condivise tra i worker: il flusso ticket passa da un worker all'altro
+    env.setdefault("SESSION_BACKEND", "sqlite")
+    if not cache_risposte:
+        env["ANSWER_CACHE_TTL"] = "0"
+    return subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+                            cwd=CARTELLA_PROGETTO, env=env)
+
+
+def email_ricevute(url_mock):
+    return httpx.get(f"{url_mock}/stats", timeout=5).json()["email"]
+
+
+def attendi_email(url_mock, attese, timeout=30):
+    """Le email dei ticket partono in background dalla coda: si attende che arrivino tutte"""
+    scadenza = time.monotonic() + timeout
+    while email_ricevute(url_mock) < attese and time.monotonic() < scadenza:
+        time.sleep(0.5)
+    return email_ricevute(url_mock)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Test di carico del bot con LLM e SendGrid finti")
+    parser.add_argument("--configurazioni", default="1x4",
+                        help="configurazioni gunicorn workers x thread separate da virgola (es. 1x4,2x4,4x8)")
+    parser.add_argument("--url", default=None, help="server già avviato (le configurazioni vengono ignorate)")
+    parser.add_argument("--porta", type=int, default=5099, help="porta dei server gunicorn avviati dal driver")
+    parser.add_argument("--rps", type=float, default=5.0, help="richieste al secondo obiettivo")
+    parser.add_argument("--durata", type=float, default=30.0, help="secondi di carico per configurazione")
+    parser.add_argument("--concorrenza", type=int, default=32, help="sessioni contemporanee al massimo")
+    parser.add_argument("--quota-ticket", type=float, default=0.2, help="frazione di sessioni 'apertura ticket'")
+    parser.add_argument("--stream", action="store_true", help="domande su /chat/stream (misura il primo token)")
+    parser.add_argument("--domande", default=os.path.join(CARTELLA_PROGETTO, "benchmark_domande.jsonl"))
+    parser.add_argument("--cache-risposte", action="store_true", help="lascia attiva la cache delle risposte")
+    parser.add_argument("--attesa-avvio", type=float, default=180.0, help="secondi massimi per l'avvio di gunicorn")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout delle richieste del driver")
+    parser.add_argument("--mock-url", default=None, help="servizi finti già avviati (mock_servizi.py)")
+    parser.add_argument("--porta-mock", type=int, default=8099)
+    parser.add_argument("--latenza-llm", type=float, default=0.3)
+    parser.add_argument("--token-al-secondo", type=float, default=50.0)
+    parser.add_argument("--token", type=int, default=120)
+    parser.add_argument("--errori-llm", type=float, default=0.0)
+    parser.add_argument("--latenza-sendgrid", type=float, default=0.05)
+    parser.add_argument("--errori-sendgrid", type=float, default=0.0)
+    parser.add_argument("--output", default=None, help="file JSON dei risultati")
+    args = parser.parse_args()
+
+    with open(args.domande, encoding='utf-8') as f:
+        domande = [json.loads(riga)["domanda"] for riga in f if riga.strip()]
+
+    url_mock = args.mock_url
+    if url_mock is None:
+        mock_servizi.avvia(porta=args.porta_mock, latenza=args.latenza_llm,
+                           token_al_secondo=args.token_al_secondo, token=args.token,
+                           errori_llm=args.errori_llm, latenza_sendgrid=args.latenza_sendgrid,
+                           errori_sendgrid=args.errori_sendgrid)
+        url_mock = f"http://127.0.0.1:{args.porta_mock}"
+    url_mock = url_mock.rstrip("/")
+
+    if args.url:
+        configurazioni = [("esterna", None, None)]
+    else:
+        configurazioni = []
+        for voce in args.configurazioni.split(","):
+            workers, thread = (int(x) for x in voce.lower().split("x"))
+            configurazioni.append((voce, workers, thread))
+
+    risultati = {
+        "data": datetime.now().isoformat(),
+        "parametri": {k: v for k, v in vars(args).items() if k not in ("output", "url", "mock_url")},
+        "configurazioni": {}
+    }
+    for nome, workers, thread in configurazioni:
+        processo = None
+        cartella_stato = tempfile.mkdtemp(prefix="carico_")
+        url = args.url or f"http://127.0.0.1:{args.porta}"
+        try:
+            if workers is not None:
+                print(f"🚀 Avvio gunicorn con {workers} worker x {thread} thread...")
+                processo = avvia_gunicorn(workers, thread, args.porta, url_mock, cartella_stato, args.cache_risposte)
+            attendi_pronto(url, processo, args.attesa_avvio)
+
+            email_prima = email_ricevute(url_mock)
+            print(f"⏱️ {nome}: {args.rps} RPS per {args.durata}s, {args.concorrenza} sessioni, "
+                  f"{args.quota_ticket:.0%} ticket")
+            driver = Driver(url, domande, args.rps, args.durata, args.concorrenza,
+                            quota_ticket=args.quota_ticket, stream=args.stream, timeout=args.timeout)
+            rapporto = driver.rapporto(driver.esegui())
+            rapporto["email_ricevute"] = attendi_email(url_mock, email_prima + rapporto["ticket_completati"]) \
+                - email_prima
+        finally:
+            if processo is not None:
+                processo.terminate()
+                processo.wait(timeout=60)
+            shutil.rmtree(cartella_stato, ignore_errors=True)
+
+        risultati["configurazioni"][nome] = {"workers": workers, "thread": thread, **rapporto}
+        latenza = rapporto["latenza_s"]["tutte"] or {}
+        print(f"✅ {nome}: {rapporto['rps_effettivo']} RPS, p50 {latenza.get('p50')}s, p95 {latenza.get('p95')}s, "
+              f"p99 {latenza.get('p99')}s, errori {rapporto['tasso_errori'] or 0:.1%}, "
+              f"ticket {rapporto['ticket_completati']} (email {rapporto['email_ricevute']})")
+
+    output = args.output or os.path.join(CARTELLA_PROGETTO, "carico_risultati", f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(risultati, f, ensure_ascii=False, indent=2)
+    print(f"💾 Risultati salvati in {output}")
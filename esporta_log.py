@@ -0,0 +1,16 @@
+# esporta_log.py
+import argparse
+import os
+
+# Solo esportazione: nessun riscaldamento del server
+os.environ.setdefault("WARMUP_IN_BACKGROUND", "0")
+
+from app import bot
+
+parser = argparse.ArgumentParser(description="Esporta il log delle interazioni in formato colonnare")
+parser.add_argument("destinazione", nargs="?", default="interazioni.npz",
+                    help="file .parquet (richiede pyarrow) oppure .npz")
+args = parser.parse_args()
+
+righe = bot.registro.esporta(args.destinazione)
+print(f"✅ Esportate {righe} interazioni in {args.destinazione}")
@@ -0,0 +1,28 @@
+# gunicorn.conf.py
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# Con più worker serve uno stato delle sessioni condiviso (SESSION_BACKEND=sqlite o redis)
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+
+# app.py (solo i moduli: nessun indice, modello o connessione) viene importato una volta sola
+# nel master e condiviso con i worker; indici BM25/sezioni, modello e connessioni si caricano
+# in ogni worker, durante il riscaldamento (post_worker_init)
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+# Niente riscaldamento all'import: lo fa ogni worker in post_worker_init
+os.environ["WARMUP_IN_BACKGROUND"] = "0"
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app import bot
+        bot.dopo_fork()
+
+
+def post_worker_init(worker):
+    # Il worker inizia ad accettare connessioni solo al termine: nessuna richiesta "a freddo"
+    from app import bot
+    bot.riscalda()
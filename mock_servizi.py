@@ -0,0 +1,161 @@
+# mock_servizi.py
+"""Servizi esterni finti per i test di carico: LLM compatibile chat-completions (come Groq) e SendGrid.
+
+Il bot si collega con:
+    GROQ_BASE_URL=http://127.0.0.1:8099/openai/v1  GROQ_API_KEY=carico
+    SENDGRID_URL=http://127.0.0.1:8099/v3/mail/send  SENDGRID_API_KEY=carico
+GET /stats restituisce i contatori delle chiamate ricevute."""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PAROLE = ("Secondo i documenti disponibili la procedura prevede di aprire un ticket indicando "
+          "nome cognome reparto e ubicazione e di inoltrare la richiesta al referente competente "
+          "tramite email allegando le informazioni necessarie per la verifica").split()
+
+
+class ServiziFinti(ThreadingHTTPServer):
+    """Server HTTP con i parametri di latenza ed errore e i contatori delle chiamate"""
+
+    daemon_threads = True
+
+    def __init__(self, indirizzo, latenza=0.3, token_al_secondo=50.0, token=120, errori_llm=0.0,
+                 latenza_sendgrid=0.05, errori_sendgrid=0.0):
+        super().__init__(indirizzo, GestoreRichieste)
+        self.latenza = latenza
+        self.token_al_secondo = token_al_secondo
+        self.token = token
+        self.errori_llm = errori_llm
+        self.latenza_sendgrid = latenza_sendgrid
+        self.errori_sendgrid = errori_sendgrid
+        self.contatori = {"llm": 0, "llm_stream": 0, "llm_errori": 0, "email": 0, "email_errori": 0}
+        self._lock = threading.Lock()
+
+    def conta(self, chiave):
+        with self._lock:
+            self.contatori[chiave] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.contatori)
+
+    def risposta(self, max_tokens):
+        n = min(self.token, max_tokens or self.token)
+        return [parola + " " for parola in itertools.islice(itertools.cycle(PAROLE), n)]
+
+
+class GestoreRichieste(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, stato, dati):
+        corpo = json.dumps(dati).encode()
+        self.send_response(stato)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _vuota(self, stato):
+        self.send_response(stato)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _chunk(self, testo):
+        dati = testo.encode()
+        self.wfile.write(f"{len(dati):x}\r\n".encode() + dati + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._json(200, self.server.stats())
+        else:
+            self._vuota(404)
+
+    def do_POST(self):
+        corpo = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("/chat/completions"):
+            self._llm(corpo)
+        elif self.path.endswith("/mail/send"):
+            self._sendgrid()
+        else:
+            self._vuota(404)
+
+    def _llm(self, corpo):
+        server = self.server
+        time.sleep(server.latenza)
+        if random.random() < server.errori_llm:
+            server.conta("llm_errori")
+            self._vuota(503)
+            return
+        messaggio = corpo["messages"][-1]["content"]
+        # Le chiamate di validazione ricevono sempre esito positivo
+        token = ["VALIDA"] if "VERIFICA RISPOSTA" in messaggio else server.risposta(corpo.get("max_tokens"))
+        intervallo = 1 / server.token_al_secondo if server.token_al_secondo > 0 else 0
+
+        if not corpo.get("stream"):
+            server.conta("llm")
+            time.sleep(intervallo * len(token))
+            self._json(200, {
+                "choices": [{"message": {"role": "assistant", "content": "".join(token)}, "finish_reason": "stop"}],
+                "usage": {"completion_tokens": len(token)}
+            })
+            return
+
+        server.conta("llm_stream")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for parola in token:
+            time.sleep(intervallo)
+            self._chunk(f"data: {json.dumps({'choices': [{'delta': {'content': parola}}]})}\n\n")
+        self._chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _sendgrid(self):
+        server = self.server
+        time.sleep(server.latenza_sendgrid)
+        if random.random() < server.errori_sendgrid:
+            server.conta("email_errori")
+            self._vuota(503)
+            return
+        server.conta("email")
+        self._vuota(202)
+
+
+def avvia(host="127.0.0.1", porta=8099, **parametri):
+    """Avvia i servizi finti in un thread e restituisce il server (server.shutdown() per fermarlo)"""
+    server = ServiziFinti((host, porta), **parametri)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="LLM e SendGrid finti per i test di carico")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=8099)
+    parser.add_argument("--latenza", type=float, default=0.3, help="secondi prima del primo token")
+    parser.add_argument("--token-al-secondo", type=float, default=50.0, help="velocità di generazione (0 = istantanea)")
+    parser.add_argument("--token", type=int, default=120, help="token per risposta")
+    parser.add_argument("--errori-llm", type=float, default=0.0, help="frazione di risposte 503 del LLM")
+    parser.add_argument("--latenza-sendgrid", type=float, default=0.05)
+    parser.add_argument("--errori-sendgrid", type=float, default=0.0, help="frazione di risposte 503 di SendGrid")
+    args = parser.parse_args()
+
+    server = ServiziFinti((args.host, args.porta), latenza=args.latenza, token_al_secondo=args.token_al_secondo,
+                          token=args.token, errori_llm=args.errori_llm, latenza_sendgrid=args.latenza_sendgrid,
+                          errori_sendgrid=args.errori_sendgrid)
+    print(f"🧪 Servizi finti su http://{args.host}:{args.porta}")
+    print(f"   GROQ_BASE_URL=http://{args.host}:{args.porta}/openai/v1 GROQ_API_KEY=carico")
+    print(f"   SENDGRID_URL=http://{args.host}:{args.porta}/v3/mail/send SENDGRID_API_KEY=carico")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,5 +1,24 @@
 # precarga.py
+import argparse
+import os
+
+# Solo caricamento: nessun riscaldamento del server
+os.environ.setdefault("WARMUP_IN_BACKGROUND", "0")
+
 from app import bot
-print("Caricamento documento.txt...")
-chunks = bot.carica_documento("documento.txt")
-print(f"✅ Precaricati {chunks} chunks nella cartella 'db/'")
\ No newline at end of file
+
+parser = argparse.ArgumentParser(description="Precarica documenti nella cartella 'db/'")
+parser.add_argument("percorsi", nargs="*", default=["documento.txt"],
+                    help="file, cartelle o glob (es. 'documenti/**/*.pdf')")
+parser.add_argument("--workers", type=int, default=None, help="processi per lettura e chunking")
+parser.add_argument("--da-capo", action="store_true", help="ignora il journal e ricarica tutto")
+args = parser.parse_args()
+
+for percorso in args.percorsi:
+    print(f"Caricamento {percorso}...")
+    riepilogo = bot.carica_cartella(percorso, workers=args.workers, riprendi=not args.da_capo)
+    chunks = sum(riepilogo['caricati'].values())
+    print(f"✅ Precaricati {chunks} chunks da {len(riepilogo['caricati'])} file nella cartella 'db/' "
+          f"({riepilogo['saltati']} già aggiornati)")
+    for file_path, errore in riepilogo['errori'].items():
+        print(f"❌ {file_path}: {errore}")
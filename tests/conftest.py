@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+RADICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RADICE)
+os.environ.setdefault("WARMUP_IN_BACKGROUND", "0")
+
+
+@pytest.fixture(autouse=True)
+def cartella_di_lavoro(tmp_path, monkeypatch):
+    """app.py usa percorsi relativi (db/, code SQLite, log): ogni test gira in una cartella sua"""
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """Modulo app, importato una volta: i file che il Bot crea all'import finiscono in una cartella temporanea"""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp("import"))
+        import app
+    return app
@@ -0,0 +1,31 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import RADICE
+
+
+def _importa_app():
+    """Import di app.py in un interprete nuovo, come fa il master gunicorn con preload_app"""
+    codice = (
+        "import json, sys, app; "
+        "print(json.dumps({'ms': app.TEMPO_IMPORT_MS, 'budget': app.IMPORT_BUDGET_MS, "
+        "'moduli': sorted(m for m in ('chromadb', 'onnxruntime') if m in sys.modules)}))"
+    )
+    ambiente = dict(os.environ, PYTHONPATH=RADICE, WARMUP_IN_BACKGROUND="0")
+    uscita = subprocess.run([sys.executable, "-c", codice], cwd=os.getcwd(), env=ambiente,
+                            capture_output=True, text=True, timeout=120, check=True)
+    return json.loads(uscita.stdout.strip().splitlines()[-1])
+
+
+def test_import_non_carica_chroma_ne_onnxruntime():
+    assert _importa_app()["moduli"] == []
+
+
+def test_tempo_di_import():
+    # IMPORT_BUDGET_MS è un obiettivo, non un limite: sulle macchine di CI i tempi variano molto,
+    # quindi si riporta il tempo misurato e si fallisce solo per regressioni grossolane
+    risultato = _importa_app()
+    print(f"import di app.py: {risultato['ms']} ms (budget {risultato['budget']} ms)")
+    assert risultato["ms"] <= 10 * risultato["budget"]
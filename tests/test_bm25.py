@@ -0,0 +1,44 @@
+import json
+
+
+def _indice(app, tmp_path):
+    return app.BM25Index(path=str(tmp_path / "bm25.json"))
+
+
+def test_aggiunte_e_rimozioni_sopravvivono_al_salvataggio(app, tmp_path):
+    indice = _indice(app, tmp_path)
+    indice.upsert(["a", "b", "c"], ["referente Pleiade Mario Rossi", "telefono Aurora 0577 586000",
+                                    "stampa etichette Aurora"])
+    indice.rimuovi(["b"], ["telefono Aurora 0577 586000"])
+    indice.salva()
+
+    riletto = _indice(app, tmp_path)
+    assert sorted(riletto.lunghezze) == ["a", "c"]
+    assert riletto.lunghezza_totale == indice.lunghezza_totale == sum(riletto.lunghezze.values())
+    assert riletto.search("0577") == []
+    assert [chunk_id for chunk_id, _ in riletto.search("aurora")] == ["c"]
+    assert all("b" not in posting for posting in riletto.postings.values())
+
+
+def test_rimozione_senza_testo_e_upsert_idempotente(app, tmp_path):
+    indice = _indice(app, tmp_path)
+    indice.upsert(["a", "b"], ["referente Pleiade", "referente Aurora"])
+    totale = indice.lunghezza_totale
+    indice.upsert(["a"], ["referente Pleiade"])
+    assert indice.lunghezza_totale == totale
+
+    indice.rimuovi(["a"])
+    indice.salva()
+    riletto = _indice(app, tmp_path)
+    assert sorted(riletto.lunghezze) == ["b"]
+    assert "pleiad" not in riletto.postings
+
+
+def test_formato_precedente_convertito(app, tmp_path):
+    (tmp_path / "bm25.json").write_text(json.dumps({
+        "docs": {"a": {"text": "referente Pleiade", "metadata": {}, "len": 2}},
+        "postings": {"referent": {"a": 1}, "pleiad": {"a": 1}}
+    }), encoding="utf-8")
+    indice = _indice(app, tmp_path)
+    assert indice.lunghezze == {"a": 2} and indice.lunghezza_totale == 2
+    assert [chunk_id for chunk_id, _ in indice.search("Pleiade")] == ["a"]
@@ -0,0 +1,88 @@
+import pytest
+
+pytest.importorskip("chromadb")
+
+
+def _sezione(numero, nome, variante=""):
+    righe = [f"{numero} {nome}", f"Referente: Operatore {nome.title()}", f"Telefono: 0577 {numero}00000"]
+    righe += [f"Istruzione {i} per l'applicativo {nome}: aprire il menu {i} e confermare{variante}."
+              for i in range(1, 9)]
+    return "\n".join(righe) + "\n"
+
+
+def _scrivi(percorso, *sezioni):
+    percorso.write_text("\n".join(sezioni), encoding="utf-8")
+
+
+@pytest.fixture
+def bot(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app.Bot, "DOCUMENTS_ROOT", str(tmp_path.resolve()))
+    bot = app.Bot()
+    bot.ricalcolati = []
+    embed = bot.embedding_function.embed
+
+    def conta(testi, **kwargs):
+        bot.ricalcolati.extend(testi)
+        return embed(testi, **kwargs)
+
+    monkeypatch.setattr(bot.embedding_function, "embed", conta)
+    return bot
+
+
+def _chunk(bot):
+    esistenti = bot.collection.get(include=["documents", "metadatas"])
+    return {chunk_id: (testo, metadata)
+            for chunk_id, testo, metadata in zip(esistenti["ids"], esistenti["documents"], esistenti["metadatas"])}
+
+
+def test_ricaricare_un_file_invariato_non_ricalcola_nulla(bot, tmp_path):
+    manuale = tmp_path / "manuale.txt"
+    _scrivi(manuale, _sezione(1, "ALFA"), _sezione(2, "BETA"), _sezione(3, "GAMMA"))
+    assert bot.carica_documento(str(manuale)) == 3
+    prima = _chunk(bot)
+    assert len(bot.ricalcolati) == 3
+    assert {metadata["source"] for _, metadata in prima.values()} == {"manuale.txt"}
+
+    bot.ricalcolati.clear()
+    assert bot.carica_documento(str(manuale)) == 3
+    assert bot.ricalcolati == []
+    assert _chunk(bot).keys() == prima.keys()
+
+
+def test_solo_i_chunk_modificati_vengono_ricalcolati(bot, tmp_path):
+    manuale = tmp_path / "manuale.txt"
+    _scrivi(manuale, _sezione(1, "ALFA"), _sezione(2, "BETA"), _sezione(3, "GAMMA"))
+    bot.carica_documento(str(manuale))
+    prima = _chunk(bot)
+
+    bot.ricalcolati.clear()
+    _scrivi(manuale, _sezione(1, "ALFA"), _sezione(2, "BETA", variante=" con la firma"), _sezione(3, "GAMMA"))
+    bot.carica_documento(str(manuale))
+    dopo = _chunk(bot)
+
+    assert len(bot.ricalcolati) == 1 and bot.ricalcolati[0].startswith("2 BETA")
+    assert len(dopo) == 3
+    assert len(prima.keys() & dopo.keys()) == 2
+    # Il BM25 segue la collection: il nuovo chunk è indicizzato, quello vecchio non più
+    assert len(bot.bm25) == 3
+    assert dopo[bot.bm25.search("firma")[0][0]][0].startswith("2 BETA")
+
+
+def test_chunk_rimossi_e_posizioni_aggiornate_senza_ricalcolo(bot, tmp_path):
+    manuale = tmp_path / "manuale.txt"
+    _scrivi(manuale, _sezione(1, "ALFA"), _sezione(2, "BETA"), _sezione(3, "GAMMA"))
+    bot.carica_documento(str(manuale))
+    prima = _chunk(bot)
+
+    bot.ricalcolati.clear()
+    _scrivi(manuale, _sezione(1, "ALFA"), _sezione(3, "GAMMA"))
+    bot.carica_documento(str(manuale))
+    dopo = _chunk(bot)
+
+    assert bot.ricalcolati == []
+    assert len(dopo) == 2 and dopo.keys() < prima.keys()
+    assert all(not testo.startswith("2 BETA") for testo, _ in dopo.values())
+    assert len(bot.bm25) == 2
+    contenuto = manuale.read_text(encoding="utf-8")
+    for testo, metadata in dopo.values():
+        assert contenuto[metadata["char_start"]:metadata["char_end"]] == testo
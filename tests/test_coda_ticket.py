@@ -0,0 +1,83 @@
+import sqlite3
+import time
+
+import pytest
+
+import mock_servizi
+
+TICKET = {"nome": "Mario Rossi", "reparto": "Cardiologia", "telefono": "0577 586000"}
+
+
+@pytest.fixture
+def sendgrid(monkeypatch):
+    monkeypatch.setenv("SENDGRID_API_KEY", "chiave-di-prova")
+    server = mock_servizi.avvia(porta=0, latenza_sendgrid=0.0)
+    yield server
+    server.shutdown()
+
+
+def _coda(app, tmp_path, sendgrid, **parametri):
+    url = f"http://127.0.0.1:{sendgrid.server_address[1]}/v3/mail/send"
+    parametri = dict(dict(workers=1, max_tentativi=3, backoff=0.01, backoff_max=0.05), **parametri)
+    return app.CodaTicket(path=str(tmp_path / "ticket.sqlite3"), url=url, **parametri)
+
+
+def _attendi(coda, condizione, timeout=10):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        stats = coda.stats()
+        if condizione(stats):
+            return stats
+        time.sleep(0.02)
+    pytest.fail(f"coda ferma in {coda.stats()}")
+
+
+def test_errori_temporanei_ritentati_fino_alla_dead_letter(app, tmp_path, sendgrid):
+    sendgrid.errori_sendgrid = 1.0
+    coda = _coda(app, tmp_path, sendgrid)
+    coda.accoda(TICKET)
+    stats = _attendi(coda, lambda s: s["per_stato"]["dead"] == 1)
+    assert stats["profondita"] == 0
+    assert sendgrid.stats()["email_errori"] == 3
+
+    # Corretto il problema, i ticket in dead letter si riaccodano e partono
+    sendgrid.errori_sendgrid = 0.0
+    assert coda.riaccoda_dead() == 1
+    _attendi(coda, lambda s: s["per_stato"]["inviato"] == 1)
+    assert sendgrid.stats()["email"] == 1
+    with sqlite3.connect(coda.path) as conn:
+        assert conn.execute("SELECT dati FROM ticket").fetchone() == (None,)
+
+
+def test_errore_temporaneo_poi_inviato(app, tmp_path, sendgrid):
+    sendgrid.errori_sendgrid = 1.0
+    coda = _coda(app, tmp_path, sendgrid, max_tentativi=50, backoff=0.2, backoff_max=0.2)
+    coda.accoda(TICKET)
+    _attendi(coda, lambda s: sendgrid.stats()["email_errori"] >= 1)
+    sendgrid.errori_sendgrid = 0.0
+    _attendi(coda, lambda s: s["per_stato"]["inviato"] == 1)
+    assert sendgrid.stats()["email"] == 1
+
+
+def test_esito_ignorato_se_il_ticket_e_stato_ripreso(app, tmp_path, sendgrid):
+    # Nessun thread: le prese si fanno a mano, con un lease già scaduto
+    coda = _coda(app, tmp_path, sendgrid, workers=0, lease=0)
+    id_ticket = coda.accoda(TICKET)
+    primo, righe = coda._prendi()
+    assert [riga[0] for riga in righe] == [id_ticket]
+    secondo, righe = coda._prendi()
+    assert [riga[0] for riga in righe] == [id_ticket]
+
+    assert not coda._rinnova(id_ticket, primo)
+    coda._esito(id_ticket, primo, 1)
+    assert coda.stats()["per_stato"]["in_invio"] == 1
+    coda._esito(id_ticket, secondo, 1)
+    assert coda.stats()["per_stato"]["inviato"] == 1
+
+
+def test_retry_after_limitato(app, tmp_path, sendgrid):
+    class Risposta:
+        headers = {"retry-after": "86400"}
+
+    coda = _coda(app, tmp_path, sendgrid, backoff_max=600)
+    assert coda._attesa(0, Risposta()) == 600
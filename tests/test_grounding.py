@@ -0,0 +1,23 @@
+CONTESTO = (
+    "Destinatario Email: assistenzapleiade.aous@estar.toscana.it\n"
+    "Per urgenze chiamare il numero 0577 586000\n"
+    "2 opzioni di assistenza disponibili"
+)
+
+
+def test_email_a_fine_frase(app):
+    validatore = app.GroundingValidator()
+    risposta = "Scrivere all'indirizzo assistenzapleiade.aous@estar.toscana.it."
+    assert validatore.valida(risposta, "email Pleiade", CONTESTO)
+
+
+def test_telefono_a_fine_frase(app):
+    validatore = app.GroundingValidator()
+    risposta = "Per urgenze chiamare il numero 0577 586000. 2 opzioni di assistenza disponibili."
+    assert validatore.valida(risposta, "telefono urgenze", CONTESTO)
+
+
+def test_recapito_inventato(app):
+    validatore = app.GroundingValidator()
+    assert not validatore.valida("Scrivere a supporto@estar.toscana.it.", "email", CONTESTO)
+    assert not validatore.valida("Chiamare il numero 0577 999999.", "telefono", CONTESTO)
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+
+@pytest.fixture(params=["memoria", "sqlite", "redis"])
+def backend(request, app, tmp_path):
+    if request.param == "memoria":
+        return app.SessioniMemoria(max_sessioni=100, ttl=60)
+    if request.param == "sqlite":
+        return app.SessioniSQLite(path=str(tmp_path / "sessioni.sqlite3"), ttl=60)
+    pytest.importorskip("redis")
+    backend = app.SessioniRedis(ttl=60, prefisso=f"test-{app.ArchivioSessioni.nuovo_id()}:")
+    try:
+        backend.client.ping()
+    except Exception:
+        pytest.skip("server Redis non raggiungibile")
+    return backend
+
+
+def test_stato_salvato_e_riletto_come_copia(backend):
+    stato = {"chat_history": [{"domanda": "orari?", "risposta": "8-18"}], "awaiting_ticket_field": 1,
+             "ticket_data": {"nome": "Mario Rossi"}}
+    backend.salva("s1", stato)
+    riletto = backend.carica("s1")
+    assert riletto == stato and riletto is not stato
+    riletto["ticket_data"]["nome"] = "altro"
+    assert backend.carica("s1")["ticket_data"]["nome"] == "Mario Rossi"
+
+    backend.elimina("s1")
+    assert backend.carica("s1") is None
+    assert backend.carica("mai-vista") is None
+
+
+def test_sessione_scaduta(backend, monkeypatch):
+    if backend.stats()["backend"] == "redis":
+        pytest.skip("la scadenza è gestita dal server Redis")
+    backend.salva("s1", {"chat_history": []})
+    adesso = time.time()
+    monkeypatch.setattr(time, "time", lambda: adesso + 61)
+    assert backend.carica("s1") is None
+
+
+def test_sqlite_condiviso_tra_worker(app, tmp_path):
+    primo = app.SessioniSQLite(path=str(tmp_path / "sessioni.sqlite3"))
+    secondo = app.SessioniSQLite(path=str(tmp_path / "sessioni.sqlite3"))
+    primo.salva("s1", {"awaiting_ticket_field": 2})
+    assert secondo.carica("s1") == {"awaiting_ticket_field": 2}
+    assert secondo.stats()["sessioni"] == 1
+
+
+def test_memoria_lru(app):
+    backend = app.SessioniMemoria(max_sessioni=2)
+    backend.salva("a", {})
+    backend.salva("b", {})
+    backend.carica("a")
+    backend.salva("c", {})
+    assert backend.carica("b") is None
+    assert backend.carica("a") == {} and backend.carica("c") == {}
+
+
+def test_archivio(app, tmp_path, monkeypatch):
+    monkeypatch.setenv("SESSION_BACKEND", "sqlite")
+    monkeypatch.setenv("SESSION_DB_PATH", str(tmp_path / "sessioni.sqlite3"))
+    archivio = app.ArchivioSessioni.da_ambiente()
+    assert archivio.stats()["backend"] == "sqlite"
+
+    stato = archivio.carica(None)
+    assert stato == app.ArchivioSessioni.stato_iniziale()
+    stato["chat_history"] = [{"domanda": str(i), "risposta": str(i)} for i in range(15)]
+    archivio.salva("s1", stato)
+    storico = archivio.carica("s1")["chat_history"]
+    assert len(storico) == app.ArchivioSessioni.STORICO_MAX and storico[-1]["domanda"] == "14"
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from conftest import RADICE
+
+DOCUMENTO = os.path.join(RADICE, "documento.txt")
+
+
+@pytest.fixture(scope="module")
+def sezioni(app):
+    with open(DOCUMENTO, encoding="utf-8") as f:
+        return app.IndiceSezioni.analizza(f.read())
+
+
+@pytest.fixture
+def indice(app, sezioni, tmp_path):
+    indice = app.IndiceSezioni(path=str(tmp_path / "sezioni.json"))
+    indice.imposta_source("documento.txt", sezioni)
+    return indice
+
+
+def test_nome_esatto_anche_se_parte_di_altri_nomi(indice):
+    source, numero, sezione = indice.trova_sezione("Chi sono i referenti di Aurora?")
+    assert (source, numero, sezione["nome"]) == ("documento.txt", "2", "AURORA")
+
+
+@pytest.mark.parametrize("numero", ["2", "40", "68", "76", "89", "92", "109", "121", "122",
+                                    "133", "142", "157", "158", "160", "168", "185"])
+def test_nome_esatto_senza_limite_di_lunghezza(indice, sezioni, numero):
+    trovata = indice.trova_sezione(f"Chi sono i referenti di {sezioni[numero]['nome']}?")
+    assert trovata is not None and trovata[1] == numero
+
+
+def test_ogni_sezione_raggiungibile_per_nome(indice, sezioni):
+    sbagliate = {numero: (indice.trova_sezione(f"Referenti di {sezione['nome']}") or (None, None))[1]
+                 for numero, sezione in sezioni.items()}
+    assert {numero: trovata for numero, trovata in sbagliate.items() if trovata != numero} == {}
+
+
+def test_nome_parziale_ambiguo(indice):
+    assert indice.trova_sezione("Chi sono i referenti AOUS?") is None
+
+
+def test_nome_parziale_univoco(indice):
+    assert indice.trova_sezione("referenti per la lista pazienti non visibile")[1] == "167"
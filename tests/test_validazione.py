@@ -0,0 +1,29 @@
+CONTESTO = "Il servizio di assistenza Pleiade risponde dal lunedì al venerdì dalle 8 alle 18."
+RISPOSTA = "Il servizio di assistenza Pleiade risponde dal lunedì al venerdì dalle 8 alle 18."
+
+
+class ValidatoreRemoto:
+    nome = "llm"
+
+    def __init__(self, esito=True, errore=None):
+        self.esito = esito
+        self.errore = errore
+
+    def valida(self, risposta, domanda, contesto, confidence=None):
+        if self.errore is not None:
+            raise self.errore
+        return self.esito
+
+
+def test_validatore_in_errore_non_equivale_a_scarto(app):
+    pipeline = app.ValidationPipeline([app.GroundingValidator(), ValidatoreRemoto(errore=app.LLMError("HTTP 503"))],
+                                  modo="auto", soglia_confidenza=0.6)
+    assert pipeline.valida(RISPOSTA, "orari assistenza", CONTESTO, confidence=0.3) is None
+    stats = pipeline.stats()["strategie"]["llm"]
+    assert (stats["errori"], stats["reject_rate"]) == (1, 0.0)
+
+
+def test_esiti_del_validatore_remoto(app):
+    for esito in (True, False):
+        pipeline = app.ValidationPipeline([app.GroundingValidator(), ValidatoreRemoto(esito=esito)], modo="llm")
+        assert pipeline.valida(RISPOSTA, "orari assistenza", CONTESTO) is esito